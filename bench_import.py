@@ -0,0 +1,86 @@
+"""
+benchmark the startup of a worker: the time and resident memory of importing TransChat in fresh processes
+each run is appended to import_benchmark.jsonl with the commit, so the startup can be tracked over time
+usage: python bench_import.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+# the UI and API libraries, which should only be imported where they are used
+HEAVY_MODULES = ["streamlit", "pandas", "openai", "gradio"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from demo import TransChat
+seconds = time.perf_counter() - started
+try:
+    import resource
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+except ImportError:
+    max_rss_kb = None
+print(json.dumps({"seconds": seconds, "max_rss_kb": max_rss_kb, "heavy_modules": [m for m in %r if m in sys.modules]}))
+""" % HEAVY_MODULES
+
+
+def measure(runs):
+    """
+    import TransChat in fresh interpreters, return the measurement of each run
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE], cwd=here, capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return samples
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--log", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "import_benchmark.jsonl"))
+    args = parser.parse_args()
+
+    samples = measure(args.runs)
+    seconds = sorted([s["seconds"] for s in samples])
+    record = {
+        "time": time.time(),
+        "commit": current_commit(),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "median_seconds": seconds[len(seconds) // 2],
+        "min_seconds": seconds[0],
+        "max_rss_kb": max([s["max_rss_kb"] or 0 for s in samples]),
+        "heavy_modules": sorted(set([m for s in samples for m in s["heavy_modules"]])),
+    }
+
+    previous = None
+    if os.path.exists(args.log):
+        with open(args.log, "r") as f:
+            lines = [l for l in f.read().splitlines() if l.strip() != ""]
+        if len(lines) > 0:
+            previous = json.loads(lines[-1])
+    with open(args.log, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    print(f"Importing TransChat: median {record['median_seconds'] * 1000:.1f} ms, min {record['min_seconds'] * 1000:.1f} ms, max RSS {record['max_rss_kb'] / 1024:.1f} MB over {args.runs} runs")
+    if previous is not None:
+        print(f"Previous run ({previous['commit']}): median {previous['median_seconds'] * 1000:.1f} ms, max RSS {previous['max_rss_kb'] / 1024:.1f} MB")
+    if len(record["heavy_modules"]) > 0:
+        print(f"Warning: importing TransChat also imports {', '.join(record['heavy_modules'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,1022 @@
-from openai import OpenAI
-import gradio as gr
-
 import os
 import json
 import re
-from openai import OpenAI
 import logging
 import uuid
+import hashlib
 import random
 import time
 import glob
 import argparse
-import streamlit as st
-import pandas as pd
+import sys
+import socket
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import gzip
+import difflib
+import math
+import io
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+# openai, streamlit and pandas are imported where they are used, so the workers and the scripts importing TransChat start fast
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+
+class PartialJSONString:
+    """
+    PartialJSONString decodes the string value of a key from a JSON object that arrives in chunks.
+    Each chunk is scanned once, the incomplete escape sequence at the end of a chunk is kept for the next one.
+    """
+    escapes = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", '"': '"', "\\": "\\", "/": "/"}
+
+    def __init__(self, key):
+        self.key = key
+        self.pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*"')
+        self.special = re.compile(r'["\\]')
+        self.buffer = ""
+        self.chars = []
+        self.length = 0
+        self.started = False
+        self.finished = False
+
+    def feed(self, text):
+        """
+        decode a chunk
+        :return: the length of the decoded prefix of the value
+        """
+        if self.finished:
+            return self.length
+        self.buffer += text
+        i = 0
+        if not self.started:
+            match = self.pattern.search(self.buffer)
+            if match is None:
+                # only the last occurrence of the key, or a key cut by the chunk, can still start the value
+                last = self.buffer.rfind(f'"{self.key}"')
+                self.buffer = self.buffer[last if last >= 0 else max(0, len(self.buffer) - len(self.key) - 2):]
+                return self.length
+            self.started = True
+            i = match.end()
+        buffer = self.buffer
+        while i < len(buffer):
+            c = buffer[i]
+            if c == '"':
+                self.finished = True
+                break
+            if c == "\\":
+                if i + 1 >= len(buffer):
+                    break
+                if buffer[i+1] == "u":
+                    if i + 6 > len(buffer):
+                        break
+                    self.chars.append(chr(int(buffer[i+2:i+6], 16)))
+                    self.length += 1
+                    i += 6
+                    continue
+                self.chars.append(self.escapes.get(buffer[i+1], buffer[i+1]))
+                self.length += 1
+                i += 2
+                continue
+            # the plain characters up to the next quote or escape
+            match = self.special.search(buffer, i)
+            j = match.start() if match is not None else len(buffer)
+            self.chars.append(buffer[i:j])
+            self.length += j - i
+            i = j
+        self.buffer = buffer[i:]
+        return self.length
+
+    def value(self):
+        """
+        the decoded prefix of the value, or None if the value has not started
+        """
+        if not self.started:
+            return None
+        return "".join(self.chars)
+
+
+def partial_json_string(text, key):
+    """
+    decode the string value of key from a JSON object that may still be incomplete
+    :return: the decoded prefix of the value, or None if the value has not started
+    """
+    decoder = PartialJSONString(key)
+    decoder.feed(text)
+    return decoder.value()
+
+
+def repair_json(text):
+    """
+    repair the common defects of a JSON object returned by a model:
+    code fences, text around the object, unescaped quotes and newlines in strings, and missing closing quotes and braces
+    :return: the repaired text, or None if there is no JSON object
+    """
+    fence = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.S)
+    if fence is not None:
+        text = fence.group(1)
+    start = text.find("{")
+    if start == -1:
+        return None
+    text = text[start:]
+
+    out = []
+    stack = []
+    in_string = False
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if in_string:
+            if c == "\\":
+                if i + 1 < len(text):
+                    out.append(text[i:i+2])
+                i += 2
+                continue
+            if c == '"':
+                # a quote only closes the string if a structural character follows
+                rest = text[i+1:].lstrip()
+                if rest == "" or rest[0] in ",:}]":
+                    in_string = False
+                    out.append(c)
+                else:
+                    out.append('\\"')
+                i += 1
+                continue
+            if c == "\n":
+                out.append("\\n")
+                i += 1
+                continue
+            out.append(c)
+            i += 1
+            continue
+        if c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if len(stack) == 0 or stack[-1] != c:
+                i += 1
+                continue
+            stack.pop()
+        out.append(c)
+        i += 1
+        if len(stack) == 0:
+            # drop the text after the object
+            break
+
+    if in_string:
+        out.append('"')
+    repaired = "".join(out).rstrip()
+    # drop a trailing comma or a key without a value
+    repaired = re.sub(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*:?\s*$', r"\1", repaired)
+    repaired = re.sub(r",\s*$", "", repaired)
+    return repaired + "".join(reversed(stack))
+
+
+def schema_from_format(additional_system_message):
+    """
+    derive the top-level keys and types from the JSON format described in a system message
+    :return: a dict of key to one of string, bool, int, float, list, dict
+    """
+    if additional_system_message is None:
+        return {}
+    match = re.search(r"as follows: (\{.*\})", additional_system_message)
+    if match is None:
+        return {}
+    body = match.group(1)[1:-1]
+    fields = []
+    depth = 0
+    field = ""
+    for c in body:
+        if c in "[{":
+            depth += 1
+        elif c in "]}":
+            depth -= 1
+        if c == "," and depth == 0:
+            fields.append(field)
+            field = ""
+        else:
+            field += c
+    fields.append(field)
+
+    schema = {}
+    for field in fields:
+        match = re.match(r'\s*"(\w+)"\s*:\s*(.*)', field, re.S)
+        if match is None:
+            continue
+        key, value = match.group(1), match.group(2).strip()
+        if value.startswith("["):
+            schema[key] = "list"
+        elif value.startswith("{"):
+            schema[key] = "dict"
+        elif value in ["string", "bool", "int", "float"]:
+            schema[key] = value
+    return schema
+
+
+def estimate_tokens(text):
+    """
+    estimate the number of tokens of a text without a tokenizer
+    CJK characters count as one token each, other characters as a quarter of a token
+    """
+    cjk = len(re.findall(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def set_overlap(a, b):
+    """
+    the Jaccard overlap of two lists of terms or glossary pairs, 1.0 when both are empty
+    """
+    def normalize(e):
+        if isinstance(e, dict):
+            return tuple((k, str(v).strip().lower()) for k, v in sorted(e.items()))
+        return str(e).strip().lower()
+
+    a = set([normalize(e) for e in a or []])
+    b = set([normalize(e) for e in b or []])
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def text_similarity(a, b):
+    """
+    one minus the normalized edit distance of two texts, approximated by difflib
+    """
+    a, b = a or "", b or ""
+    if a == b:
+        return 1.0
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    # the upper bounds are cheap, the exact ratio is quadratic
+    if matcher.real_quick_ratio() < 0.5 or matcher.quick_ratio() < 0.5:
+        return matcher.quick_ratio()
+    return matcher.ratio()
+
+
+
+def split_paragraphs(text):
+    """
+    the paragraphs of a text, i.e. its non-empty lines
+    """
+    return [l.strip() for l in text.split("\n") if len(l.strip()) > 0]
+
+
+def align_paragraphs(source, target):
+    """
+    align the paragraphs of a text and of its translation by their lengths
+    a bead joins one paragraph with one or two paragraphs on the other side, the cost of a bead grows with the length mismatch
+    :return: a list of beads, each a pair of lists of source and target paragraph indices, None if the texts cannot be aligned
+    """
+    if len(source) == 0 or len(target) == 0:
+        return None
+    src = [estimate_tokens(p) + 1 for p in source]
+    tgt = [estimate_tokens(p) + 1 for p in target]
+    ratio = sum(tgt) / sum(src)
+    n, m = len(source), len(target)
+    cost = [[math.inf] * (m + 1) for _ in range(n + 1)]
+    back = [[None] * (m + 1) for _ in range(n + 1)]
+    cost[0][0] = 0
+    for i in range(n + 1):
+        for j in range(m + 1):
+            if cost[i][j] == math.inf:
+                continue
+            for di, dj, penalty in [(1, 1, 0), (1, 2, 1), (2, 1, 1)]:
+                if i + di > n or j + dj > m:
+                    continue
+                c = cost[i][j] + penalty + abs(math.log(sum(tgt[j:j+dj]) / (sum(src[i:i+di]) * ratio)))
+                if c < cost[i+di][j+dj]:
+                    cost[i+di][j+dj] = c
+                    back[i+di][j+dj] = (di, dj)
+    if cost[n][m] == math.inf:
+        return None
+
+    beads = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        di, dj = back[i][j]
+        beads.append((list(range(i - di, i)), list(range(j - dj, j))))
+        i, j = i - di, j - dj
+    return beads[::-1]
+
+# a heading makes up the whole line, optionally followed by a short title after ":", "." or a dash
+HEADING_TITLE = r"\s*([:.\-–—]\s*\S.*|[:.])?\s*$"
+ROMAN_NUMERAL = r"(?=[mdclxvi])m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})"
+# the number words of the chapter headings, as cardinals and ordinals
+NUMBER_WORDS = {
+    "English": r"(twenty|thirty|forty|fifty)(-(one|two|three|four|five|six|seven|eight|nine))?|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|thirteen|fourteen|fifteen|sixteen|seventeen|eighteen|nineteen|first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth",
+    "French": r"un|une|deux|trois|quatre|cinq|six|sept|huit|neuf|dix|onze|douze|treize|quatorze|quinze|seize|dix-sept|dix-huit|dix-neuf|vingt|premier|première|second|seconde|deuxième|troisième|quatrième|cinquième|sixième|septième|huitième|neuvième|dixième",
+    "German": r"eins|zwei|drei|vier|fünf|sechs|sieben|acht|neun|zehn|elf|zwölf|dreizehn|vierzehn|fünfzehn|sechzehn|siebzehn|achtzehn|neunzehn|zwanzig|(erst|zweit|dritt|viert|fünft|sechst|siebt|acht|neunt|zehnt)(e|er|es)",
+    "Spanish": r"uno|una|dos|tres|cuatro|cinco|seis|siete|ocho|nueve|diez|once|doce|trece|catorce|quince|dieciséis|diecisiete|dieciocho|diecinueve|veinte|primero|primera|segundo|segunda|tercero|tercera|cuarto|cuarta|quinto|quinta|sexto|sexta|séptimo|séptima|octavo|octava|noveno|novena|décimo|décima",
+}
+
+# chapter heading patterns per source language, matched against short lines only
+HEADING_PATTERNS = {
+    "Chinese": [
+        re.compile(r"^\s*第[零一二三四五六七八九十百千万两〇\d]+[章回节卷]"),
+        re.compile(r"^\s*(序章|序言|楔子|尾声|后记|番外)"),
+    ],
+    "Japanese": [
+        re.compile(r"^\s*第[〇一二三四五六七八九十百千\d]+[章話回]"),
+        re.compile(r"^\s*(プロローグ|エピローグ|序章|終章)"),
+    ],
+    "Korean": [
+        re.compile(r"^\s*제\s*\d+\s*[장화]"),
+        re.compile(r"^\s*(프롤로그|에필로그)"),
+    ],
+    "English": [
+        re.compile(rf"^\s*(chapter|part|book)\s+(\d+|{ROMAN_NUMERAL}|{NUMBER_WORDS['English']}){HEADING_TITLE}", re.I),
+        re.compile(rf"^\s*(prologue|epilogue|interlude){HEADING_TITLE}", re.I),
+    ],
+    "French": [
+        re.compile(rf"^\s*(chapitre|partie)\s+(\d+|{ROMAN_NUMERAL}|{NUMBER_WORDS['French']}){HEADING_TITLE}", re.I),
+        re.compile(rf"^\s*(prologue|épilogue){HEADING_TITLE}", re.I),
+    ],
+    "German": [
+        re.compile(rf"^\s*(kapitel|teil)\s+(\d+|{ROMAN_NUMERAL}|{NUMBER_WORDS['German']}){HEADING_TITLE}", re.I),
+        re.compile(rf"^\s*\d+\.\s*kapitel{HEADING_TITLE}", re.I),
+        re.compile(rf"^\s*(prolog|epilog){HEADING_TITLE}", re.I),
+    ],
+    "Spanish": [
+        re.compile(rf"^\s*(capítulo|capitulo|parte)\s+(\d+|{ROMAN_NUMERAL}|{NUMBER_WORDS['Spanish']}){HEADING_TITLE}", re.I),
+        re.compile(rf"^\s*(prólogo|epílogo){HEADING_TITLE}", re.I),
+    ],
+}
+
+
+class Chapter:
+    """
+    Chapter is a dict-like view of one chapter of a Book.
+    Its large text fields live in the project store and are loaded on access.
+    """
+    __slots__ = ["book", "idx", "fields", "stored_fields"]
+
+    def __init__(self, book, idx):
+        self.book = book
+        self.idx = idx
+        self.fields = {}
+        self.stored_fields = set()
+
+    def __getitem__(self, key):
+        if key in self.stored_fields:
+            return self.book.load(self.idx, key)
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        if key in Book.text_fields:
+            self.book.store(self.idx, key, value)
+            self.stored_fields.add(key)
+        else:
+            self.fields[key] = value
+
+    def __contains__(self, key):
+        return key in self.stored_fields or key in self.fields
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.fields.keys()) + [k for k in Book.text_fields if k in self.stored_fields]
+
+    def to_dict(self):
+        """
+        read the whole chapter without filling the cache
+        """
+        dic = dict(self.fields)
+        for key in Book.text_fields:
+            if key in self.stored_fields:
+                dic[key] = self.book.load(self.idx, key, cache=False)
+        return dic
+
+
+class Book:
+    """
+    Book is a list-like collection of chapters whose large text fields are spilled to disk.
+    At most cache_size text fields are kept in memory, evicted in LRU order.
+    """
+    __slots__ = ["store_dir", "chapters", "cache", "cache_size", "lock"]
+
+    text_fields = [
+        "chapter_text",
+        "chapter_summary",
+        "chapter_translation_init",
+        "chapter_localization",
+        "chapter_proofreading",
+        "chapter_finalization",
+    ]
+
+    def __init__(self, store_dir, chapters=[], cache_size=64):
+        self.store_dir = store_dir
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.chapters = []
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        for dic in chapters:
+            self.append(dic)
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def __getitem__(self, idx):
+        return self.chapters[idx]
+
+    def __iter__(self):
+        return iter(self.chapters)
+
+    def append(self, dic):
+        chapter = Chapter(self, len(self.chapters))
+        self.chapters.append(chapter)
+        for key, value in dic.items():
+            chapter[key] = value
+
+    def field_path(self, idx, key):
+        return os.path.join(self.store_dir, f"chapter_{idx}_{key}.txt")
+
+    def store(self, idx, key, value):
+        path = self.field_path(idx, key)
+        tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        self.remember((idx, key), value)
+
+    def load(self, idx, key, cache=True):
+        with self.lock:
+            if (idx, key) in self.cache:
+                self.cache.move_to_end((idx, key))
+                return self.cache[(idx, key)]
+        with open(self.field_path(idx, key), "r") as f:
+            value = f.read()
+        if cache:
+            self.remember((idx, key), value)
+        return value
+
+    def remember(self, cache_key, value):
+        with self.lock:
+            self.cache[cache_key] = value
+            self.cache.move_to_end(cache_key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+
+class TranslationMemory:
+    """
+    TranslationMemory stores finalized paragraph translations across books.
+    Exact matches are looked up by source text and fuzzy matches through a MinHash LSH index over character n-grams.
+    """
+    def __init__(self, save_dir, src_lang, tgt_lang, ngram=3, num_perm=64, num_bands=32, threshold=0.5):
+        self.save_dir = save_dir
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.path = os.path.join(self.save_dir, f"{src_lang}_{tgt_lang}.jsonl")
+        self.ngram = ngram
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.threshold = threshold
+        rng = random.Random(0)
+        self.perms = [(rng.randrange(1, 2**61 - 1), rng.randrange(0, 2**61 - 1)) for _ in range(num_perm)]
+
+        self.segments = []
+        self.exact = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f.readlines():
+                    segment = json.loads(line)
+                    self.index(segment["source"], segment["target"])
+
+    def normalize(self, text):
+        return re.sub(r"\s+", " ", text).strip()
+
+    def shingles(self, text):
+        text = self.normalize(text)
+        if len(text) <= self.ngram:
+            return set([text])
+        return set([text[i:i+self.ngram] for i in range(len(text) - self.ngram + 1)])
+
+    def signature(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles]
+        return [min([(a * h + b) % (2**61 - 1) for h in hashes]) for a, b in self.perms]
+
+    def bands(self, signature):
+        rows = self.num_perm // self.num_bands
+        return [(i, tuple(signature[i*rows:(i+1)*rows])) for i in range(self.num_bands)]
+
+    def index(self, source, target):
+        key = self.normalize(source)
+        if key == "" or key in self.exact:
+            return False
+        idx = len(self.segments)
+        self.segments.append({"source": source, "target": target})
+        self.exact[key] = idx
+        for band in self.bands(self.signature(self.shingles(source))):
+            self.buckets.setdefault(band, []).append(idx)
+        return True
+
+    def add(self, source_text, target_text):
+        """
+        align a source and a translated text paragraph by paragraph and store the pairs
+        """
+        sources = [p for p in source_text.split("\n") if p.strip() != ""]
+        targets = [p for p in target_text.split("\n") if p.strip() != ""]
+        # paragraphs can only be aligned when the translation keeps the paragraph structure
+        if len(sources) != len(targets):
+            return 0
+        num_added = 0
+        with self.lock:
+            with open(self.path, "a") as f:
+                for source, target in zip(sources, targets):
+                    if self.index(source, target):
+                        f.write(json.dumps({"source": source, "target": target}, ensure_ascii=False)+"\n")
+                        num_added += 1
+        return num_added
+
+    def lookup(self, source):
+        """
+        :return: ("exact", segment, 1.0), ("fuzzy", segment, score) or None
+        """
+        key = self.normalize(source)
+        if key in self.exact:
+            return "exact", self.segments[self.exact[key]], 1.0
+        shingles = self.shingles(source)
+        candidates = set()
+        for band in self.bands(self.signature(shingles)):
+            candidates.update(self.buckets.get(band, []))
+        best = None
+        for idx in candidates:
+            other = self.shingles(self.segments[idx]["source"])
+            score = len(shingles & other) / len(shingles | other)
+            if score >= self.threshold and (best is None or score > best[2]):
+                best = ("fuzzy", self.segments[idx], score)
+        return best
+
+
+class ConversationStore:
+    """
+    ConversationStore keeps the conversation logs of a project with deduplicated message bodies.
+    Long strings are stored once as compressed blobs named by their SHA-256 hash, and the logs reference them.
+    """
+    def __init__(self, save_dir, min_blob_size=128):
+        self.save_dir = save_dir
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.min_blob_size = min_blob_size
+        # zstd when the zstandard package is installed, gzip otherwise
+        self.suffix = ".zst" if zstandard is not None else ".gz"
+        self.known = set()
+        self.stats = {"raw_bytes": 0, "stored_bytes": 0, "blobs_written": 0, "blobs_reused": 0}
+        self.lock = threading.Lock()
+
+    def blob_path(self, digest, suffix=None):
+        return os.path.join(self.save_dir, digest[:2], f"{digest}{suffix or self.suffix}")
+
+    def compress(self, data):
+        if zstandard is not None:
+            return zstandard.ZstdCompressor().compress(data)
+        return gzip.compress(data)
+
+    def decompress(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if path.endswith(".zst"):
+            if zstandard is None:
+                raise Exception(f"The zstandard package is required to read {path}.")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def put(self, text):
+        """
+        store a string as a blob, return its hash
+        """
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if digest in self.known:
+                self.stats["blobs_reused"] += 1
+                return digest
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            with self.lock:
+                self.known.add(digest)
+                self.stats["blobs_reused"] += 1
+            return digest
+        compressed = self.compress(data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(compressed)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.known.add(digest)
+            self.stats["blobs_written"] += 1
+            self.stats["stored_bytes"] += len(compressed)
+        return digest
+
+    def get(self, digest):
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            # blobs written with the other compression
+            path = self.blob_path(digest, ".gz" if self.suffix == ".zst" else ".zst")
+        return self.decompress(path).decode("utf-8")
+
+    def write(self, path, messages):
+        """
+        write a conversation log, replacing the long strings with references to their blobs
+        """
+        print(f"Writing the conversation to {path}...")
+        tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+        with open(tmp_path, "w") as f:
+            for m in messages:
+                record = {}
+                for k, v in m.items():
+                    if isinstance(v, str) and len(v) >= self.min_blob_size:
+                        v = {"$blob": self.put(v)}
+                    record[k] = v
+                line = json.dumps(record, ensure_ascii=False)+"\n"
+                with self.lock:
+                    self.stats["raw_bytes"] += len((json.dumps(m, ensure_ascii=False)+"\n").encode("utf-8"))
+                    self.stats["stored_bytes"] += len(line.encode("utf-8"))
+                f.write(line)
+        os.replace(tmp_path, path)
+
+    def read(self, path):
+        """
+        read a conversation log and reconstruct the original messages
+        """
+        messages = []
+        with open(path, "r") as f:
+            for line in f.readlines():
+                record = json.loads(line)
+                for k, v in record.items():
+                    if isinstance(v, dict) and list(v.keys()) == ["$blob"]:
+                        record[k] = self.get(v["$blob"])
+                messages.append(record)
+        return messages
+
+
+class BudgetExceeded(Exception):
+    """
+    raised instead of calling the API once a budget ceiling has been reached
+    """
+    pass
+
+
+class InvalidResponse(Exception):
+    """
+    raised by call_api once the retries of a call run out without a response that can be decoded and passes the validator
+    """
+    pass
+
+
+class Budget:
+    """
+    Budget enforces ceilings on the tokens and cost spent per project, per stage and per chapter.
+    The limits are keyed by scope: "project", "stage" and "chapter" apply to every stage or chapter, "stage:<name>" to one stage.
+    Each limit is a dict with optional "cost" and "tokens". The spend is persisted so that the limits survive restarts.
+    A call reserves its expected spend when it is checked, so that concurrent calls cannot overshoot a ceiling together.
+    """
+    def __init__(self, path, limits=None, degrade_ratio=0.8, reload_interval=10):
+        self.path = path
+        self.limits = limits or {}
+        self.degrade_ratio = degrade_ratio
+        self.spent = {}
+        # the spend persisted by the other workers of a sharded project, reloaded every reload_interval seconds
+        self.others = {}
+        self.reload_interval = reload_interval
+        self.reloaded = 0
+        # the expected spend of the calls in flight
+        self.reserved = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for scope, value in json.loads(f.read())["spent"].items():
+                    self.add(self.spent, scope, value["tokens"], value["cost"])
+        self.reload_others()
+
+    def add(self, spent, scope, tokens, cost):
+        value = spent.setdefault(scope, {"tokens": 0, "cost": 0})
+        value["tokens"] += tokens
+        value["cost"] += cost
+
+    def reload_others(self):
+        """
+        read the spend of the other workers, the lock is held by the caller
+        """
+        others = {}
+        for spent_path in glob.glob(os.path.join(os.path.dirname(self.path), "budget*.json")):
+            if os.path.abspath(spent_path) == os.path.abspath(self.path):
+                continue
+            try:
+                with open(spent_path, "r") as f:
+                    spent = json.loads(f.read())["spent"]
+            except (OSError, ValueError, KeyError):
+                # the file of another worker is being replaced
+                continue
+            for scope, value in spent.items():
+                self.add(others, scope, value["tokens"], value["cost"])
+        self.others = others
+        self.reloaded = time.time()
+
+    def scopes(self, stage, chapter_idx):
+        """
+        the scopes of a call, with the key of their limit
+        """
+        scopes = [("project", "project")]
+        if stage is not None:
+            scopes.append((f"stage:{stage}", f"stage:{stage}" if f"stage:{stage}" in self.limits else "stage"))
+        if chapter_idx is not None:
+            scopes.append((f"chapter:{chapter_idx}", "chapter"))
+        return scopes
+
+    def fraction(self, stage, chapter_idx):
+        """
+        the highest fraction of a limit spent or reserved among the scopes of a call, the lock is held by the caller
+        """
+        if len(self.limits) > 0 and time.time() - self.reloaded > self.reload_interval:
+            self.reload_others()
+        fraction = 0
+        for scope, limit_key in self.scopes(stage, chapter_idx):
+            limit = self.limits.get(limit_key, {})
+            for key in ["tokens", "cost"]:
+                if limit.get(key) is None:
+                    continue
+                spent = sum([s.get(scope, {key: 0})[key] for s in [self.spent, self.others, self.reserved]])
+                fraction = max(fraction, spent / limit[key] if limit[key] > 0 else 1)
+        return fraction
+
+    def usage(self, stage, chapter_idx):
+        with self.lock:
+            return self.fraction(stage, chapter_idx)
+
+    def check(self, stage, chapter_idx, tokens=0, cost=0):
+        """
+        refuse a call once a ceiling of its scopes has been reached, otherwise reserve its expected spend
+        :return: the reservation, to be released by spend
+        """
+        with self.lock:
+            if self.fraction(stage, chapter_idx) >= 1:
+                raise BudgetExceeded(f"The budget is spent for the stage {stage} and chapter {chapter_idx}.")
+            for scope, limit_key in self.scopes(stage, chapter_idx):
+                self.add(self.reserved, scope, tokens, cost)
+        return (stage, chapter_idx, tokens, cost)
+
+    def nearly_spent(self, stage, chapter_idx):
+        return self.usage(stage, chapter_idx) >= self.degrade_ratio
+
+    def spend(self, stage, chapter_idx, tokens, cost, reservation=None):
+        with self.lock:
+            if reservation is not None:
+                reserved_stage, reserved_chapter_idx, reserved_tokens, reserved_cost = reservation
+                for scope, limit_key in self.scopes(reserved_stage, reserved_chapter_idx):
+                    self.add(self.reserved, scope, -reserved_tokens, -reserved_cost)
+            for scope, limit_key in self.scopes(stage, chapter_idx):
+                self.add(self.spent, scope, tokens, cost)
+            tmp_path = f"{self.path}.{uuid.uuid4()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps({"limits": self.limits, "spent": self.spent}, ensure_ascii=False))
+            os.replace(tmp_path, self.path)
+
+
+class LeaseManager:
+    """
+    LeaseManager coordinates the workers sharing a project directory through lease files.
+    A lease expires unless its holder renews it by heartbeats, so the work claimed by a dead worker is reclaimed.
+    """
+    def __init__(self, lease_dir, worker_id, ttl=300):
+        self.lease_dir = lease_dir
+        os.makedirs(self.lease_dir, exist_ok=True)
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.held = set()
+        self.lock = threading.Lock()
+        self.heartbeat = threading.Thread(target=self.renew_forever, daemon=True)
+        self.heartbeat.start()
+
+    def lease_path(self, name):
+        return os.path.join(self.lease_dir, f"{name}.lease")
+
+    def read(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def is_expired(self, path, lease):
+        if lease is not None:
+            return lease["expires"] < time.time()
+        # a lease file left empty by a worker that died while creating it
+        try:
+            return os.path.getmtime(path) + self.ttl < time.time()
+        except FileNotFoundError:
+            return True
+
+    def acquire(self, name):
+        """
+        try to claim a work item, return True if this worker holds its lease
+        """
+        with self.lock:
+            if name in self.held:
+                return True
+        path = self.lease_path(name)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                lease = self.read(path)
+                if not self.is_expired(path, lease) or not self.reclaim(name, lease):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps({"worker_id": self.worker_id, "expires": time.time() + self.ttl}))
+            with self.lock:
+                self.held.add(name)
+            return True
+        return False
+
+    def reclaim(self, name, lease):
+        """
+        remove an expired lease, unless another worker has replaced it in the meantime
+        """
+        path = self.lease_path(name)
+        stale_path = f"{path}.{uuid.uuid4()}.stale"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True
+        moved = self.read(stale_path)
+        if moved is not None and not self.is_expired(stale_path, moved):
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        print(f"Reclaimed the expired lease {name} of {lease['worker_id'] if lease is not None else 'an unknown worker'}...")
+        return True
+
+    def release(self, name):
+        # under the lock, so that a heartbeat cannot renew the lease after its file is removed
+        with self.lock:
+            self.held.discard(name)
+            path = self.lease_path(name)
+            lease = self.read(path)
+            if lease is not None and lease["worker_id"] == self.worker_id:
+                os.remove(path)
+
+    def renew_forever(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            with self.lock:
+                for name in list(self.held):
+                    path = self.lease_path(name)
+                    lease = self.read(path)
+                    if lease is None or lease["worker_id"] != self.worker_id:
+                        print(f"Lost the lease {name}...")
+                        self.held.discard(name)
+                        continue
+                    tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+                    with open(tmp_path, "w") as f:
+                        f.write(json.dumps({"worker_id": self.worker_id, "expires": time.time() + self.ttl}))
+                    os.replace(tmp_path, path)
+
+
+class Profiler:
+    """
+    Profiler attributes the local CPU time and the memory allocations of a run to (stage, chapter), apart from the waits for the API.
+    Each unit of work runs under cProfile, whose statistics are accumulated per unit and written with a summary to the profile directory.
+    The wall-clock of a unit includes the units it waits for, its CPU time only counts its own thread.
+    The peak allocation of tracemalloc is global to the process, so it is only recorded for a unit that starts alone and runs without units in other threads.
+    """
+    def __init__(self, save_dir, top=30):
+        self.save_dir = save_dir
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.top = top
+        self.units = {}
+        self.stats = {}
+        # the running units and their threads, and those whose peak allocation is mixed with other threads
+        self.active = {}
+        self.shared = set()
+        self.lock = threading.Lock()
+        self.profiling = threading.local()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def entry(self, stage, chapter_idx):
+        return self.units.setdefault((stage, chapter_idx), {
+            "stage": stage,
+            "chapter_idx": chapter_idx,
+            "runs": 0,
+            "wall_seconds": 0,
+            "cpu_seconds": 0,
+            "calls": 0,
+            "call_cpu_seconds": 0,
+            "api_seconds": 0,
+            "peak_alloc_kb": None,
+        })
+
+    @contextlib.contextmanager
+    def unit(self, stage, chapter_idx=None):
+        """
+        profile a unit of work, a unit already running in another thread or nested in itself is not counted twice
+        """
+        key = (stage, chapter_idx)
+        thread = threading.get_ident()
+        with self.lock:
+            if key in self.active:
+                key = None
+            else:
+                # the allocations of this unit now count in the peaks of the units running in other threads
+                self.shared.update([k for k, t in self.active.items() if t != thread])
+                if len(self.active) == 0:
+                    tracemalloc.reset_peak()
+                    allocated = tracemalloc.get_traced_memory()[0]
+                else:
+                    # resetting the peak would lose that of the running units
+                    self.shared.add(key)
+                self.active[key] = thread
+        if key is None:
+            yield
+            return
+
+        # one cProfile per thread, the nested units are covered by the outer one
+        profile = None
+        if not getattr(self.profiling, "on", False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self.profiling.on = True
+            except ValueError:
+                # another profiler is active, e.g. in another thread with sys.monitoring
+                profile = None
+        started = time.time()
+        cpu_started = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.time() - started
+            cpu = time.thread_time() - cpu_started
+            if profile is not None:
+                profile.disable()
+                self.profiling.on = False
+            with self.lock:
+                del self.active[key]
+                e = self.entry(stage, chapter_idx)
+                e["runs"] += 1
+                e["wall_seconds"] += wall
+                e["cpu_seconds"] += cpu
+                if key in self.shared:
+                    self.shared.discard(key)
+                else:
+                    peak = (tracemalloc.get_traced_memory()[1] - allocated) / 1024
+                    e["peak_alloc_kb"] = peak if e["peak_alloc_kb"] is None else max(e["peak_alloc_kb"], peak)
+                if profile is not None:
+                    if key in self.stats:
+                        self.stats[key].add(profile)
+                    else:
+                        self.stats[key] = pstats.Stats(profile)
+
+    def record_call(self, stage, chapter_idx, cpu_seconds, api_seconds):
+        """
+        record the CPU time spent in call_api, building the messages and decoding the response, and the time waiting for the API
+        """
+        with self.lock:
+            e = self.entry(stage, chapter_idx)
+            e["calls"] += 1
+            e["call_cpu_seconds"] += cpu_seconds
+            e["api_seconds"] += api_seconds
 
+    def write_reports(self):
+        """
+        write the cProfile statistics of each unit and the largest allocation sites
+        :return: the units sorted by CPU time
+        """
+        with self.lock:
+            units = sorted([dict(e) for e in self.units.values()], key=lambda e: -e["cpu_seconds"])
+            stats = dict(self.stats)
+
+        for (stage, chapter_idx), s in stats.items():
+            name = stage if chapter_idx is None else f"{stage}_chapter_{chapter_idx}"
+            s.dump_stats(os.path.join(self.save_dir, f"{name}.prof"))
+            stream = io.StringIO()
+            pstats.Stats(os.path.join(self.save_dir, f"{name}.prof"), stream=stream).sort_stats("cumulative").print_stats(self.top)
+            with open(os.path.join(self.save_dir, f"{name}.txt"), "w") as f:
+                f.write(stream.getvalue())
+
+        # the allocations still alive at the end of the run, without those of the profiling itself
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, m.__file__) for m in [cProfile, pstats, tracemalloc]])
+        with open(os.path.join(self.save_dir, "memory.txt"), "w") as f:
+            for stat in snapshot.statistics("lineno")[:self.top]:
+                f.write(f"{stat}\n")
+        return units
 
 
 class TransChat:
@@ -32,18 +1035,67 @@ class TransChat:
         max_turns=3,
         max_retry=3,
         max_rerun=5,
+        routing_policy=None,
+        batch_mode=False,
+        batch_poll_interval=60,
+        speculative=False,
+        book_cache_size=64,
+        use_translation_memory=True,
+        stream=False,
+        worker_id=None,
+        lease_ttl=300,
+        pack_short_chapters=True,
+        heading_patterns=None,
+        chunk_tokens=2000,
+        budget=None,
+        hedge=False,
+        early_exit=True,
+        shared_dir=None,
+        profile=False,
     ):
 
         self.client = client
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
-        self.text = self.read_text(text_path)
-        self.book = self.split_chapter(self.text)
-        self.book_summary = None
         self.save_dir = save_dir
         os.makedirs(self.save_dir, exist_ok=True)
         self.project_save_dir = os.path.join(save_dir, os.path.basename(text_path))
         os.makedirs(self.project_save_dir, exist_ok=True)
+        # chapter headings of the source language, books without headings are cut into chunks of about chunk_tokens
+        self.heading_patterns = dict(HEADING_PATTERNS)
+        if heading_patterns is not None:
+            self.heading_patterns.update(heading_patterns)
+        self.max_heading_length = 50
+        self.chunk_tokens = chunk_tokens
+        self.segmentation_stats = {}
+        # workers sharing the project claim the work items through leases
+        self.leases = None
+        self.lease_poll_interval = 10
+        book_store_dir = os.path.join(self.project_save_dir, "book_store")
+        if worker_id is not None:
+            self.leases = LeaseManager(os.path.join(self.project_save_dir, "leases"), worker_id, lease_ttl)
+            book_store_dir = os.path.join(book_store_dir, worker_id)
+        # the source text is streamed into the book, it is not kept in memory
+        self.book = Book(book_store_dir, self.split_chapter(text_path), book_cache_size)
+        # the glossary terms, summaries and guidelines depend on the source text only, projects of other target languages share them
+        self.shared_dir = shared_dir
+        self.source_save_dir = self.project_save_dir
+        self.shared_leases = None
+        self.source_terms = {}
+        if shared_dir is not None:
+            # keyed by the content of the book, two books with the same file name do not share their source side
+            self.source_save_dir = os.path.join(shared_dir, f"{os.path.basename(text_path)}_{self.text_hash(text_path)[:16]}")
+            os.makedirs(self.source_save_dir, exist_ok=True)
+            self.shared_leases = LeaseManager(os.path.join(self.source_save_dir, "leases"), f"{worker_id or socket.gethostname() + '-' + str(os.getpid())}-{tgt_lang}", lease_ttl)
+        # content-addressed, so the projects sharing the source side also share the blobs
+        self.conversation_store = ConversationStore(os.path.join(self.source_save_dir, "conversation_blobs"))
+        # ceilings on the tokens and cost, skipping optional turns and accepting drafts near them
+        budget_path = os.path.join(self.project_save_dir, "budget.json" if worker_id is None else f"budget_{worker_id}.json")
+        self.budget = Budget(budget_path, budget)
+        self.book_summary = None
+        self.translation_memory = None
+        if use_translation_memory:
+            self.translation_memory = TranslationMemory(os.path.join(self.save_dir, "translation_memory"), self.src_lang, self.tgt_lang)
         self.num_senior_editors = num_senior_editors
         self.num_junior_editors = num_junior_editors
         self.num_translators = num_translators
@@ -58,13 +1110,111 @@ class TransChat:
         self.model = "gpt-4-1106-preview"
         self.input_rate = 0.00001
         self.output_rate = 0.00003
-        self.conversations = []
+        # messages of the agents and the progress of the run, polled by the front end
+        self.conversations = deque(maxlen=1000)
+        self.progress = {"stage": None, "chapters": {}, "started": None, "finished": None}
 
         # self.model = "gpt-3.5-turbo-1106"
         # self.input_rate = 0.000001
         # self.output_rate = 0.000002
 
+        self.fast_model = "gpt-3.5-turbo-1106"
+        self.model_rates = {
+            "gpt-4-1106-preview": {"input_rate": 0.00001, "output_rate": 0.00003},
+            "gpt-3.5-turbo-1106": {"input_rate": 0.000001, "output_rate": 0.000002},
+        }
+        # model tier per (role, stage, turn_kind), None matches any value
+        self.routing_policy = {
+            (None, None, "profile"): "fast",
+            (None, None, "draft"): "fast",
+            (None, None, "suggestion"): "fast",
+            (None, None, "debate"): "fast",
+            (None, None, "select"): "strong",
+            (None, None, "revise"): "strong",
+            (None, None, "finalize"): "strong",
+            (None, None, "evaluate"): "strong",
+        }
+        if routing_policy is not None:
+            self.routing_policy.update(routing_policy)
+        self.call_stats = []
+
+        # results of batched requests, consumed by call_api
+        self.batch_mode = batch_mode
+        self.batch_poll_interval = batch_poll_interval
+        self.prefetched = {}
+
+        # localize chapters while their translations are being evaluated, the chapters translated in a packed prompt are not speculated
+        self.speculative = speculative
+        # the prefetched keys of the committed speculations, a hit once call_api consumes them
+        self.speculated = set()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.stats_lock = threading.Lock()
+        # stream the responses and notify the subscribers of partial outputs
+        self.stream = stream
+        self.stream_emit_chars = 50
+        self.subscribers = []
+
+        self.decode_stats = {"clean": 0, "repaired": 0, "retried": 0, "failed": 0}
+        self.speculation_stats = {"hits": 0, "misses": 0, "cancelled": 0, "failed": 0, "packed_chapters": 0, "wasted_tokens": 0, "wasted_cost": 0}
+
+        # translate consecutive short chapters together, up to a token budget per prompt
+        self.pack_short_chapters = pack_short_chapters
+        self.short_chapter_tokens = 1000
+        self.pack_token_budget = 4000
+        # the packed prompts that failed, their chapters are translated one by one
+        self.packing_fallbacks = []
+
+        # deadlines scaled by the expected output length, and duplicate requests for the calls slower than the p95 latency
+        self.timeout_base = 60
+        self.timeout_tokens_per_second = 10
+        self.hedge = hedge
+        self.hedge_min_samples = 20
+        # one pool per stage, sized from its concurrency, see hedge_executor
+        self.hedge_executors = {}
+        self.hedge_stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0, "uncancelled_losers": 0, "extra_tokens": 0, "extra_cost": 0}
+
+        # end the glossary and summary debates once two successive outputs agree
+        self.early_exit = early_exit
+        self.convergence_threshold = 0.9
+        self.debate_stats = {}
+
+        # assumptions of the dry-run planner
+        self.plan_overhead_tokens = 300
+        self.plan_guideline_tokens = 1500
+        self.plan_short_output_tokens = 200
+        self.plan_output_ratio = 1.2
+        self.plan_base_latency = 2
+        self.plan_output_tokens_per_second = 40
+
+        # the output field of each stage, in order, the latest one is kept for a chapter once the budget is spent
+        self.draft_fields = {"source": "chapter_text", "translation": "chapter_translation_init", "localization": "chapter_localization", "proofreading": "chapter_proofreading", "finalization": "chapter_finalization"}
+        self.length_fields = ["chapter_translation_init_length", "chapter_localization_length", "chapter_proofreading_length"]
+        self.budget_degraded = []
+
+        # opt-in profiling of the local CPU time and memory per (stage, chapter), the profiles are written under profile/
+        self.profiler = None
+        if profile:
+            self.profiler = Profiler(os.path.join(self.project_save_dir, "profile" if self.leases is None else f"profile_{self.leases.worker_id}"))
+
+        # concurrent steps of the preparation, see prepare
+        self.preparation_workers = 4
+        self.preparation_stats = []
+
+        # concurrent reviews of the finalization and bounded redos of the rejected chapters
+        self.finalization_workers = 8
+        self.max_redo = 2
+        # a rejected chapter first redoes the paragraphs named by its evaluation, then the whole chapter
+        self.max_paragraph_redo = 1
+        self.rejected_evaluations = {}
+        self.paragraph_redo_stats = {"redos": 0, "spliced": 0, "accepted": 0, "paragraphs_redone": 0, "paragraphs_total": 0}
+
         self.glossary = []
+        self.translation_guidelines = None
+        # stages whose calls share the translation guidelines in the prompt prefix
+        self.guideline_stages = ["translation", "localization", "proofreading", "finalization"]
+        self.cached_input_discount = 0.5
+        # bump when the prompts change to invalidate the checkpoints
+        self.prompt_version = 1
 
         self.company_prompt = f"TransChat is a {self.src_lang} translation firm specializing in translating books across a wide range of languages. It utilizes a team with diverse backgrounds that include roles such as Senior Editor, Junior Editor, Translator, and more. Its goal is to connect cultures and languages through precise, engaging, and culturally respectful literature translations, thereby promoting a worldwide community united by the art of storytelling."
         self.project_members = {
@@ -83,20 +1233,29 @@ class TransChat:
 
         print(self.company_prompt)
 
-        self.curr_rerun = 0
+        # rerun counters of the localization and proofreading per chapter
+        self.curr_rerun = {}
 
 
     def read_text(self, path):
         """
         :param path: path to the text file
-        :return: a list of sentences
+        :return: the sentences, read one at a time
         """
-        lst = []
         with open(path, "r") as f:
-            for line in f.readlines():
+            for line in f:
                 if line.strip() != "":
-                    lst.append(line)
-        return lst
+                    yield line
+
+    def text_hash(self, path):
+        """
+        hash the content of a text file
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
 
     def write_text(self, path, text):
         """
@@ -111,11 +1270,27 @@ class TransChat:
         :param path: path to the jsonl file
         :param data: data to be written
         """
-        self.curr_rerun = 0
         print(f"Writing the data to {path}...")
-        with open(path, "w") as f:
+        # write to a temporary file first so that other workers never read a partial checkpoint
+        tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+        with open(tmp_path, "w") as f:
             for d in data:
                 f.write(json.dumps(d, ensure_ascii=False)+"\n")
+        os.replace(tmp_path, path)
+
+    def write_conversation(self, path, messages):
+        """
+        :param path: path to the conversation log
+        :param messages: messages of the conversation, long message bodies are stored once in the conversation store
+        """
+        self.conversation_store.write(path, messages)
+
+    def read_conversation(self, path):
+        """
+        :param path: path to the conversation log
+        :return: the messages of the conversation
+        """
+        return self.conversation_store.read(path)
 
     def read_jsonl(self, path):
         """
@@ -128,39 +1303,318 @@ class TransChat:
                 lst.append(json.loads(line))
         return lst
 
-    def split_chapter(self, text):
+    def split_chapter(self, text_path):
         """
-        :param text: text to be splitted
-        :return: a list of sentences
+        :param text_path: path to the text to be splitted
+        :return: the chapters, generated one at a time so that the book can spill them to disk
         """
         print("Splitting the text into chapters...")
-        book = []
-        chapter = []
-        for l in text:
-            
-            if bool(re.search(r"[\u4e00-\u9fa5\d]+章\s", l)) and len(chapter) > 0:
+        patterns = self.heading_patterns.get(self.src_lang)
+        if patterns is None:
+            patterns = [p for lang_patterns in self.heading_patterns.values() for p in lang_patterns]
+
+        # a first pass counts the headings, the text is then read again chapter by chapter
+        num_headings = 0
+        total_tokens = 0
+        self.num_sentences = 0
+        for l in self.read_text(text_path):
+            num_headings += int(len(l.strip()) <= self.max_heading_length and any([p.search(l) for p in patterns]))
+            total_tokens += estimate_tokens(l.strip())
+            self.num_sentences += 1
+
+        sizes = []
+        if num_headings >= 2:
+            method = "headings"
+            chapter = []
+            for l in self.read_text(text_path):
+                is_heading = len(l.strip()) <= self.max_heading_length and any([p.search(l) for p in patterns])
+                if is_heading and len(chapter) > 0:
+                    dic = {
+                        "chapter_title": chapter[0].strip(),
+                        "chapter_text": "\n".join(chapter),
+                    }
+                    sizes.append(estimate_tokens(dic["chapter_text"]))
+                    yield dic
+                    chapter = [l.strip()]
+                else:
+                    chapter.append(l.strip())
+
+            dic = {
+                "chapter_title": chapter[0].strip(),
+                "chapter_text": "\n".join(chapter),
+                # "chapter_summary": "",
+            }
+            sizes.append(estimate_tokens(dic["chapter_text"]))
+            yield dic
+        else:
+            print(f"Found {num_headings} chapter headings, cutting the text into chunks of about {self.chunk_tokens} tokens...")
+            method = "chunks"
+            for k, chunk in enumerate(self.chunk_paragraphs((l.strip() for l in self.read_text(text_path)), total_tokens)):
                 dic = {
-                    "chapter_title": chapter[0].strip(),
-                    "chapter_text": "\n".join(chapter),
+                    "chapter_title": f"Part {k+1}",
+                    "chapter_text": "\n".join(chunk),
                 }
-                book.append(dic)
-                chapter = [l.strip()]
-            else:
-                chapter.append(l.strip())
-
-        dic = {
-            "chapter_title": chapter[0].strip(),
-            "chapter_text": "\n".join(chapter),
-            # "chapter_summary": "",
+                sizes.append(estimate_tokens(dic["chapter_text"]))
+                yield dic
+
+        mean = sum(sizes) / len(sizes)
+        self.segmentation_stats = {
+            "method": method,
+            "num_chapters": len(sizes),
+            "min_tokens": min(sizes),
+            "max_tokens": max(sizes),
+            "mean_tokens": mean,
+            "stdev_tokens": (sum([(x - mean) ** 2 for x in sizes]) / len(sizes)) ** 0.5,
         }
-        book.append(dic)
-        return book
+        print(f"Segmentation: {self.segmentation_stats}")
+
+    def chunk_paragraphs(self, paragraphs, total):
+        """
+        cut the paragraphs into chunks of balanced sizes close to chunk_tokens, only at paragraph boundaries
+        :param total: the number of tokens of all the paragraphs
+        :return: the chunks, generated one at a time
+        """
+        num_chunks = max(1, round(total / self.chunk_tokens))
+        chunk = []
+        num_done_chunks = 0
+        done = 0
+        for p in paragraphs:
+            t = estimate_tokens(p)
+            # start the next chunk once the middle of the paragraph passes the chunk boundary
+            boundary = (num_done_chunks + 1) * total / num_chunks
+            if num_done_chunks + 1 < num_chunks and len(chunk) > 0 and done + t / 2 > boundary:
+                yield chunk
+                chunk = []
+                num_done_chunks += 1
+            chunk.append(p)
+            done += t
+        yield chunk
     
     def write_conversations(self, assistant, message):
         dialogue_turn = """###assistant###:###message###"""
-        st.write(dialogue_turn.replace("###assistant###", assistant).replace("###message###", message))
+        self.post_message(assistant, dialogue_turn.replace("###assistant###", assistant).replace("###message###", message))
         return 
 
+    def glossary_slice(self, chapter_idx):
+        """
+        the glossary entries that occur in one chapter
+        """
+        chapter_text = self.book[chapter_idx]["chapter_text"]
+        return sorted([[e["source"], e["target"]] for e in self.glossary if e["source"] in chapter_text])
+
+    def stage_inputs(self, stage, chapter_idx):
+        """
+        the inputs that a checkpoint of one stage of one chapter depends on
+        """
+        stage_assistants = {
+            "summary": ["junior_editor", "senior_editor"],
+            "translation": ["translator", "junior_editor", "senior_editor"],
+            "localization": ["localization_specialist", "junior_editor", "translator", "senior_editor"],
+            "proofreading": ["proofreader", "junior_editor", "senior_editor"],
+            "finalization": ["senior_editor"],
+        }
+        chapter = self.book[chapter_idx]
+        inputs = {
+            "stage": stage,
+            "prompt_version": self.prompt_version,
+            "chapter_text": chapter["chapter_text"],
+            "glossary": self.glossary_slice(chapter_idx),
+            "models": sorted(set([self.route_model(a, stage, k) for a in stage_assistants[stage] for k in ["draft", "suggestion", "revise", "evaluate"]])),
+        }
+        if stage != "summary":
+            inputs["guidelines"] = self.translation_guidelines
+        elif self.shared_dir is not None:
+            # the shared summaries depend on the source terms, not on the glossary of one target language
+            inputs["glossary"] = sorted(set([t for terms in self.source_terms.values() for t in terms if t in chapter["chapter_text"]]))
+        if stage == "localization":
+            inputs["chapter_translation_init"] = chapter["chapter_translation_init"]
+        if stage == "proofreading":
+            inputs["chapter_localization"] = chapter["chapter_localization"]
+        if stage == "finalization":
+            inputs["chapter_proofreading"] = chapter["chapter_proofreading"]
+            inputs["prev_chapter_proofreading"] = self.book[chapter_idx-1].get("chapter_proofreading", "") if chapter_idx > 0 else ""
+        return inputs
+
+    def stage_hash(self, stage, chapter_idx):
+        """
+        hash the inputs of one stage of one chapter
+        """
+        inputs = json.dumps(self.stage_inputs(stage, chapter_idx), ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(inputs.encode("utf-8")).hexdigest()
+
+    def is_stale(self, path, stage, chapter_idx):
+        """
+        check if the checkpoint of one stage of one chapter is missing or computed from outdated inputs
+        """
+        if not os.path.exists(path):
+            return True
+        record = self.read_jsonl(path)[0]
+        # checkpoints written before input hashing are trusted
+        if "input_hash" not in record:
+            return False
+        if record["input_hash"] == self.stage_hash(stage, chapter_idx):
+            return False
+        print(f"The {stage} of chapter {chapter_idx} is stale, recomputing...")
+        with open(os.path.join(self.project_save_dir, "invalidation.jsonl"), "a") as f:
+            f.write(json.dumps({"stage": stage, "chapter_idx": chapter_idx, "time": time.time()})+"\n")
+        return True
+
+    def run_stage(self, stage, stage_dir, load_one_chapter, process_one_chapter, workers=1):
+        """
+        run one stage over all chapters, loading the fresh checkpoints and processing the stale ones
+        in sharded mode, the chapters are claimed through leases and the stage waits for the chapters claimed by other workers
+        :param workers: the number of chapters processed concurrently, for the stages whose chapters do not depend on each other
+        """
+        def run_one_chapter(i):
+            chapter_path = os.path.join(stage_dir, f"chapter_{i}.jsonl")
+            if not self.is_stale(chapter_path, stage, i):
+                load_one_chapter(i, chapter_path)
+            elif self.leases is None:
+                self.set_progress(stage, i, "running")
+                self.process_chapter(process_one_chapter, stage, i, chapter_path)
+            elif self.leases.acquire(f"{stage}_chapter_{i}"):
+                self.set_progress(stage, i, "running")
+                try:
+                    # another worker may have finished the chapter before the lease was acquired
+                    if self.is_stale(chapter_path, stage, i):
+                        self.process_chapter(process_one_chapter, stage, i, chapter_path)
+                    else:
+                        load_one_chapter(i, chapter_path)
+                finally:
+                    self.leases.release(f"{stage}_chapter_{i}")
+            else:
+                self.set_progress(stage, i, "waiting")
+                return False
+            self.drop_prefetched(f"{stage}-draft-chapter_{i}")
+            self.set_progress(stage, i, "done")
+            return True
+
+        pending = list(range(len(self.book)))
+        self.set_progress(stage)
+        pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while len(pending) > 0:
+                finished = list(pool.map(run_one_chapter, pending) if pool is not None else map(run_one_chapter, pending))
+                waiting = [i for i, f in zip(pending, finished) if not f]
+                if len(waiting) > 0:
+                    print(f"Waiting for {len(waiting)} chapters of the {stage} claimed by other workers...")
+                    time.sleep(self.lease_poll_interval)
+                pending = waiting
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def run_exclusive(self, name, paths, step, leases=None):
+        """
+        run a step over the whole book in one worker, the other workers wait for its checkpoints and load them
+        :param leases: the leases of the workers to coordinate, those of the project if None
+        """
+        self.set_progress(name)
+        leases = leases if leases is not None else self.leases
+        while leases is not None and not all([os.path.exists(p) for p in paths]):
+            if leases.acquire(name):
+                try:
+                    with self.profile_unit(name):
+                        step()
+                finally:
+                    leases.release(name)
+                return
+            print(f"Waiting for the {name} claimed by another worker...")
+            time.sleep(self.lease_poll_interval)
+        with self.profile_unit(name):
+            step()
+
+    def profile_unit(self, stage, chapter_idx=None):
+        """
+        profile a unit of work of a stage when profiling is enabled
+        """
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.unit(stage, chapter_idx)
+
+    def process_chapter(self, process_one_chapter, stage, chapter_idx, *args):
+        """
+        process one chapter of a stage in a profiled unit
+        once the budget of the chapter is spent, its output degrades instead of failing the job, see degrade_chapter
+        """
+        if stage in self.draft_fields and stage != "translation" and self.book[chapter_idx].get("untranslated"):
+            return None
+        with self.profile_unit(stage, chapter_idx):
+            try:
+                return process_one_chapter(chapter_idx, *args)
+            except BudgetExceeded as e:
+                if stage not in self.draft_fields and stage not in ["glossary", "summary"]:
+                    raise
+                print(e)
+                self.degrade_chapter(stage, chapter_idx)
+                return None
+
+    def degrade_chapter(self, stage, chapter_idx):
+        """
+        degrade the output of a stage for a chapter whose budget is spent, the checkpoint is not written so that the stage is redone once the budget is raised
+        a chapter without glossary or summary is translated without them, a draft stage keeps the latest accepted draft
+        """
+        with self.stats_lock:
+            self.budget_degraded.append({"stage": stage, "chapter_idx": chapter_idx})
+        if stage == "glossary":
+            print(f"Leaving the glossary of chapter {chapter_idx} out within the budget...")
+            self.source_terms.setdefault(chapter_idx, [])
+        elif stage == "summary":
+            print(f"Leaving the summary of chapter {chapter_idx} out within the budget...")
+            self.book[chapter_idx]["chapter_summary"] = ""
+        else:
+            self.keep_latest_draft(stage, chapter_idx)
+
+    def keep_latest_draft(self, stage, chapter_idx):
+        """
+        take the latest accepted draft of a chapter as the output of a stage
+        a chapter without any translation is marked as untranslated, the later stages skip it
+        """
+        fields = list(self.draft_fields.values())
+        chapter = self.book[chapter_idx]
+        field = self.draft_fields[stage]
+        if field in chapter or chapter.get("untranslated"):
+            return
+        draft_field = next(f for f in reversed(fields[:fields.index(field)]) if f in chapter)
+        if draft_field == "chapter_text":
+            print(f"Chapter {chapter_idx} is left untranslated within the budget...")
+            chapter["untranslated"] = True
+            return
+        print(f"Keeping the latest draft of chapter {chapter_idx} as its {stage} within the budget...")
+        draft = chapter[draft_field]
+        chapter[field] = draft
+        if f"{field}_length" in self.length_fields:
+            chapter[f"{field}_length"] = len(draft.split())
+
+    def accept_near_budget(self, stage, chapter_idx):
+        """
+        near the budget, a rejected draft is accepted instead of being redone
+        """
+        if not self.budget.nearly_spent(stage, chapter_idx):
+            return False
+        print(f"Accepting the rejected {stage} of chapter {chapter_idx} near the budget...")
+        return True
+
+    def debate_converged(self, stage, previous, current, turns_left, chapter_idx=None):
+        """
+        compare two successive outputs of a debate, the remaining turns are skipped if they agree
+        lists are compared by set overlap, texts by normalized edit distance
+        """
+        if isinstance(current, list):
+            similarity = set_overlap(previous, current)
+        else:
+            similarity = text_similarity(previous, current)
+        converged = self.early_exit and similarity >= self.convergence_threshold
+        with self.stats_lock:
+            stats = self.debate_stats.setdefault(stage, {"checks": 0, "early_exits": 0, "turns_saved": 0})
+            stats["checks"] += 1
+            if converged:
+                stats["early_exits"] += 1
+                stats["turns_saved"] += turns_left
+        if converged:
+            print(f"The {stage} debate of chapter {chapter_idx} converged with similarity {similarity:.2f}, skipping {turns_left} turns...")
+        return converged
+
     def compute_cost(self, prev_messages):
         """
         compute the cost of the conversation
@@ -170,48 +1624,157 @@ class TransChat:
             costs[m["uuid"]] = m["cost"]
         return sum(costs.values())
 
-    def evaluate_translation(self, chapter_text, chapter_translation):
+    def evaluate_translation(self, chapter_text, chapter_translation, stage=None, chapter_idx=None):
         prev_messages = []
-        translation_guildelines = self.translation_guidelines
-        message = f"Translation Guidelines:\n\n{translation_guildelines}\n\nChapter Text:\n\n{chapter_text}\n\nChapter Translation:\n\n{chapter_translation}\n\nConsiderring the translation guidelines, including the glossary, book summary, tone, style, and target audience, please carefully evaluate the translation and provide a detailed justification. Ensure that the translation aligns with the original chapter text closely."
-        prev_messages.append({"role": "junion_editor", "content": message})
-        st.chat_message(self.project_roles["junion_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"finalize\": bool}. The value of \"finalize\" should be set to true if the translation is of high quality and does not require any further editing. Please do not change the key of the JSON object."
+        alignment = self.paragraph_alignment(chapter_text, chapter_translation)
+        if alignment is None:
+            message = f"Chapter Text:\n\n{chapter_text}\n\nChapter Translation:\n\n{chapter_translation}\n\nConsiderring the translation guidelines, including the glossary, book summary, tone, style, and target audience, please carefully evaluate the translation and provide a detailed justification. Ensure that the translation aligns with the original chapter text closely."
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"finalize\": bool}. The value of \"finalize\" should be set to true if the translation is of high quality and does not require any further editing. Please do not change the key of the JSON object."
+        else:
+            message = f"Chapter Text:\n\n{self.numbered_paragraphs(alignment, 'source')}\n\nChapter Translation:\n\n{self.numbered_paragraphs(alignment, 'target')}\n\nConsiderring the translation guidelines, including the glossary, book summary, tone, style, and target audience, please carefully evaluate the translation and provide a detailed justification. Ensure that the translation aligns with the original chapter text closely. The paragraphs are numbered, and each translated paragraph has the number of its source paragraph."
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"finalize\": bool, \"faulty_paragraphs\": [int]}. The value of \"finalize\" should be set to true if the translation is of high quality and does not require any further editing. The \"faulty_paragraphs\" key should list the numbers of the paragraphs whose translation needs editing. Please do not change the key of the JSON object."
+        prev_messages.append({"role": "junior_editor", "content": message})
+        self.post_message(self.project_roles["junior_editor"], message)
         content, response = self.call_api(
             assistant="senior_editor",
             message=message,
             content_key="finalize",
             additional_system_message=additional_system_message,
             prev_messages=[],
+            stage=stage,
+            turn_kind="evaluate",
+            chapter_idx=chapter_idx,
         )
         print(content)
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         return content, prev_messages
 
+    def paragraph_alignment(self, chapter_text, chapter_translation):
+        """
+        the alignment index of the paragraphs of a chapter and of its translation
+        :return: a list of aligned {"source": string, "target": string} paragraphs, None if the paragraphs cannot be aligned
+        """
+        source = split_paragraphs(chapter_text)
+        target = split_paragraphs(chapter_translation)
+        beads = align_paragraphs(source, target)
+        if beads is None or len(beads) < 2:
+            return None
+        return [{"source": "\n".join([source[i] for i in s]), "target": "\n".join([target[j] for j in t])} for s, t in beads]
+
+    def numbered_paragraphs(self, alignment, side):
+        """
+        render one side of an alignment with the paragraph numbers
+        """
+        return "\n".join([f"[{k}] {a[side]}" for k, a in enumerate(alignment)])
+
+    def redo_paragraphs(self, chapter_idx, stage, chapter_translation, evaluation, prev_messages):
+        """
+        regenerate the paragraphs named by a rejecting evaluation in the context of the chapter and splice them into the translation
+        :return: the spliced translation, None if no paragraph is named or the new paragraphs cannot be spliced
+        """
+        chapter_text = self.book[chapter_idx]["chapter_text"]
+        alignment = self.paragraph_alignment(chapter_text, chapter_translation)
+        if alignment is None:
+            return None
+        faulty = sorted(set([k for k in evaluation.get("faulty_paragraphs") or [] if isinstance(k, int) and not isinstance(k, bool) and 0 <= k < len(alignment)]))
+        if len(faulty) == 0:
+            return None
+        print(f"Redoing paragraphs {faulty} of the {stage} of chapter {chapter_idx}...")
+
+        assistant = "proofreader" if stage in ["proofreading", "finalization"] else "translator"
+        message = f"Chapter Text:\n\n{self.numbered_paragraphs(alignment, 'source')}\n\nChapter Translation:\n\n{self.numbered_paragraphs(alignment, 'target')}\n\nEvaluation:\n\n{evaluation.get('justification', '')}\n\nGuided by our translation guidelines, including the glossary, book summary, tone, style, and target audience, translate the paragraphs {', '.join([str(k) for k in faulty])} of the chapter text again, addressing the evaluation. The new paragraphs MUST fit the surrounding paragraphs of the chapter translation."
+        additional_system_message = "Your response should always be in JSON format as follows: {\"paragraphs\": [{\"paragraph\": int, \"translation\": string}, ...]}. Please do not change the key of the JSON object. The \"paragraph\" key should be set to the number of the paragraph and the \"translation\" key to its new translation."
+        content, response = self.call_api(
+            assistant=assistant,
+            message=message,
+            content_key="paragraphs",
+            additional_system_message=additional_system_message,
+            prev_messages=[],
+            stage=stage,
+            turn_kind="repair",
+            chapter_idx=chapter_idx,
+        )
+        prev_messages.append({"role": "senior_editor", "content": message})
+        self.post_message(self.project_roles["senior_editor"], message)
+        prev_messages.append({"role": assistant, "content": json.dumps(content, ensure_ascii=False)})
+        self.post_message(self.project_roles[assistant], content)
+
+        redone = {}
+        for p in content["paragraphs"]:
+            if isinstance(p, dict) and p.get("paragraph") in faulty and isinstance(p.get("translation"), str) and len(p["translation"].strip()) > 0:
+                redone[p["paragraph"]] = p["translation"].strip()
+        separator = "\n\n" if "\n\n" in chapter_translation else "\n"
+        spliced = separator.join([redone.get(k, a["target"]) for k, a in enumerate(alignment)])
+
+        with self.stats_lock:
+            self.paragraph_redo_stats["redos"] += 1
+            self.paragraph_redo_stats["paragraphs_redone"] += len(redone)
+            self.paragraph_redo_stats["paragraphs_total"] += len(alignment)
+        ratio = len(spliced.split()) / max(1, len(chapter_translation.split()))
+        print(len(spliced.split()), len(chapter_translation.split()), ratio)
+        if len(redone) == 0 or ratio < 0.9:
+            return None
+        with self.stats_lock:
+            self.paragraph_redo_stats["spliced"] += 1
+        return spliced
+
+    def repair_translation(self, chapter_idx, stage, chapter_translation, evaluation, prev_messages):
+        """
+        redo the faulty paragraphs of a rejected translation and evaluate it again, up to max_paragraph_redo times
+        :return: the latest translation and its evaluation
+        """
+        for attempt in range(self.max_paragraph_redo):
+            if evaluation["finalize"] or self.budget.nearly_spent(stage, chapter_idx):
+                break
+            repaired = self.redo_paragraphs(chapter_idx, stage, chapter_translation, evaluation, prev_messages)
+            if repaired is None:
+                break
+            chapter_translation = repaired
+            evaluation, lst = self.evaluate_translation(self.book[chapter_idx]["chapter_text"], chapter_translation, stage=stage, chapter_idx=chapter_idx)
+            prev_messages.extend(lst)
+            if evaluation["finalize"]:
+                with self.stats_lock:
+                    self.paragraph_redo_stats["accepted"] += 1
+        return chapter_translation, evaluation
+
     def execute(self):
 
-        
-        self.initialize_company()
-        st.chat_message("sys").write(self.company_prompt + "\n Our employees are:")
+        self.progress["started"] = time.time()
+        try:
+            self.run_project()
+        except BudgetExceeded as e:
+            # the stages keep the latest drafts of their chapters, only the setup and the preparation get here
+            print(e)
+            print("The budget is spent, writing down the book with the latest accepted drafts...")
+            for i in range(len(self.book)):
+                self.keep_latest_draft("finalization", i)
+            if self.leases is None or self.leases.acquire("write_down"):
+                self.write_down_the_book()
+                if self.leases is not None:
+                    self.leases.release("write_down")
+            self.write_telemetry_summary()
+        self.progress["finished"] = time.time()
+
+    def run_project(self):
+        """
+        set up the company and the project, prepare, translate and post-process the book
+        """
+        company_dir = os.path.join(self.save_dir, "company")
+        self.run_exclusive("company", [os.path.join(company_dir, f"{role}_pool.jsonl") for role in ["senior_editor", "junior_editor", "translator", "localization_specialist", "proofreader"]], self.initialize_company)
+        self.post_message("sys", self.company_prompt + "\n Our employees are:")
         all_members = self.senior_editor_pool + self.junior_editor_pool +self.translator_pool +self.localization_specialist_pool +self.proofreader_pool
-        df = pd.DataFrame().from_dict(
-            {"Members":[elem["name"] for elem in all_members],"Profile":[elem["text"][8:] for elem in all_members]}
-        )
-        st.chat_message("sys").table(df)
+        self.post_message("sys", {"Members":[elem["name"] for elem in all_members],"Profile":[elem["text"][8:] for elem in all_members]}, kind="table")
 
        
-        self.initialize_project()
+        self.run_exclusive("project", [os.path.join(self.project_save_dir, "project_members.jsonl")], self.initialize_project)
         # project_members = list(self.project_members.items())
-        st.chat_message("sys").write(f"The project is to translate a book from {self.src_lang} to {self.tgt_lang}, which has {len(self.book)} chapters and {len(self.text)} sentences. The project team is:")
-        df = pd.DataFrame().from_dict(
-            {"Members":list(self.project_members.keys()),"Profile":[elem["role_prompt"][8:] for elem in list(self.project_members.values())]}
-        )
+        self.post_message("sys", f"The project is to translate a book from {self.src_lang} to {self.tgt_lang}, which has {len(self.book)} chapters and {self.num_sentences} sentences. The project team is:")
         self.project_roles = {name: profile["role_prompt"].split(",")[8:] for name, profile in self.project_members.items()}
-        st.chat_message("sys").table(df)
+        self.post_message("sys", {"Members":list(self.project_members.keys()),"Profile":[elem["role_prompt"][8:] for elem in list(self.project_members.values())]}, kind="table")
 
 
-        st.chat_message("sys").write("Preparing the project")
+        self.post_message("sys", "Preparing the project")
         self.prepare()
 
 
@@ -270,6 +1833,8 @@ class TransChat:
                 content_key="profile",
                 additional_system_message=additional_system_message,
                 prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile = content["profile"]
             profile["profession"] = "senior_editor"
@@ -284,14 +1849,16 @@ class TransChat:
                 message=message,
                 content_key="text",
                 additional_system_message=additional_system_message,
-                prev_messages=[]
+                prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile["text"] = content["text"]
             print(profile)
             senior_editors.append(profile)
             idx += 1
             name, text = profile["name"], profile["text"]
-            st.chat_message("ceo").write(f"recuiting senior editors: {text[8:]}")
+            self.post_message("ceo", f"recuiting senior editors: {text[8:]}")
 
         self.senior_editor_pool = senior_editors
         self.write_jsonl(senior_editor_path, senior_editors)
@@ -321,6 +1888,8 @@ class TransChat:
                 content_key="profile",
                 additional_system_message=additional_system_message,
                 prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile = content["profile"]
             profile["profession"] = "junior_editor"
@@ -334,14 +1903,16 @@ class TransChat:
                 message=message,
                 content_key="text",
                 additional_system_message=additional_system_message,
-                prev_messages=[]
+                prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile["text"] = content["text"]
             profile["uuid"] = str(uuid.uuid4())
             junior_editors.append(profile)
             idx += 1
             name, text = profile["name"], profile["text"]
-            st.chat_message("ceo").write(f"recuiting junior editors: {text[8:]}")
+            self.post_message("ceo", f"recuiting junior editors: {text[8:]}")
 
         self.junior_editor_pool = junior_editors
         self.write_jsonl(junior_editor_path, junior_editors)
@@ -370,6 +1941,8 @@ class TransChat:
                 content_key="profile",
                 additional_system_message=additional_system_message,
                 prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile = content["profile"]
             profile["profession"] = "translator"
@@ -383,14 +1956,16 @@ class TransChat:
                 message=message,
                 content_key="text",
                 additional_system_message=additional_system_message,
-                prev_messages=[]
+                prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile["text"] = content["text"]
             profile["uuid"] = str(uuid.uuid4())
             translators.append(profile)
             idx += 1
             name, text = profile["name"], profile["text"]
-            st.chat_message("ceo").write(f"recuiting translators: {text[8:]}")
+            self.post_message("ceo", f"recuiting translators: {text[8:]}")
         
         self.translator_pool = translators
         self.write_jsonl(translator_path, translators)
@@ -419,6 +1994,8 @@ class TransChat:
                 content_key="profile",
                 additional_system_message=additional_system_message,
                 prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile = content["profile"]
             profile["profession"] = "localization_specialist"
@@ -432,7 +2009,9 @@ class TransChat:
                 message=message,
                 content_key="text",
                 additional_system_message=additional_system_message,
-                prev_messages=[]
+                prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile["text"] = content["text"]
             profile["uuid"] = str(uuid.uuid4())
@@ -441,7 +2020,7 @@ class TransChat:
             idx += 1
             name, text = profile["name"], profile["text"]
 
-            st.chat_message("ceo").write(f"Recuiting localization specialists: {text[8:]}")
+            self.post_message("ceo", f"Recuiting localization specialists: {text[8:]}")
 
         self.localization_specialist_pool = localization_specialists
         self.write_jsonl(localization_specialist_path, localization_specialists)
@@ -470,6 +2049,8 @@ class TransChat:
                 content_key="profile",
                 additional_system_message=additional_system_message,
                 prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile = content["profile"]
             profile["profession"] = "proofreader"
@@ -483,7 +2064,9 @@ class TransChat:
                 message=message,
                 content_key="text",
                 additional_system_message=additional_system_message,
-                prev_messages=[]
+                prev_messages=[],
+                stage="recruitment",
+                turn_kind="profile",
             )
             profile["text"] = content["text"]
             profile["uuid"] = str(uuid.uuid4())
@@ -491,7 +2074,7 @@ class TransChat:
             proofreaders.append(profile)
             idx += 1
             name, text = profile["name"], profile["text"]
-            st.chat_message("ceo").write(f"Recuiting proofreaders: {text[8:]}")
+            self.post_message("ceo", f"Recuiting proofreaders: {text[8:]}")
 
         self.proofreader_pool = proofreaders
         self.write_jsonl(proofreader_path, proofreaders)
@@ -505,7 +2088,7 @@ class TransChat:
         print("*********************************************************************")
         print(f"The project is to translate a book from {self.src_lang} to {self.tgt_lang}.")
         print(f"The book has {len(self.book)} chapters.")
-        print(f"The book has {len(self.text)} sentences.")
+        print(f"The book has {self.num_sentences} sentences.")
         project_members_path = os.path.join(self.project_save_dir, "project_members.jsonl")
         if os.path.exists(project_members_path):
             print(f"Loading the project members from {project_members_path}...")
@@ -567,7 +2150,7 @@ class TransChat:
         turn = 0
 
 
-        st.chat_message(assignor).write(f"I need to choose a {assignee_title_map[assignee]} who fits the project best as one of my teammates")
+        self.post_message(assignor, f"I need to choose a {assignee_title_map[assignee]} who fits the project best as one of my teammates")
 
 
 
@@ -585,6 +2168,8 @@ class TransChat:
                     content_key="candidate_name",
                     additional_system_message=additional_system_message,
                     prev_messages=prev_messages,
+                    stage="assignment",
+                    turn_kind="select",
                 )
                 print(content) #TODO: printout
                 assignee_name = content["candidate_name"]
@@ -599,7 +2184,7 @@ class TransChat:
                 continue
             selected_assignee = [e for e in assignee_pool if e["name"] == assignee_name][0]
             prev_messages.append({"role": assignor, "content": assignee_justification})
-            st.chat_message(assignor).write(assignee_justification)
+            self.post_message(assignor, assignee_justification)
 
             message = "Would you like to finalize your decision regarding this candidate, particularly in terms of their language skills?"
             additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"finalize\": bool}. Please do not change the key of the JSON object. The value of \"finalize\" should be set to true if you are satified with this candidate."
@@ -609,12 +2194,14 @@ class TransChat:
                 content_key="finalize",
                 additional_system_message=additional_system_message,
                 prev_messages=prev_messages,
+                stage="assignment",
+                turn_kind="finalize",
             )
             prev_messages.append({"role": "user", "content": message})
             print(content)
             finalize = content["finalize"]
             prev_messages.append({"role": assignor, "content": json.dumps(content, ensure_ascii=False)})
-            st.chat_message(assignor).write(content["justification"])
+            self.post_message(assignor, content["justification"])
 
 
             if finalize:
@@ -641,31 +2228,114 @@ class TransChat:
              
     def prepare(self):
         """
-        a sequence of steps to prepare the text for translation, including: 
+        a graph of steps to prepare the text for translation, including: 
         glossary translation,
         chapter summarization, 
         book summarization, 
-        personnel recuitment,
+        guideline definition,
+        the independent steps run concurrently, and each step loads its checkpoints if any
         """
-        self.document_glossary()
-        self.summarize_chapters()
-        self.summarize_book()
-        self.define_guidelines()
+        glossary_path = os.path.join(self.project_save_dir, "glossary", "glossary.jsonl")
+        summary_dir = os.path.join(self.source_save_dir, "summary")
+        guidelines_dir = os.path.join(self.source_save_dir, "guidelines")
+        # with a shared source side, the first project to get to a source step runs it, the projects of the other target languages load it
+        leases = self.shared_leases
+        nodes = {
+            "glossary": ([], lambda: self.run_exclusive("glossary", [glossary_path], self.document_glossary)),
+            "summaries": (["glossary"], self.summarize_chapters),
+            "book_summary": (["summaries"], lambda: self.run_exclusive("book_summary", [os.path.join(summary_dir, "book_summary.jsonl")], self.summarize_book, leases)),
+            "guidelines": (["book_summary"], lambda: self.run_exclusive("guidelines", [os.path.join(guidelines_dir, f"{name}.jsonl") for name in ["tone", "style", "target_audience"]], self.define_guidelines, leases)),
+        }
+        if self.shared_dir is not None:
+            # the summaries depend on the source terms only, so they run along the translation of the glossary
+            nodes["source_terms"] = ([], lambda: self.run_exclusive("source_terms", [os.path.join(self.source_save_dir, "glossary", "terms.jsonl")], self.extract_source_terms, leases))
+            nodes["glossary"] = (["source_terms"], nodes["glossary"][1])
+            nodes["summaries"] = (["source_terms"], lambda: self.run_exclusive("summaries", [os.path.join(summary_dir, f"chapter_{i}.jsonl") for i in range(len(self.book))], self.summarize_chapters, leases))
+        self.run_graph(nodes)
         # self.recruit_beta_readers()
         self.finalize_preparation()
 
-    def document_glossary(self):
+    def run_graph(self, nodes):
         """
-        document the glossary
+        run the nodes of a dependency graph, each one as soon as the nodes it depends on are done
+        :param nodes: a dict of node name to the names of its dependencies and a function without arguments
         """
-        print("*********************************************************************")
-        print("********************** Documenting the glossary... ******************")
-        print("*********************************************************************")
-        glossary_dir = os.path.join(self.project_save_dir, "glossary")
-        os.makedirs(glossary_dir, exist_ok=True)
-        glossary_path = os.path.join(glossary_dir, "glossary.jsonl")
-        if os.path.exists(glossary_path):
-            print(f"Loading the glossary from {glossary_path}...")
+        done = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.preparation_workers) as pool:
+            while len(done) < len(nodes):
+                for name, (dependencies, step) in nodes.items():
+                    if name not in done and name not in running.values() and all([d in done for d in dependencies]):
+                        running[pool.submit(self.run_node, name, step)] = name
+                if len(running) == 0:
+                    raise Exception(f"The nodes {sorted(set(nodes) - done)} depend on each other.")
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()
+                    done.add(name)
+
+    def run_node(self, name, step):
+        """
+        run one node of a dependency graph and record its wall-clock
+        """
+        started = time.time()
+        step()
+        with self.stats_lock:
+            self.preparation_stats.append({"node": name, "started": started, "seconds": time.time() - started})
+
+    def extract_source_terms(self):
+        """
+        extract the source terms of the glossary of each chapter, to be translated by each target language
+        """
+        glossary_dir = os.path.join(self.source_save_dir, "glossary")
+        os.makedirs(glossary_dir, exist_ok=True)
+        terms_path = os.path.join(glossary_dir, "terms.jsonl")
+        if os.path.exists(terms_path):
+            print(f"Loading the glossary terms from {terms_path}...")
+            self.source_terms = {e["chapter_idx"]: e["terms"] for e in self.read_jsonl(terms_path)}
+            return
+
+        existing_terms = []
+        for i in range(len(self.book)):
+            chapter_path = os.path.join(glossary_dir, f"chapter_{i}.jsonl")
+            if os.path.exists(chapter_path):
+                print(f"Loading the glossary terms of chapter {i} from {chapter_path}...")
+                terms = self.read_jsonl(chapter_path)[0]["terms"]
+            else:
+                print(f"Extracting the glossary terms of chapter {i}...")
+                terms = self.process_chapter(self.extract_source_terms_one_chapter, "glossary", i, chapter_path, existing_terms)
+                if terms is None:
+                    continue
+            self.source_terms[i] = terms
+            existing_terms.extend([t for t in terms if t not in existing_terms])
+
+        # the chapters left out within the budget are extracted again on the next run
+        if all([os.path.exists(os.path.join(glossary_dir, f"chapter_{i}.jsonl")) for i in range(len(self.book))]):
+            self.write_jsonl(terms_path, [{"chapter_idx": i, "terms": terms} for i, terms in self.source_terms.items()])
+
+    def extract_source_terms_one_chapter(self, chapter_idx, save_path, existing_terms):
+        """
+        extract the source terms of the glossary of one chapter
+        """
+        prev_messages = []
+        terms = self.extract_glossary_terms(chapter_idx, existing_terms, prev_messages)
+        self.write_jsonl(save_path, [{"terms": terms}])
+        self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+        return terms
+
+    def document_glossary(self):
+        """
+        document the glossary
+        """
+        print("*********************************************************************")
+        print("********************** Documenting the glossary... ******************")
+        print("*********************************************************************")
+        glossary_dir = os.path.join(self.project_save_dir, "glossary")
+        os.makedirs(glossary_dir, exist_ok=True)
+        glossary_path = os.path.join(glossary_dir, "glossary.jsonl")
+        if os.path.exists(glossary_path):
+            print(f"Loading the glossary from {glossary_path}...")
             self.glossary = self.read_jsonl(glossary_path)
             return
 
@@ -676,7 +2346,7 @@ class TransChat:
                 print(f"Loading the glossary of chapter {i} from {chapter_path}...")
                 self.glossary.extend(self.read_jsonl(chapter_path))
             else:
-                self.document_glossary_one_chapter(i, chapter_path)
+                self.process_chapter(self.document_glossary_one_chapter, "glossary", i, chapter_path)
 
         new_glossary = []
         print(self.glossary)
@@ -685,7 +2355,9 @@ class TransChat:
                 new_glossary.append(g)
 
         self.glossary = new_glossary
-        self.write_jsonl(glossary_path, self.glossary)
+        # the chapters left out within the budget are documented again on the next run
+        if all([os.path.exists(os.path.join(glossary_dir, f"chapter_{i}.jsonl")) for i in range(num_chapters)]):
+            self.write_jsonl(glossary_path, self.glossary)
 
     def document_glossary_one_chapter(self, chapter_idx, save_path):
         """
@@ -693,13 +2365,25 @@ class TransChat:
         """
         print(f"Documenting the glossary of chapter {chapter_idx}...")
         prev_messages = []
-        glossary = None
+        if self.shared_dir is not None:
+            chapter_glossary = self.source_terms.get(chapter_idx, [])
+        else:
+            chapter_glossary = self.extract_glossary_terms(chapter_idx, [e["source"] for e in self.glossary], prev_messages)
+
+        chapter_glossary_pairs = self.translate_glossary(chapter_idx, save_path, chapter_glossary)
+        self.write_jsonl(save_path, chapter_glossary_pairs)
+        self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+        self.glossary.extend(chapter_glossary_pairs)
 
+    def extract_glossary_terms(self, chapter_idx, existing_terms, prev_messages):
+        """
+        extract the source terms of the glossary of one chapter, excluding the existing terms
+        """
         curr_chapter = self.book[chapter_idx]
         chapter_title = curr_chapter["chapter_title"]
         chapter_text = curr_chapter["chapter_text"]
 
-        glossary_text = ", ".join([e["source"] for e in self.glossary])
+        glossary_text = ", ".join(existing_terms)
         message = f"Existing {self.src_lang} Glossary:\n\n{glossary_text}\n\nChapter Text:\n\n{chapter_text}\n\nPlease analyze the text and identify all specialized terms that could lead to inconsistent translations, negatively affecting the quality of the translation, such as character names and specific in-world terminologies. In your response, include only the terms in {self.src_lang} and exclude those already in the glossary. Note that the generic and non-essential terms should be excluded as well."
         # print(message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"glossary\": [string]}. Please do not change the key of the JSON object."
@@ -711,18 +2395,22 @@ class TransChat:
             content_key="glossary",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="glossary",
+            turn_kind="draft",
+            chapter_idx=chapter_idx,
         )
         # st.chat_message()
         prev_messages.append({"role": "senior_editor", "content": message})
-        st.chat_message(self.project_roles["senior_editor"]).write(message)
+        self.post_message(self.project_roles["senior_editor"], message)
         prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(json.dumps(content, ensure_ascii=False))
+        self.post_message(self.project_roles["junior_editor"], json.dumps(content, ensure_ascii=False))
 
+        draft_glossary = content["glossary"]
         print(prev_messages[-1])
 
         message = "I believe that some non-essential terms are included, while some crucial terms are omitted. In my view, the following terms could potentially lead to inconsistencies during the translation process."
         prev_messages.append({"role": "senior_editor", "content": message})
-        st.chat_message(self.project_roles["senior_editor"]).write(message)
+        self.post_message(self.project_roles["senior_editor"], message)
         
         additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"glossary\": [string]}. Please do not change the key of the JSON object."
         content, response = self.call_api(
@@ -731,31 +2419,34 @@ class TransChat:
             content_key="glossary",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="glossary",
+            turn_kind="debate",
+            chapter_idx=chapter_idx,
         )
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(json.dumps(content, ensure_ascii=False))
+        self.post_message(self.project_roles["senior_editor"], json.dumps(content, ensure_ascii=False))
         print(prev_messages[-1])
 
-        message = f"Please review and finalize the glossary of chapter text. Please remove those generic and non-essential terms from the glossary."
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"glossary\": [string]}. Please do not change the key of the JSON object."
-        content, response = self.call_api(
-            assistant="senior_editor",
-            message=None,
-            content_key="glossary",
-            additional_system_message=additional_system_message,
-            prev_messages=prev_messages,
-        )
-        prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(json.dumps(content, ensure_ascii=False))
+        if not self.debate_converged("glossary", draft_glossary, content["glossary"], 1, chapter_idx):
+            message = f"Please review and finalize the glossary of chapter text. Please remove those generic and non-essential terms from the glossary."
+            prev_messages.append({"role": "junior_editor", "content": message})
+            self.post_message(self.project_roles["junior_editor"], message)
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"glossary\": [string]}. Please do not change the key of the JSON object."
+            content, response = self.call_api(
+                assistant="senior_editor",
+                message=None,
+                content_key="glossary",
+                additional_system_message=additional_system_message,
+                prev_messages=prev_messages,
+                stage="glossary",
+                turn_kind="finalize",
+                chapter_idx=chapter_idx,
+            )
+            prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
+            self.post_message(self.project_roles["senior_editor"], json.dumps(content, ensure_ascii=False))
         chapter_glossary = content["glossary"]
         print(content)
-
-        chapter_glossary_pairs = self.translate_glossary(chapter_idx, save_path, chapter_glossary)
-        self.write_jsonl(save_path, chapter_glossary_pairs)
-        self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
-        self.glossary.extend(chapter_glossary_pairs)
+        return chapter_glossary
 
     def translate_glossary(self, chapter_idx, save_path, chapter_glossary):
         """
@@ -779,16 +2470,20 @@ class TransChat:
             content_key="text",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="glossary_translation",
+            turn_kind="draft",
+            chapter_idx=chapter_idx,
         )
         prev_messages.append({"role": "senior_editor", "content": message})
-        st.chat_message(self.project_roles["senior_editor"]).write(message)
+        self.post_message(self.project_roles["senior_editor"], message)
         prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        self.post_message(self.project_roles["junior_editor"], content)
+        draft = content["text"]
         # print(prev_messages[-1])
 
         message = f"I think the terms in the glossary can be alternatively translated as follows:"
         prev_messages.append({"role": "senior_editor", "content": message})
-        st.chat_message(self.project_roles["senior_editor"]).write(message)
+        self.post_message(self.project_roles["senior_editor"], message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"text\": [{\"source\": string, \"target\": string}, ...]}. Please do not change the key of the JSON object."
         content, response = self.call_api(
             assistant="senior_editor",
@@ -796,46 +2491,57 @@ class TransChat:
             content_key="text",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="glossary_translation",
+            turn_kind="debate",
+            chapter_idx=chapter_idx,
         )
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         print(prev_messages[-1])
 
-        message = f"No, I disagree with you. The terms in the glossary should be translated as follows."
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"text\": [{\"source\": string, \"target\": string}, ...]}. Please do not change the key of the JSON object."
-        content, response = self.call_api(
-            assistant="junior_editor",
-            message=None,
-            content_key="text",
-            additional_system_message=additional_system_message,
-            prev_messages=prev_messages,
-        )
-        prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        if not self.debate_converged("glossary_translation", draft, content["text"], 2, chapter_idx):
+            debate = content["text"]
+            message = f"No, I disagree with you. The terms in the glossary should be translated as follows."
+            prev_messages.append({"role": "junior_editor", "content": message})
+            self.post_message(self.project_roles["junior_editor"], message)
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"text\": [{\"source\": string, \"target\": string}, ...]}. Please do not change the key of the JSON object."
+            content, response = self.call_api(
+                assistant="junior_editor",
+                message=None,
+                content_key="text",
+                additional_system_message=additional_system_message,
+                prev_messages=prev_messages,
+                stage="glossary_translation",
+                turn_kind="debate",
+                chapter_idx=chapter_idx,
+            )
+            prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
+            self.post_message(self.project_roles["junior_editor"], content)
         
-        # print(prev_messages[-1])
-
-        message = f"I believe we've discussed this sufficiently. Please review and finalize the translations of glossary terms in chapter text, making sure to refer to the chapter's content for context. This will help ensure that each term is translated with the highest accuracy and effectiveness."
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"text\": [{\"source\": string, \"target\": string}, ...]}. Please do not change the key of the JSON object."
-        content, response = self.call_api(
-            assistant="senior_editor",
-            message=None,
-            content_key="text",
-            additional_system_message=additional_system_message,
-            prev_messages=prev_messages,
-        )
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+            # print(prev_messages[-1])
+            if not self.debate_converged("glossary_translation", debate, content["text"], 1, chapter_idx):
+                message = f"I believe we've discussed this sufficiently. Please review and finalize the translations of glossary terms in chapter text, making sure to refer to the chapter's content for context. This will help ensure that each term is translated with the highest accuracy and effectiveness."
+                prev_messages.append({"role": "junior_editor", "content": message})
+                self.post_message(self.project_roles["junior_editor"], message)
+                additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"text\": [{\"source\": string, \"target\": string}, ...]}. Please do not change the key of the JSON object."
+                content, response = self.call_api(
+                    assistant="senior_editor",
+                    message=None,
+                    content_key="text",
+                    additional_system_message=additional_system_message,
+                    prev_messages=prev_messages,
+                    stage="glossary_translation",
+                    turn_kind="finalize",
+                    chapter_idx=chapter_idx,
+                )
+                prev_messages.append({"role": "junior_editor", "content": message})
+                self.post_message(self.project_roles["junior_editor"], message)
+                prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
+                self.post_message(self.project_roles["senior_editor"], content)
         chapter_glossary_pairs = content["text"]
         # print(prev_messages[-1])
         
-        self.write_jsonl(save_path.replace(".jsonl", "_trans_conv.jsonl"), prev_messages)
+        self.write_conversation(save_path.replace(".jsonl", "_trans_conv.jsonl"), prev_messages)
         return chapter_glossary_pairs
 
     def summarize_chapters(self):
@@ -845,17 +2551,50 @@ class TransChat:
         print("*********************************************************************")
         print("********************** Summarizing chapters... **********************")
         print("*********************************************************************")
-        summary_dir = os.path.join(self.project_save_dir, "summary")
+        summary_dir = os.path.join(self.source_save_dir, "summary")
         os.makedirs(summary_dir, exist_ok=True)
 
         num_chapters = len(self.book)
-        for i in range(num_chapters):
-            chapter_path = os.path.join(summary_dir, f"chapter_{i}.jsonl")
-            if os.path.exists(chapter_path):
-                print(f"Loading the summary of chapter {i} from {chapter_path}...")
-                self.book[i]["chapter_summary"] = self.read_jsonl(chapter_path)[0]["summary"]
-            else:
-                self.summarize_one_chapter(i, chapter_path)
+        if self.batch_mode and self.leases is None:
+            requests = []
+            for i in range(num_chapters):
+                if self.is_stale(os.path.join(summary_dir, f"chapter_{i}.jsonl"), "summary", i):
+                    message, additional_system_message = self.summary_draft_message(i)
+                    requests.append({
+                        "custom_id": f"summary-draft-chapter_{i}",
+                        "assistant": "junior_editor",
+                        "message": message,
+                        "content_key": "summary",
+                        "additional_system_message": additional_system_message,
+                        "stage": "summary",
+                        "turn_kind": "draft",
+                        "chapter_idx": i,
+                    })
+            self.run_batch("summary_draft", requests)
+
+        def load_one_chapter(i, chapter_path):
+            print(f"Loading the summary of chapter {i} from {chapter_path}...")
+            self.book[i]["chapter_summary"] = self.read_jsonl(chapter_path)[0]["summary"]
+
+        self.run_stage("summary", summary_dir, load_one_chapter, self.summarize_one_chapter, workers=self.preparation_workers)
+
+    def summary_glossary_text(self):
+        """
+        the glossary given to the summaries, only its source terms when the summaries are shared by several target languages
+        """
+        if self.shared_dir is not None:
+            return "\n".join([t for i in sorted(self.source_terms) for t in self.source_terms[i]])
+        return "\n".join([e["source"] + ": " + e["target"] for e in self.glossary])
+
+    def summary_draft_message(self, chapter_idx):
+        """
+        build the first message of the summary of one chapter
+        """
+        chapter_text = self.book[chapter_idx]["chapter_text"]
+        glossary_text = self.summary_glossary_text()
+        message = f"Glossary:\n\n{glossary_text}\n\nChapter Text:\n\n{chapter_text}\n\nPlease summarize the chapter text. Please ensure that the summary is consistent with the glossary."
+        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
+        return message, additional_system_message
 
     def summarize_one_chapter(self, chapter_idx, save_path):
         """
@@ -865,29 +2604,28 @@ class TransChat:
         prev_messages = []
         summary = None
 
-        curr_chapter = self.book[chapter_idx]
-        chapter_title = curr_chapter["chapter_title"]
-        chapter_text = curr_chapter["chapter_text"]
-
-        glossary_text = "\n".join([e["source"] + ": " + e["target"] for e in self.glossary])
-        message = f"Glossary:\n\n{glossary_text}\n\nChapter Text:\n\n{chapter_text}\n\nPlease summarize the chapter text. Please ensure that the summary is consistent with the glossary."
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
+        message, additional_system_message = self.summary_draft_message(chapter_idx)
         content, response = self.call_api(
             assistant="junior_editor",
             message=message,
             content_key="summary",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="summary",
+            turn_kind="draft",
+            chapter_idx=chapter_idx,
+            prefetch_key=f"summary-draft-chapter_{chapter_idx}",
         )
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
+        self.post_message(self.project_roles["junior_editor"], message)
         prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        self.post_message(self.project_roles["junior_editor"], content)
+        draft = content["summary"]
         # print(prev_messages[-1])
 
         message = f"I think the chapter can be better summarized as follows:"
         prev_messages.append({"role": "senior_editor", "content": message})
-        st.chat_message(self.project_roles["senior_editor"]).write(message)
+        self.post_message(self.project_roles["senior_editor"], message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
         content, response = self.call_api(
             assistant="senior_editor",
@@ -895,42 +2633,53 @@ class TransChat:
             content_key="summary",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="summary",
+            turn_kind="debate",
+            chapter_idx=chapter_idx,
         )
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         # print(prev_messages[-1])
 
-        message = f"No, I disagree with you. The chapter should be summarized as follows."
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
-        content, response = self.call_api(
-            assistant="junior_editor",
-            message=None,
-            content_key="summary",
-            additional_system_message=additional_system_message,
-            prev_messages=prev_messages,
-        )
-        prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
-
-        message = f"I believe we've discussed this sufficiently. Please review and finalize the summary of chapter text, making sure to refer to the chapter's content for context. This will help ensure that the summary is accurate and effective."
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
-        content, response = self.call_api(
-            assistant="senior_editor",
-            message=None,
-            content_key="summary",
-            additional_system_message=additional_system_message,
-            prev_messages=prev_messages,
-        )
-        prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        if not self.debate_converged("summary", draft, content["summary"], 2, chapter_idx):
+            debate = content["summary"]
+            message = f"No, I disagree with you. The chapter should be summarized as follows."
+            prev_messages.append({"role": "junior_editor", "content": message})
+            self.post_message(self.project_roles["junior_editor"], message)
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
+            content, response = self.call_api(
+                assistant="junior_editor",
+                message=None,
+                content_key="summary",
+                additional_system_message=additional_system_message,
+                prev_messages=prev_messages,
+                stage="summary",
+                turn_kind="debate",
+                chapter_idx=chapter_idx,
+            )
+            prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
+            self.post_message(self.project_roles["junior_editor"], content)
+            if not self.debate_converged("summary", debate, content["summary"], 1, chapter_idx):
+                message = f"I believe we've discussed this sufficiently. Please review and finalize the summary of chapter text, making sure to refer to the chapter's content for context. This will help ensure that the summary is accurate and effective."
+                prev_messages.append({"role": "junior_editor", "content": message})
+                self.post_message(self.project_roles["junior_editor"], message)
+                additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
+                content, response = self.call_api(
+                    assistant="senior_editor",
+                    message=None,
+                    content_key="summary",
+                    additional_system_message=additional_system_message,
+                    prev_messages=prev_messages,
+                    stage="summary",
+                    turn_kind="finalize",
+                    chapter_idx=chapter_idx,
+                )
+                prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
+                self.post_message(self.project_roles["junior_editor"], content)
 
         self.book[chapter_idx]["chapter_summary"] = content["summary"]
-        self.write_jsonl(save_path, [{"summary": content["summary"]}])
-        self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+        self.write_jsonl(save_path, [{"summary": content["summary"], "input_hash": self.stage_hash("summary", chapter_idx)}])
+        self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
 
     def summarize_book(self):
         """
@@ -942,7 +2691,7 @@ class TransChat:
         prev_messages = []
         summary = None
 
-        summary_dir = os.path.join(self.project_save_dir, "summary")
+        summary_dir = os.path.join(self.source_save_dir, "summary")
         os.makedirs(summary_dir, exist_ok=True)
         summary_path = os.path.join(summary_dir, "book_summary.jsonl")
         if os.path.exists(summary_path):
@@ -950,7 +2699,7 @@ class TransChat:
             self.book_summary = self.read_jsonl(summary_path)[0]["summary"]
             return
 
-        glossary_text = "\n".join([e["source"] + ": " + e["target"] for e in self.glossary])
+        glossary_text = self.summary_glossary_text()
         chapter_summaries = "\n".join([f"Chapter {i} Summary: {self.book[i]['chapter_summary']}" for i in range(len(self.book))])
 
         message = f"Glossary:\n\n{glossary_text}\n\nChapter Summaries:\n\n{chapter_summaries}\n\nPlease summarize the book. Please ensure that the summary is consistent with the glossary and chapter summaries."
@@ -961,15 +2710,18 @@ class TransChat:
             content_key="summary",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="book_summary",
+            turn_kind="draft",
         )
         prev_messages.append({"role": "senior_editor", "content": message})
-        st.chat_message(self.project_roles["senior_editor"]).write(message)
+        self.post_message(self.project_roles["senior_editor"], message)
         prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        self.post_message(self.project_roles["junior_editor"], content)
+        draft = content["summary"]
 
         message = f"I think the book can be better summarized as follows:"
         prev_messages.append({"role": "senior_editor", "content": message})
-        st.chat_message(self.project_roles["senior_editor"]).write(message)
+        self.post_message(self.project_roles["senior_editor"], message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
         content, response = self.call_api(
             assistant="senior_editor",
@@ -977,44 +2729,52 @@ class TransChat:
             content_key="summary",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="book_summary",
+            turn_kind="debate",
         )
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
-        # print(prev_messages[-1])
-
-        message = f"No, I disagree with you. The book should be summarized as follows."
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
-        content, response = self.call_api(
-            assistant="junior_editor",
-            message=None,
-            content_key="summary",
-            additional_system_message=additional_system_message,
-            prev_messages=prev_messages,
-        )
-        prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         # print(prev_messages[-1])
 
-        message = f"I believe we've discussed this sufficiently. Please review and finalize the summary of the book, making sure to refer to the summaries of each chapter. This will help ensure that the summary is accurate and effective."
-        prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
-        content, response = self.call_api(
-            assistant="senior_editor",
-            message=None,
-            content_key="summary",
-            additional_system_message=additional_system_message,
-            prev_messages=prev_messages,
-        )
-        prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        if not self.debate_converged("book_summary", draft, content["summary"], 2, None):
+            debate = content["summary"]
+            message = f"No, I disagree with you. The book should be summarized as follows."
+            prev_messages.append({"role": "junior_editor", "content": message})
+            self.post_message(self.project_roles["junior_editor"], message)
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
+            content, response = self.call_api(
+                assistant="junior_editor",
+                message=None,
+                content_key="summary",
+                additional_system_message=additional_system_message,
+                prev_messages=prev_messages,
+                stage="book_summary",
+                turn_kind="debate",
+            )
+            prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
+            self.post_message(self.project_roles["junior_editor"], content)
+            # print(prev_messages[-1])
+            if not self.debate_converged("book_summary", debate, content["summary"], 1, None):
+                message = f"I believe we've discussed this sufficiently. Please review and finalize the summary of the book, making sure to refer to the summaries of each chapter. This will help ensure that the summary is accurate and effective."
+                prev_messages.append({"role": "junior_editor", "content": message})
+                self.post_message(self.project_roles["junior_editor"], message)
+                additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"summary\": string}. Please do not change the key of the JSON object."
+                content, response = self.call_api(
+                    assistant="senior_editor",
+                    message=None,
+                    content_key="summary",
+                    additional_system_message=additional_system_message,
+                    prev_messages=prev_messages,
+                    stage="book_summary",
+                    turn_kind="finalize",
+                )
+                prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
+                self.post_message(self.project_roles["senior_editor"], content)
         # print(prev_messages[-1])
 
         self.book_summary = content["summary"]
         self.write_jsonl(summary_path, [{"summary": content["summary"]}])
-        self.write_jsonl(summary_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+        self.write_conversation(summary_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
 
     def define_guidelines(self):
         """
@@ -1023,29 +2783,22 @@ class TransChat:
         print("*********************************************************************")
         print("********************** Defining the guidelines... *******************")
         print("*********************************************************************")
-        guidelines_dir = os.path.join(self.project_save_dir, "guidelines")
+        guidelines_dir = os.path.join(self.source_save_dir, "guidelines")
         os.makedirs(guidelines_dir, exist_ok=True)
 
-        tone_path = os.path.join(guidelines_dir, "tone.jsonl")
-        if os.path.exists(tone_path):
-            print(f"Loading the tone from {tone_path}...")
-            self.tone = self.read_jsonl(tone_path)[0]["tone"]
-        else:
-            self.define_tone(tone_path)
+        # the tone, style and target audience only depend on the book summary and the first chapter
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            list(pool.map(lambda name: self.define_guideline(name, os.path.join(guidelines_dir, f"{name}.jsonl")), ["tone", "style", "target_audience"]))
 
-        style_path = os.path.join(guidelines_dir, "style.jsonl")
-        if os.path.exists(style_path):
-            print(f"Loading the style from {style_path}...")
-            self.style = self.read_jsonl(style_path)[0]["style"]
-        else:
-            self.define_style(style_path)
-
-        target_audience_path = os.path.join(guidelines_dir, "target_audience.jsonl")
-        if os.path.exists(target_audience_path):
-            print(f"Loading the target audience from {target_audience_path}...")
-            self.target_audience = self.read_jsonl(target_audience_path)[0]["target_audience"]
+    def define_guideline(self, name, save_path):
+        """
+        load one of the guidelines, the tone, style or target audience, or define it
+        """
+        if os.path.exists(save_path):
+            print(f"Loading the {name.replace('_', ' ')} from {save_path}...")
+            setattr(self, name, self.read_jsonl(save_path)[0][name])
         else:
-            self.define_target_audience(target_audience_path)
+            {"tone": self.define_tone, "style": self.define_style, "target_audience": self.define_target_audience}[name](save_path)
 
     def define_tone(self, save_path):
         """
@@ -1065,14 +2818,16 @@ class TransChat:
             content_key="text",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="guidelines",
+            turn_kind="finalize",
         )
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         # print(prev_messages[-1])
 
         self.tone = content["text"]
         self.write_jsonl(save_path, [{"tone": content["text"]}])
-        self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+        self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
     
     def define_style(self, save_path):
         """
@@ -1091,14 +2846,16 @@ class TransChat:
             content_key="text",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="guidelines",
+            turn_kind="finalize",
         )
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         # print(prev_messages[-1])
 
         self.style = content["text"]
         self.write_jsonl(save_path, [{"style": content["text"]}])
-        self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+        self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
 
     def define_target_audience(self, save_path):
         """
@@ -1117,14 +2874,16 @@ class TransChat:
             content_key="text",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="guidelines",
+            turn_kind="finalize",
         )
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         # print(prev_messages[-1])
 
         self.target_audience = content["text"]
         self.write_jsonl(save_path, [{"target_audience": content["text"]}])
-        self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+        self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
 
     def finalize_preparation(self):
         """
@@ -1153,47 +2912,289 @@ class TransChat:
         os.makedirs(translation_dir, exist_ok=True)
 
         num_chapters = len(self.book)
-        for i in range(num_chapters):
-            chapter_path = os.path.join(translation_dir, f"chapter_{i}.jsonl")
-            if os.path.exists(chapter_path):
-                print(f"Loading the translation of chapter {i} from {chapter_path}...")
-                self.book[i]["chapter_translation_init"] = self.read_jsonl(chapter_path)[0]["chapter_translation_init"]
-                self.book[i]["chapter_translation_init_length"] = self.read_jsonl(chapter_path)[0]["chapter_translation_init_length"]
-            else:
-                self.translate_one_chapter(i, chapter_path)
+        if self.batch_mode and self.leases is None:
+            requests = []
+            for i in range(num_chapters):
+                if self.is_stale(os.path.join(translation_dir, f"chapter_{i}.jsonl"), "translation", i):
+                    message, additional_system_message = self.translation_draft_message(i)
+                    requests.append({
+                        "custom_id": f"translation-draft-chapter_{i}",
+                        "assistant": "translator",
+                        "message": message,
+                        "content_key": "translation",
+                        "additional_system_message": additional_system_message,
+                        "stage": "translation",
+                        "turn_kind": "draft",
+                        "chapter_idx": i,
+                    })
+            self.run_batch("translation_draft", requests)
+
+        elif self.pack_short_chapters and self.leases is None:
+            pending = []
+            for i in range(num_chapters):
+                chapter_path = os.path.join(translation_dir, f"chapter_{i}.jsonl")
+                if self.is_stale(chapter_path, "translation", i) and not self.prefill_from_translation_memory(i, chapter_path):
+                    pending.append(i)
+            for group in self.pack_chapters(pending):
+                if len(group) > 1:
+                    try:
+                        with self.profile_unit("translation"):
+                            self.translate_packed_chapters(group, translation_dir)
+                        with self.stats_lock:
+                            self.speculation_stats["packed_chapters"] += len(group)
+                    except (InvalidResponse, BudgetExceeded) as e:
+                        # within the budget, each chapter then degrades on its own, see process_chapter
+                        print(e)
+                        print(f"Failed to translate chapters {group} in one packed prompt, they will be translated one by one...")
+                        self.packing_fallbacks.append({"chapters": group, "error": str(e)})
+
+        def load_one_chapter(i, chapter_path):
+            print(f"Loading the translation of chapter {i} from {chapter_path}...")
+            self.book[i]["chapter_translation_init"] = self.read_jsonl(chapter_path)[0]["chapter_translation_init"]
+            self.book[i]["chapter_translation_init_length"] = self.read_jsonl(chapter_path)[0]["chapter_translation_init_length"]
+
+        # the chapters left stale by the packed prompts are translated one by one
+        self.run_stage("translation", translation_dir, load_one_chapter, self.translate_one_chapter)
+
+    def pack_chapters(self, chapter_indices):
+        """
+        group consecutive short chapters, up to the token budget of one packed prompt
+        """
+        groups = []
+        group = []
+        group_tokens = 0
+        for i in chapter_indices:
+            tokens = estimate_tokens(self.book[i]["chapter_text"])
+            if len(group) > 0 and (tokens > self.short_chapter_tokens or group[-1] != i - 1 or group_tokens + tokens > self.pack_token_budget):
+                groups.append(group)
+                group = []
+                group_tokens = 0
+            if tokens > self.short_chapter_tokens:
+                groups.append([i])
+                continue
+            group.append(i)
+            group_tokens += tokens
+        if len(group) > 0:
+            groups.append(group)
+        return groups
+
+    def packed_items(self, items, value_key):
+        """
+        map the per-chapter items of a packed response to their chapters
+        """
+        values = {}
+        for item in items:
+            if not isinstance(item, dict) or value_key not in item:
+                continue
+            try:
+                values[int(item["chapter_idx"])] = item[value_key]
+            except (KeyError, TypeError, ValueError):
+                continue
+        return values
+
+    def translate_packed_chapters(self, chapter_indices, translation_dir):
+        """
+        translate several short chapters in one conversation, the accepted chapters are written to their own checkpoints
+        """
+        print(f"Translating chapters {chapter_indices} in one packed prompt...")
+        prev_messages = []
+        expected = set(chapter_indices)
+
+        chapters_text = ""
+        memory_text = ""
+        for i in chapter_indices:
+            chapters_text += f"Chapter {i} Text:\n\n{self.book[i]['chapter_text']}\n\n"
+            memory_text += "".join([f"{m['source']} => {m['target']}\n" for m in self.lookup_translation_memory(i)])
+        if memory_text != "":
+            memory_text = f"Translation Memory:\n\n{memory_text}\nThe translation memory lists previously approved translations of identical or similar paragraphs. Reuse them where they fit.\n\n"
+        message = f"{chapters_text}{memory_text}Translate each of the chapter texts above from {self.src_lang} into {self.tgt_lang}, keeping the chapters apart. Ensure that your translation closely adheres to the provided translation guidelines, including the glossary, book summary, tone, style, and target audience, for consistency and accuracy. Remember to maintain the original meaning and tone as much as possible while making the translation understandable in {self.tgt_lang}."
+        additional_system_message = "Your response should always be in JSON format as follows: {\"translations\": [{\"chapter_idx\": int, \"translation\": string}]}. Include every chapter exactly once, identified by its chapter index. Please do not change the key of the JSON object."
+        content, response = self.call_api(
+            assistant="translator",
+            message=message,
+            content_key="translations",
+            additional_system_message=additional_system_message,
+            prev_messages=prev_messages,
+            stage="translation",
+            turn_kind="draft",
+            validator=lambda c: set([k for k, v in self.packed_items(c["translations"], "translation").items() if isinstance(v, str)]) == expected,
+        )
+        # a chapter missing from the response is left stale and translated on its own
+        translations = {i: t for i, t in self.packed_items(content["translations"], "translation").items() if i in expected and isinstance(t, str)}
+        chapter_indices = [i for i in chapter_indices if i in translations]
+        if len(chapter_indices) == 0:
+            return
+
+        prev_messages.append({"role": "junior_editor", "content": message})
+        self.post_message(self.project_roles["junior_editor"], message)
+        prev_messages.append({"role": "translator", "content": json.dumps(content, ensure_ascii=False)})
+        self.post_message(self.project_roles["translator"], content)
+
+        message = "Plese review the translation of each chapter text, in terms of the glossary, book summary, tone, style, and target audience, and provide your suggestions for improvement."
+        prev_messages.append({"role": "translator", "content": message})
+        self.post_message(self.project_roles["translator"], message)
+        additional_system_message = "Your response should always be in JSON format as follows: {\"suggestions\": string}. Please do not change the key of the JSON object."
+        content, response = self.call_api(
+            assistant="junior_editor",
+            message=None,
+            content_key="suggestions",
+            additional_system_message=additional_system_message,
+            prev_messages=prev_messages,
+            stage="translation",
+            turn_kind="suggestion",
+        )
+        prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
+        self.post_message(self.project_roles["junior_editor"], content)
+
+        message = "Please adjust the translations of the chapter texts if you think the translations can be improved."
+        prev_messages.append({"role": "junior_editor", "content": message})
+        self.post_message(self.project_roles["junior_editor"], message)
+        additional_system_message = "Your response should always be in JSON format as follows: {\"adjusted\": bool, \"translations\": [{\"chapter_idx\": int, \"translation\": string}]}. Include every chapter exactly once, identified by its chapter index. Please do not change the key of the JSON object."
+        content, response = self.call_api(
+            assistant="translator",
+            message=None,
+            content_key="translations",
+            additional_system_message=additional_system_message,
+            prev_messages=prev_messages,
+            stage="translation",
+            turn_kind="revise",
+        )
+        prev_messages.append({"role": "translator", "content": json.dumps(content, ensure_ascii=False)})
+        self.post_message(self.project_roles["translator"], content)
+
+        adjusted = self.packed_items(content["translations"], "translation") if content["adjusted"] else {}
+        for i in chapter_indices:
+            translation_length = len(translations[i].split())
+            # a shortened adjustment has likely dropped content, keep the draft instead
+            if isinstance(adjusted.get(i), str) and len(adjusted[i].split()) >= 0.9 * translation_length:
+                translations[i] = adjusted[i]
+
+        message = ""
+        for i in chapter_indices:
+            message += f"Chapter {i} Text:\n\n{self.book[i]['chapter_text']}\n\nChapter {i} Translation:\n\n{translations[i]}\n\n"
+        message += "Considerring the translation guidelines, including the glossary, book summary, tone, style, and target audience, please carefully evaluate the translation of each chapter separately and provide a detailed justification. Ensure that each translation aligns with its original chapter text closely."
+        prev_messages.append({"role": "junior_editor", "content": message})
+        self.post_message(self.project_roles["junior_editor"], message)
+        additional_system_message = "Your response should always be in JSON format as follows: {\"evaluations\": [{\"chapter_idx\": int, \"justification\": string, \"finalize\": bool}]}. The value of \"finalize\" should be set to true if the translation of the chapter is of high quality and does not require any further editing. Include every chapter exactly once, identified by its chapter index. Please do not change the key of the JSON object."
+        content, response = self.call_api(
+            assistant="senior_editor",
+            message=message,
+            content_key="evaluations",
+            additional_system_message=additional_system_message,
+            prev_messages=[],
+            stage="translation",
+            turn_kind="evaluate",
+            validator=lambda c: set(self.packed_items(c["evaluations"], "finalize").keys()) == expected,
+        )
+        prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
+        self.post_message(self.project_roles["senior_editor"], content)
+
+        finalized = self.packed_items(content["evaluations"], "finalize")
+        for i in chapter_indices:
+            if str(finalized.get(i)).strip().lower() != "true":
+                print(f"The packed translation of chapter {i} is rejected, it will be translated on its own...")
+                continue
+            translation_length = len(translations[i].split())
+            self.book[i]["chapter_translation_init"] = translations[i]
+            self.book[i]["chapter_translation_init_length"] = translation_length
+            save_path = os.path.join(translation_dir, f"chapter_{i}.jsonl")
+            self.write_jsonl(save_path, [{"chapter_translation_init": translations[i], "chapter_translation_init_length": translation_length, "remark": "packed", "input_hash": self.stage_hash("translation", i)}])
+            self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+
+    def lookup_translation_memory(self, chapter_idx):
+        """
+        look up the paragraphs of one chapter in the translation memory
+        """
+        if self.translation_memory is None:
+            return []
+        matches = []
+        for paragraph in self.book[chapter_idx]["chapter_text"].split("\n"):
+            if paragraph.strip() == "":
+                continue
+            match = self.translation_memory.lookup(paragraph)
+            if match is not None:
+                kind, segment, score = match
+                matches.append({"kind": kind, "source": segment["source"], "target": segment["target"], "score": score})
+        return matches
+
+    def prefill_from_translation_memory(self, chapter_idx, save_path):
+        """
+        reuse the translation memory when every paragraph of one chapter has an exact match
+        """
+        paragraphs = [p for p in self.book[chapter_idx]["chapter_text"].split("\n") if p.strip() != ""]
+        matches = self.lookup_translation_memory(chapter_idx)
+        if len(paragraphs) == 0 or len(matches) != len(paragraphs) or any([m["kind"] != "exact" for m in matches]):
+            return False
+        print(f"Reusing the translation memory for chapter {chapter_idx}...")
+        translation = "\n".join([m["target"] for m in matches])
+        translation_length = len(translation.split())
+        self.book[chapter_idx]["chapter_translation_init"] = translation
+        self.book[chapter_idx]["chapter_translation_init_length"] = translation_length
+        self.write_jsonl(save_path, [{"chapter_translation_init": translation, "chapter_translation_init_length": translation_length, "remark": "translation memory", "input_hash": self.stage_hash("translation", chapter_idx)}])
+        return True
+
+    def update_translation_memory(self):
+        """
+        add the finalized chapters to the translation memory
+        """
+        if self.translation_memory is None:
+            return
+        num_added = 0
+        for chapter in self.book:
+            if "chapter_finalization" in chapter:
+                num_added += self.translation_memory.add(chapter["chapter_text"], chapter["chapter_finalization"])
+        print(f"Added {num_added} segments to the translation memory.")
+
+    def translation_draft_message(self, chapter_idx):
+        """
+        build the first message of the translation of one chapter
+        """
+        chapter_text = self.book[chapter_idx]["chapter_text"]
+        memory_text = ""
+        matches = self.lookup_translation_memory(chapter_idx)
+        if len(matches) > 0:
+            memory_text = "\n".join([f"{m['source']} => {m['target']}" for m in matches])
+            memory_text = f"Translation Memory:\n\n{memory_text}\n\nThe translation memory lists previously approved translations of identical or similar paragraphs. Reuse them where they fit.\n\n"
+        message = f"Chapter Text:\n\n{chapter_text}\n\n{memory_text}Translate the chapter text from {self.src_lang} into {self.tgt_lang}. Ensure that your translation closely adheres to the provided translation guidelines, including the glossary, book summary, tone, style, and target audience, for consistency and accuracy. Remember to maintain the original meaning and tone as much as possible while making the translation understandable in {self.tgt_lang}."
+        additional_system_message = "Your response should always be in JSON format as follows: {\"translation\": string}. Please do not change the key of the JSON object."
+        return message, additional_system_message
 
     def translate_one_chapter(self, chapter_idx, save_path):
         """
         translate one chapter
         """
         print(f"Translating chapter {chapter_idx}...")
+        if self.prefill_from_translation_memory(chapter_idx, save_path):
+            return None
         prev_messages = []
 
         curr_chapter = self.book[chapter_idx]
         chapter_title = curr_chapter["chapter_title"]
         chapter_text = curr_chapter["chapter_text"]
 
-        translation_guidelines = self.translation_guidelines
-        message = f"Translation Guidelines:\n\n{translation_guidelines}\n\nChapter Text:\n\n{chapter_text}\n\nTranslate the chapter text from {self.src_lang} into {self.tgt_lang}. Ensure that your translation closely adheres to the provided translation guidelines, including the glossary, book summary, tone, style, and target audience, for consistency and accuracy. Remember to maintain the original meaning and tone as much as possible while making the translation understandable in {self.tgt_lang}."
-        additional_system_message = "Your response should always be in JSON format as follows: {\"translation\": string}. Please do not change the key of the JSON object."
+        message, additional_system_message = self.translation_draft_message(chapter_idx)
         content, response = self.call_api(
             assistant="translator",
             message=message,
             content_key="translation",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="translation",
+            turn_kind="draft",
+            chapter_idx=chapter_idx,
+            prefetch_key=f"translation-draft-chapter_{chapter_idx}",
         )
         translation = content["translation"]
         translation_length = len(translation.split())
 
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
+        self.post_message(self.project_roles["junior_editor"], message)
         prev_messages.append({"role": "translator", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["translator"]).write(content)
+        self.post_message(self.project_roles["translator"], content)
 
         message = f"Plese review the translation of chapter text, in terms of the glossary, book summary, tone, style, and target audience, and provide your suggestions for improvement."
         prev_messages.append({"role": "translator", "content": message})
-        st.chat_message(self.project_roles["translator"]).write(message)
+        self.post_message(self.project_roles["translator"], message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"suggestions\": string}. Please do not change the key of the JSON object."
         content, response = self.call_api(
             assistant="junior_editor",
@@ -1201,9 +3202,12 @@ class TransChat:
             content_key="suggestions",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="translation",
+            turn_kind="suggestion",
+            chapter_idx=chapter_idx,
         )
         prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        self.post_message(self.project_roles["junior_editor"], content)
 
         # print(prev_messages[-1])
 
@@ -1211,7 +3215,7 @@ class TransChat:
 
         message = f"Please adjust the translation of chapter text if you think the translation can be improved."
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
+        self.post_message(self.project_roles["junior_editor"], message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"adjusted\": bool, \"translation\": string}. Please do not change the key of the JSON object."
         content, response = self.call_api(
             assistant="translator",
@@ -1219,6 +3223,9 @@ class TransChat:
             content_key="translation",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="translation",
+            turn_kind="revise",
+            chapter_idx=chapter_idx,
         )
         # print(content)
         # raise Exception("Stop here.")
@@ -1238,16 +3245,24 @@ class TransChat:
 
 
         prev_messages.append({"role": "translator", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["translator"]).write(content)
+        self.post_message(self.project_roles["translator"], content)
         # print(prev_messages[-1])
 
-        content, lst = self.evaluate_translation(chapter_text, adjusted_translation)
+        if self.speculative:
+            speculation = self.executor.submit(self.speculate_localization, chapter_idx, adjusted_translation)
+        content, lst = self.evaluate_translation(chapter_text, adjusted_translation, stage="translation", chapter_idx=chapter_idx)
         prev_messages.extend(lst)
-        if content["finalize"]:
+        if self.speculative:
+            self.resolve_speculation(chapter_idx, speculation, content["finalize"])
+        repaired_translation, content = self.repair_translation(chapter_idx, "translation", adjusted_translation, content, prev_messages)
+        if repaired_translation != adjusted_translation:
+            adjusted_translation = repaired_translation
+            adjusted_translation_length = len(adjusted_translation.split())
+        if content["finalize"] or self.accept_near_budget("translation", chapter_idx):
             self.book[chapter_idx]["chapter_translation_init"] = adjusted_translation
             self.book[chapter_idx]["chapter_translation_init_length"] = adjusted_translation_length
-            self.write_jsonl(save_path, [{"chapter_translation_init": adjusted_translation, "chapter_translation_init_length": adjusted_translation_length}])
-            self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+            self.write_jsonl(save_path, [{"chapter_translation_init": adjusted_translation, "chapter_translation_init_length": adjusted_translation_length, "input_hash": self.stage_hash("translation", chapter_idx)}])
+            self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
         else:
             self.translate_one_chapter(chapter_idx, save_path)
             return None
@@ -1256,7 +3271,14 @@ class TransChat:
         self.localize()
         self.proofread()
         self.finalize()
-        self.write_down_the_book()
+        # with several workers, the first one to get here writes the book
+        if self.leases is None or self.leases.acquire("write_down"):
+            with self.profile_unit("write_down"):
+                self.update_translation_memory()
+                self.write_down_the_book()
+            if self.leases is not None:
+                self.leases.release("write_down")
+        self.write_telemetry_summary()
         
     def localize(self):
         """
@@ -1268,31 +3290,116 @@ class TransChat:
         localization_dir = os.path.join(self.project_save_dir, "localization")
         os.makedirs(localization_dir, exist_ok=True)
 
-        num_chapters = len(self.book)
-        for i in range(num_chapters):
-            chapter_path = os.path.join(localization_dir, f"chapter_{i}.jsonl")
-            if os.path.exists(chapter_path):
-                print(f"Loading the localization of chapter {i} from {chapter_path}...")
-                self.book[i]["chapter_localization"] = self.read_jsonl(chapter_path)[0]["chapter_localization"]
-                self.book[i]["chapter_localization_length"] = self.read_jsonl(chapter_path)[0]["chapter_localization_length"]
-            else:
-                self.localize_one_chapter(i, chapter_path)
+        def load_one_chapter(i, chapter_path):
+            print(f"Loading the localization of chapter {i} from {chapter_path}...")
+            self.book[i]["chapter_localization"] = self.read_jsonl(chapter_path)[0]["chapter_localization"]
+            self.book[i]["chapter_localization_length"] = self.read_jsonl(chapter_path)[0]["chapter_localization_length"]
+
+        self.run_stage("localization", localization_dir, load_one_chapter, self.localize_one_chapter)
         
+    def localization_draft_message(self, chapter_idx, chapter_translation_init):
+        """
+        build the first message of the localization of one chapter
+        """
+        chapter_text = self.book[chapter_idx]["chapter_text"]
+        message = f"Chapter Text:\n\n{chapter_text}\n\nChapter Translation:\n\n{chapter_translation_init}\n\nGuided by our translation guidelines, including glossary, book summary, tone, style, and target audience, localize the chapter translation for {self.tgt_lang} context. You MUST maintain all the details and the orginal writing style of the chapter text."
+        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"localization\": string}. Please do not change the key of the JSON object. The \"localization\" key should be set to the localized chapter translation."
+        return message, additional_system_message
+
+    def speculate_localization(self, chapter_idx, chapter_translation):
+        """
+        localize a translation before its evaluation is known
+        """
+        message, additional_system_message = self.localization_draft_message(chapter_idx, chapter_translation)
+        return self.call_api(
+            assistant="localization_specialist",
+            message=message,
+            content_key="localization",
+            additional_system_message=additional_system_message,
+            prev_messages=[],
+            stage="localization",
+            turn_kind="draft",
+            chapter_idx=chapter_idx,
+        )
+
+    def resolve_speculation(self, chapter_idx, speculation, finalize):
+        """
+        commit the speculative localization if the translation is finalized, discard it otherwise
+        """
+        if finalize:
+            try:
+                prefetch_key = f"localization-draft-chapter_{chapter_idx}"
+                self.prefetched[prefetch_key] = speculation.result()
+                with self.stats_lock:
+                    self.speculated.add(prefetch_key)
+            except Exception as e:
+                print(e)
+                with self.stats_lock:
+                    self.speculation_stats["failed"] += 1
+            return
+
+        if speculation.cancel():
+            with self.stats_lock:
+                self.speculation_stats["cancelled"] += 1
+            return
+
+        def discard(speculation):
+            # runs in the thread of the speculation
+            self.count_speculation_miss(speculation.result()[1] if speculation.exception() is None else None)
+
+        speculation.add_done_callback(discard)
+
+    def count_speculation(self, prefetch_key, response, hit):
+        """
+        count a committed speculation once call_api consumes it, a hit, or rejects it or leaves it unconsumed, a miss
+        """
+        with self.stats_lock:
+            if prefetch_key not in self.speculated:
+                return
+            self.speculated.discard(prefetch_key)
+            if hit:
+                self.speculation_stats["hits"] += 1
+                return
+        self.count_speculation_miss(response)
+
+    def count_speculation_miss(self, response):
+        """
+        count a speculative localization that is not used, with the usage of its response if any
+        """
+        wasted_tokens, wasted_cost = 0, 0
+        usage = response.get("usage") if response is not None else None
+        if usage is not None:
+            wasted_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+            wasted_cost = self.compute_call_cost("localization_specialist", response["model"], usage)
+        with self.stats_lock:
+            self.speculation_stats["misses"] += 1
+            self.speculation_stats["wasted_tokens"] += wasted_tokens
+            self.speculation_stats["wasted_cost"] += wasted_cost
+
+    def drop_prefetched(self, prefetch_key):
+        """
+        drop a prefetched response left unconsumed once the checkpoint of its chapter is written or loaded
+        """
+        prefetched = self.prefetched.pop(prefetch_key, None)
+        if prefetched is not None:
+            self.count_speculation(prefetch_key, prefetched[1], hit=False)
+
     def localize_one_chapter(self, chapter_idx, save_path):
         """
         localize one chapter
         """
         print(f"Localizing chapter {chapter_idx}...")
-        print(self.curr_rerun, self.max_rerun)
-        if self.curr_rerun == self.max_rerun:
+        print(self.curr_rerun.get(chapter_idx, 0), self.max_rerun)
+        if self.curr_rerun.get(chapter_idx, 0) == self.max_rerun:
             
             adjusted_localization = self.book[chapter_idx]["chapter_translation_init"]
             adjusted_localization_length = self.book[chapter_idx]["chapter_translation_init_length"]
 
             self.book[chapter_idx]["chapter_localization"] = adjusted_localization
             self.book[chapter_idx]["chapter_localization_length"] = adjusted_localization_length
-            self.write_jsonl(save_path, [{"chapter_localization": adjusted_localization, "chapter_localization_length": adjusted_localization_length, "remark": "reach max rerun"}])
-            self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), [{"chapter_localization": adjusted_localization, "chapter_localization_length": adjusted_localization_length, "remark": "reach max rerun"}])
+            self.write_jsonl(save_path, [{"chapter_localization": adjusted_localization, "chapter_localization_length": adjusted_localization_length, "remark": "reach max rerun", "input_hash": self.stage_hash("localization", chapter_idx)}])
+            self.curr_rerun.pop(chapter_idx, None)
+            self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), [{"chapter_localization": adjusted_localization, "chapter_localization_length": adjusted_localization_length, "remark": "reach max rerun"}])
             return None
 
         prev_messages = []
@@ -1303,15 +3410,17 @@ class TransChat:
         chapter_translation_init = curr_chapter["chapter_translation_init"]
         chapter_translation_init_length = curr_chapter["chapter_translation_init_length"]
 
-        translation_guidelines = self.translation_guidelines
-        message = f"Translation Guidelines:\n\n{translation_guidelines}\n\nChapter Text:\n\n{chapter_text}\n\nChapter Translation:\n\n{chapter_translation_init}\n\nGuided by our translation guidelines, including glossary, book summary, tone, style, and target audience, localize the chapter translation for {self.tgt_lang} context. You MUST maintain all the details and the orginal writing style of the chapter text."
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"localization\": string}. Please do not change the key of the JSON object. The \"localization\" key should be set to the localized chapter translation."
+        message, additional_system_message = self.localization_draft_message(chapter_idx, chapter_translation_init)
         local_content, response = self.call_api(
             assistant="localization_specialist",
             message=message,
             content_key="localization",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="localization",
+            turn_kind="draft",
+            chapter_idx=chapter_idx,
+            prefetch_key=f"localization-draft-chapter_{chapter_idx}",
         )
         # print(local_content)
 
@@ -1321,19 +3430,19 @@ class TransChat:
         ratio = localization_length / chapter_translation_init_length
         print(localization_length, chapter_translation_init_length, ratio)
         if ratio < 0.9:
-            self.curr_rerun += 1
+            self.curr_rerun[chapter_idx] = self.curr_rerun.get(chapter_idx, 0) + 1
             self.localize_one_chapter(chapter_idx, save_path)
             return None
 
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
+        self.post_message(self.project_roles["junior_editor"], message)
         prev_messages.append({"role": "localization_specialist", "content": json.dumps(local_content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["localization_specialist"]).write(local_content)
+        self.post_message(self.project_roles["localization_specialist"], local_content)
         # print(prev_messages[-1])
 
         message = f"Plese review the localized translation of chapter text, in terms of the glossary, book summary, tone, style, and target audience, and provide your suggestions for improvement. Please ensure that the localized translation is culturally adapted to the context of {self.tgt_lang}. Please also ensure that the localized translation is closely consistent with the original chapter text."
         prev_messages.append({"role": "localization_specialist", "content": message})
-        st.chat_message(self.project_roles["localization_specialist"]).write(message)
+        self.post_message(self.project_roles["localization_specialist"], message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"suggestions\": string}. Please do not change the key of the JSON object."
         content, response = self.call_api(
             assistant="junior_editor",
@@ -1341,13 +3450,16 @@ class TransChat:
             content_key="suggestions",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="localization",
+            turn_kind="suggestion",
+            chapter_idx=chapter_idx,
         )
         prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        self.post_message(self.project_roles["junior_editor"], content)
 
         message = f"Please adjust the localized translation of chapter text accordingly if you think the translation can be improved."
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
+        self.post_message(self.project_roles["junior_editor"], message)
 
 
         additional_system_message = "Your response should always be in JSON format as follows: {\"adjusted\": bool, \"localization\": string}. Please do not change the key of the JSON object. The value of \"adjusted\" should be set to false if the translation needs no adjustments. The \"localization\" key should be set to the adjusted localized chapter translation."
@@ -1357,6 +3469,9 @@ class TransChat:
             content_key="localization",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="localization",
+            turn_kind="revise",
+            chapter_idx=chapter_idx,
         )
         # print(content)
 
@@ -1367,7 +3482,7 @@ class TransChat:
             ratio = adjusted_localization_length / chapter_translation_init_length
             print(adjusted_localization_length, chapter_translation_init_length, ratio)
             if ratio < 0.9:
-                self.curr_rerun += 1
+                self.curr_rerun[chapter_idx] = self.curr_rerun.get(chapter_idx, 0) + 1
                 self.localize_one_chapter(chapter_idx, save_path)
                 return None
 
@@ -1376,25 +3491,30 @@ class TransChat:
             adjusted_localization_length = localization_length
         
         prev_messages.append({"role": "localization_specialist", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["localization_specialist"]).write(content)
+        self.post_message(self.project_roles["localization_specialist"], content)
         # print(prev_messages[-1])
 
 
-        content, lst = self.evaluate_translation(chapter_text, adjusted_localization)
+        content, lst = self.evaluate_translation(chapter_text, adjusted_localization, stage="localization", chapter_idx=chapter_idx)
         prev_messages.extend(lst)
-        if content["finalize"]:
+        repaired_localization, content = self.repair_translation(chapter_idx, "localization", adjusted_localization, content, prev_messages)
+        if repaired_localization != adjusted_localization:
+            adjusted_localization = repaired_localization
+            adjusted_localization_length = len(adjusted_localization.split())
+        if content["finalize"] or self.accept_near_budget("localization", chapter_idx):
             self.book[chapter_idx]["chapter_localization"] = adjusted_localization
             self.book[chapter_idx]["chapter_localization_length"] = adjusted_localization_length
-            self.write_jsonl(save_path, [{"chapter_localization": adjusted_localization, "chapter_localization_length": adjusted_localization_length}])
-            self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+            self.write_jsonl(save_path, [{"chapter_localization": adjusted_localization, "chapter_localization_length": adjusted_localization_length, "input_hash": self.stage_hash("localization", chapter_idx)}])
+            self.curr_rerun.pop(chapter_idx, None)
+            self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
             return None
         else:
-            self.curr_rerun += 1
+            self.curr_rerun[chapter_idx] = self.curr_rerun.get(chapter_idx, 0) + 1
             self.localize_one_chapter(chapter_idx, save_path)
             return None
 
 
-        self.curr_rerun = 0
+        self.curr_rerun.pop(chapter_idx, None)
         return None
 
     def proofread(self):
@@ -1407,29 +3527,27 @@ class TransChat:
         proofreading_dir = os.path.join(self.project_save_dir, "proofreading")
         os.makedirs(proofreading_dir, exist_ok=True)
 
-        num_chapters = len(self.book)
-        for i in range(num_chapters):
-            chapter_path = os.path.join(proofreading_dir, f"chapter_{i}.jsonl")
-            if os.path.exists(chapter_path):
-                print(f"Loading the proofreading of chapter {i} from {chapter_path}...")
-                self.book[i]["chapter_proofreading"] = self.read_jsonl(chapter_path)[0]["chapter_proofreading"]
-            else:
-                self.proofread_one_chapter(i, chapter_path)
+        def load_one_chapter(i, chapter_path):
+            print(f"Loading the proofreading of chapter {i} from {chapter_path}...")
+            self.book[i]["chapter_proofreading"] = self.read_jsonl(chapter_path)[0]["chapter_proofreading"]
+
+        self.run_stage("proofreading", proofreading_dir, load_one_chapter, self.proofread_one_chapter)
     
     def proofread_one_chapter(self, chapter_idx, save_path):
         """
         proofread one chapter
         """
         print(f"Proofreading chapter {chapter_idx}...")
-        print(self.curr_rerun, self.max_rerun)
-        if self.curr_rerun == self.max_rerun:
+        print(self.curr_rerun.get(chapter_idx, 0), self.max_rerun)
+        if self.curr_rerun.get(chapter_idx, 0) == self.max_rerun:
             adjusted_proofreading = self.book[chapter_idx]["chapter_localization"]
             adjusted_proofreading_length = self.book[chapter_idx]["chapter_localization_length"]
 
             self.book[chapter_idx]["chapter_proofreading"] = adjusted_proofreading
             self.book[chapter_idx]["chapter_proofreading_length"] = adjusted_proofreading_length
-            self.write_jsonl(save_path, [{"chapter_proofreading": adjusted_proofreading, "chapter_proofreading_length": adjusted_proofreading_length, "remark": "reach max rerun"}])
-            self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), [{"chapter_proofreading": adjusted_proofreading, "chapter_proofreading_length": adjusted_proofreading_length, "remark": "reach max rerun"}])
+            self.write_jsonl(save_path, [{"chapter_proofreading": adjusted_proofreading, "chapter_proofreading_length": adjusted_proofreading_length, "remark": "reach max rerun", "input_hash": self.stage_hash("proofreading", chapter_idx)}])
+            self.curr_rerun.pop(chapter_idx, None)
+            self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), [{"chapter_proofreading": adjusted_proofreading, "chapter_proofreading_length": adjusted_proofreading_length, "remark": "reach max rerun"}])
             return None
 
         prev_messages = []
@@ -1441,8 +3559,7 @@ class TransChat:
         chapter_localization = curr_chapter["chapter_localization"]
         chapter_localization_length = curr_chapter["chapter_localization_length"]
 
-        translation_guidelines = self.translation_guidelines
-        message = f"Translation Guidelines:\n\n{translation_guidelines}\n\nChapter Text:\n\n{chapter_text}\n\nChapter Translation:\n\n{chapter_localization}\n\nGuided by our translation guidelines, including the glossary, book summary, tone, style, and target audience, proofread the chapter translation."
+        message = f"Chapter Text:\n\n{chapter_text}\n\nChapter Translation:\n\n{chapter_localization}\n\nGuided by our translation guidelines, including the glossary, book summary, tone, style, and target audience, proofread the chapter translation."
         additional_system_message = "Your response should always be in JSON format as follows: {\"proofreading\": string}. Please do not change the key of the JSON object. The \"proofreading\" key should be set to the proofread chapter translation."
         proof_content, response = self.call_api(
             assistant="proofreader",
@@ -1450,6 +3567,9 @@ class TransChat:
             content_key="proofreading",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="proofreading",
+            turn_kind="draft",
+            chapter_idx=chapter_idx,
         )
 
         proofreading = proof_content["proofreading"]
@@ -1458,18 +3578,18 @@ class TransChat:
         ratio = proofreading_length / chapter_localization_length
         print(proofreading_length, chapter_localization_length, ratio)
         if ratio < 0.9:
-            self.curr_rerun += 1
+            self.curr_rerun[chapter_idx] = self.curr_rerun.get(chapter_idx, 0) + 1
             self.proofread_one_chapter(chapter_idx, save_path)
             return None
 
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
+        self.post_message(self.project_roles["junior_editor"], message)
         prev_messages.append({"role": "proofreader", "content": json.dumps(proof_content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["proofreader"]).write(proof_content)
+        self.post_message(self.project_roles["proofreader"], proof_content)
 
         message = f"Plese review the proofread translation of chapter text, in terms of the glossary, book summary, tone, style, and target audience, and provide your suggestions for improvement."
         prev_messages.append({"role": "proofreader", "content": message})
-        st.chat_message(self.project_roles["proofreader"]).write(message)
+        self.post_message(self.project_roles["proofreader"], message)
         additional_system_message = "Your response should always be in JSON format as follows: {\"suggestions\": string}. Please do not change the key of the JSON object."
         content, response = self.call_api(
             assistant="junior_editor",
@@ -1477,13 +3597,16 @@ class TransChat:
             content_key="suggestions",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="proofreading",
+            turn_kind="suggestion",
+            chapter_idx=chapter_idx,
         )
         prev_messages.append({"role": "junior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["junior_editor"]).write(content)
+        self.post_message(self.project_roles["junior_editor"], content)
 
         message = f"Please adjust the proofread translation of chapter text accordingly if you think the translation can be improved."
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
+        self.post_message(self.project_roles["junior_editor"], message)
 
         additional_system_message = "Your response should always be in JSON format as follows: {\"adjusted\": bool, \"proofreading\": string}. Please do not change the key of the JSON object. The value of \"adjusted\" should be set to false if the translation needs no adjustments. The \"proofreading\" key should be set to the adjusted proofread chapter translation."
         content, response = self.call_api(
@@ -1492,6 +3615,9 @@ class TransChat:
             content_key="proofreading",
             additional_system_message=additional_system_message,
             prev_messages=prev_messages,
+            stage="proofreading",
+            turn_kind="revise",
+            chapter_idx=chapter_idx,
         )
         # print(content)
 
@@ -1502,7 +3628,7 @@ class TransChat:
             ratio = adjusted_proofreading_length / chapter_localization_length
             print(adjusted_proofreading_length, chapter_localization_length, ratio)
             if ratio < 0.9:
-                self.curr_rerun += 1
+                self.curr_rerun[chapter_idx] = self.curr_rerun.get(chapter_idx, 0) + 1
                 self.proofread_one_chapter(chapter_idx, save_path)
                 return None
         else:
@@ -1510,23 +3636,28 @@ class TransChat:
             adjusted_proofreading_length = proofreading_length
 
         prev_messages.append({"role": "proofreader", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["proofreader"]).write(content)
+        self.post_message(self.project_roles["proofreader"], content)
         # print(prev_messages[-1])
 
-        content, lst = self.evaluate_translation(chapter_text, adjusted_proofreading)
+        content, lst = self.evaluate_translation(chapter_text, adjusted_proofreading, stage="proofreading", chapter_idx=chapter_idx)
         prev_messages.extend(lst)
-        if content["finalize"]:
+        repaired_proofreading, content = self.repair_translation(chapter_idx, "proofreading", adjusted_proofreading, content, prev_messages)
+        if repaired_proofreading != adjusted_proofreading:
+            adjusted_proofreading = repaired_proofreading
+            adjusted_proofreading_length = len(adjusted_proofreading.split())
+        if content["finalize"] or self.accept_near_budget("proofreading", chapter_idx):
             self.book[chapter_idx]["chapter_proofreading"] = adjusted_proofreading
             self.book[chapter_idx]["chapter_proofreading_length"] = adjusted_proofreading_length
-            self.write_jsonl(save_path, [{"chapter_proofreading": adjusted_proofreading, "chapter_proofreading_length": adjusted_proofreading_length}])
-            self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+            self.write_jsonl(save_path, [{"chapter_proofreading": adjusted_proofreading, "chapter_proofreading_length": adjusted_proofreading_length, "input_hash": self.stage_hash("proofreading", chapter_idx)}])
+            self.curr_rerun.pop(chapter_idx, None)
+            self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
             return None
         else:
-            self.curr_rerun += 1
+            self.curr_rerun[chapter_idx] = self.curr_rerun.get(chapter_idx, 0) + 1
             self.proofread_one_chapter(chapter_idx, save_path)
             return None
 
-        self.curr_rerun = 0
+        self.curr_rerun.pop(chapter_idx, None)
         return None
 
     def finalize(self):
@@ -1540,16 +3671,68 @@ class TransChat:
         os.makedirs(finalization_dir, exist_ok=True)
 
 
-        num_chapters = len(self.book)
-        for i in range(num_chapters):
+        def load_one_chapter(i, chapter_path):
+            print(f"Loading the finalization of chapter {i} from {chapter_path}...")
+            self.book[i]["chapter_finalization"] = self.read_jsonl(chapter_path)[0]["chapter_finalization"]
+
+        if self.leases is not None:
+            # sharded workers finalize the chapters they claim
+            self.run_stage("finalization", finalization_dir, load_one_chapter, lambda i, chapter_path: self.finalize_chapters([i], finalization_dir))
+            return
+
+        self.set_progress("finalization")
+        pending = []
+        for i in range(len(self.book)):
             chapter_path = os.path.join(finalization_dir, f"chapter_{i}.jsonl")
-            if os.path.exists(chapter_path):
-                print(f"Loading the finalization of chapter {i} from {chapter_path}...")
-                self.book[i]["chapter_finalization"] = self.read_jsonl(chapter_path)[0]["chapter_finalization"]
+            if self.is_stale(chapter_path, "finalization", i):
+                pending.append(i)
             else:
-                redo_outcome = self.finalize_one_chapter(i, chapter_path)
-                if redo_outcome is not None:
-                    self.redo_one_chapter()
+                load_one_chapter(i, chapter_path)
+                self.set_progress("finalization", i, "done")
+        self.finalize_chapters(pending, finalization_dir)
+
+    def finalize_chapters(self, chapter_indices, finalization_dir):
+        """
+        review the chapters concurrently, then redo the rejected chapters as a parallel batch and review them again
+        """
+        with ThreadPoolExecutor(max_workers=self.finalization_workers) as pool:
+            reviewing = list(chapter_indices)
+            for attempt in range(self.max_redo + 1):
+                for i in reviewing:
+                    self.set_progress("finalization", i, "running")
+                outcomes = list(pool.map(lambda i: self.process_chapter(self.finalize_one_chapter, "finalization", i, os.path.join(finalization_dir, f"chapter_{i}.jsonl")), reviewing))
+                rejected = [i for i in outcomes if i is not None]
+                for i in reviewing:
+                    if i not in rejected:
+                        self.set_progress("finalization", i, "done")
+                if len(rejected) == 0:
+                    return
+                if attempt == self.max_redo:
+                    break
+                # the chapters near the budget keep their proofreading
+                kept = [i for i in rejected if self.budget.nearly_spent("finalization", i)]
+                rejected = [i for i in rejected if i not in kept]
+                for i in kept:
+                    self.accept_near_budget("finalization", i)
+                    self.book[i]["chapter_finalization"] = self.book[i]["chapter_proofreading"]
+                    self.write_jsonl(os.path.join(finalization_dir, f"chapter_{i}.jsonl"), [{"chapter_finalization": self.book[i]["chapter_proofreading"], "remark": "budget", "input_hash": self.stage_hash("finalization", i)}])
+                    self.set_progress("finalization", i, "done")
+                if len(rejected) == 0:
+                    return
+                print(f"Redoing {len(rejected)} rejected chapters, attempt {attempt+1} of {self.max_redo}...")
+                list(pool.map(lambda i: self.process_chapter(self.redo_one_chapter, "finalization", i, attempt), rejected))
+                reviewing = set(rejected)
+                if self.leases is None:
+                    # the review of the next chapter compares it with the redone chapter
+                    reviewing.update([i+1 for i in rejected if i+1 < len(self.book)])
+                reviewing = sorted(reviewing)
+
+        for i in rejected:
+            print(f"Chapter {i} is still rejected after {self.max_redo} redos, keeping its latest proofreading...")
+            chapter_proofreading = self.book[i]["chapter_proofreading"]
+            self.book[i]["chapter_finalization"] = chapter_proofreading
+            self.write_jsonl(os.path.join(finalization_dir, f"chapter_{i}.jsonl"), [{"chapter_finalization": chapter_proofreading, "remark": "reach max redo", "input_hash": self.stage_hash("finalization", i)}])
+            self.set_progress("finalization", i, "done")
 
     def finalize_one_chapter(self, chapter_idx, save_path):
         """
@@ -1568,14 +3751,18 @@ class TransChat:
         if chapter_idx == 0:
             prev_chapter_translation = ""
         else:
-            prev_chapter_translation = self.book[chapter_idx-1]["chapter_proofreading"]
-
-        translation_guidelines = self.translation_guidelines
+            # an untranslated previous chapter has no proofreading
+            prev_chapter_translation = self.book[chapter_idx-1].get("chapter_proofreading", "")
 
-        message = f"Translation Guidelines:\n\n{translation_guidelines}\n\nPrevious Chapter Translation:\n\n{prev_chapter_translation}\n\nCurrent Chapter Text\n\n{chapter_text}\n\nCurrent Chapter Translation:\n\n{chapter_translation}\n\nConsidering the translation guidelines, including the glossary, book summary, tone, style, and target audience, please review if the current chapter aligns well with the previous chapter translation and the current chapter text. This is the final step before the chapter is considered complete, so you must ensure that the current chapter translation is error-free."
+        alignment = self.paragraph_alignment(chapter_text, chapter_translation)
+        if alignment is None:
+            message = f"Previous Chapter Translation:\n\n{prev_chapter_translation}\n\nCurrent Chapter Text\n\n{chapter_text}\n\nCurrent Chapter Translation:\n\n{chapter_translation}\n\nConsidering the translation guidelines, including the glossary, book summary, tone, style, and target audience, please review if the current chapter aligns well with the previous chapter translation and the current chapter text. This is the final step before the chapter is considered complete, so you must ensure that the current chapter translation is error-free."
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"finalize\": bool}. The value of \"finalize\" should be set to true if the current chapter aligns with the previous chapter. Please do not change the key of the JSON object."
+        else:
+            message = f"Previous Chapter Translation:\n\n{prev_chapter_translation}\n\nCurrent Chapter Text\n\n{self.numbered_paragraphs(alignment, 'source')}\n\nCurrent Chapter Translation:\n\n{self.numbered_paragraphs(alignment, 'target')}\n\nConsidering the translation guidelines, including the glossary, book summary, tone, style, and target audience, please review if the current chapter aligns well with the previous chapter translation and the current chapter text. This is the final step before the chapter is considered complete, so you must ensure that the current chapter translation is error-free. The paragraphs of the current chapter are numbered, and each translated paragraph has the number of its source paragraph."
+            additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"finalize\": bool, \"faulty_paragraphs\": [int]}. The value of \"finalize\" should be set to true if the current chapter aligns with the previous chapter. The \"faulty_paragraphs\" key should list the numbers of the paragraphs of the current chapter whose translation needs editing. Please do not change the key of the JSON object."
         prev_messages.append({"role": "junior_editor", "content": message})
-        st.chat_message(self.project_roles["junior_editor"]).write(message)
-        additional_system_message = "Your response should always be in JSON format as follows: {\"justification\": string, \"finalize\": bool}. The value of \"finalize\" should be set to true if the current chapter aligns with the previous chapter. Please do not change the key of the JSON object."
+        self.post_message(self.project_roles["junior_editor"], message)
         # print(message)
         content, response = self.call_api(
             assistant="senior_editor",
@@ -1583,40 +3770,50 @@ class TransChat:
             content_key="finalize",
             additional_system_message=additional_system_message,
             prev_messages=[],
+            stage="finalization",
+            turn_kind="evaluate",
+            chapter_idx=chapter_idx,
         )
         print(content)
         # raise Exception("Stop here.")
         prev_messages.append({"role": "senior_editor", "content": json.dumps(content, ensure_ascii=False)})
-        st.chat_message(self.project_roles["senior_editor"]).write(content)
+        self.post_message(self.project_roles["senior_editor"], content)
         if content["finalize"]:
             self.book[chapter_idx]["chapter_finalization"] = chapter_translation
-            self.write_jsonl(save_path, [{"chapter_finalization": chapter_translation}])
-            self.write_jsonl(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+            self.write_jsonl(save_path, [{"chapter_finalization": chapter_translation, "input_hash": self.stage_hash("finalization", chapter_idx)}])
+            self.write_conversation(save_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
             return None
         else:
+            self.rejected_evaluations[chapter_idx] = content
             return chapter_idx
 
-    def redo_one_chapter(self, chapter_idx):
+    def redo_one_chapter(self, chapter_idx, attempt=0):
         """
-        redo one chapter
+        redo the paragraphs named by the review of one chapter, or its translation, localization and proofreading
+        the redone chapter replaces the checkpoints of its stages, so that a resumed run loads it and its finalization stays fresh
         """
+        evaluation = self.rejected_evaluations.pop(chapter_idx, None)
+        if evaluation is not None and attempt < self.max_paragraph_redo:
+            prev_messages = []
+            chapter_proofreading = self.redo_paragraphs(chapter_idx, "finalization", self.book[chapter_idx]["chapter_proofreading"], evaluation, prev_messages)
+            if chapter_proofreading is not None:
+                chapter_proofreading_length = len(chapter_proofreading.split())
+                self.book[chapter_idx]["chapter_proofreading"] = chapter_proofreading
+                self.book[chapter_idx]["chapter_proofreading_length"] = chapter_proofreading_length
+                chapter_path = os.path.join(self.project_save_dir, "proofreading", f"chapter_{chapter_idx}.jsonl")
+                self.write_jsonl(chapter_path, [{"chapter_proofreading": chapter_proofreading, "chapter_proofreading_length": chapter_proofreading_length, "remark": "paragraph redo", "input_hash": self.stage_hash("proofreading", chapter_idx)}])
+                self.write_conversation(chapter_path.replace(".jsonl", "_conv.jsonl"), prev_messages)
+                return None
+
         print(f"Redoing chapter {chapter_idx}...")
-        redo_dir = os.path.join(self.project_save_dir, "redo")
-        os.makedirs(redo_dir, exist_ok=True)
-        chapter_path = os.path.join(redo_dir, f"chapter_{chapter_idx}_translation.jsonl")
+        chapter_path = os.path.join(self.project_save_dir, "translation", f"chapter_{chapter_idx}.jsonl")
         self.translate_one_chapter(chapter_idx, chapter_path)
 
-        chapter_path = os.path.join(redo_dir, f"chapter_{chapter_idx}_localization.jsonl")
+        chapter_path = os.path.join(self.project_save_dir, "localization", f"chapter_{chapter_idx}.jsonl")
         self.localize_one_chapter(chapter_idx, chapter_path)
 
-        chapter_path = os.path.join(redo_dir, f"chapter_{chapter_idx}_proofreading.jsonl")
+        chapter_path = os.path.join(self.project_save_dir, "proofreading", f"chapter_{chapter_idx}.jsonl")
         self.proofread_one_chapter(chapter_idx, chapter_path)
-
-        chapter_path = os.path.join(redo_dir, f"chapter_{chapter_idx}_finalization.jsonl")
-        redo_outcome = self.finalize_one_chapter(chapter_idx, chapter_path)
-        if redo_outcome is not None:
-            self.redo_one_chapter(chapter_idx)
-        
         return None
 
     def write_down_the_book(self):
@@ -1627,16 +3824,324 @@ class TransChat:
         print("********************** Writing down the book... *********************")
         print("*********************************************************************")
         book_path = os.path.join(self.project_save_dir, "book.jsonl")
-        self.write_jsonl(book_path, self.book)
+        print(f"Writing the data to {book_path}...")
+        with open(book_path, "w") as f:
+            for chapter in self.book:
+                f.write(json.dumps(chapter.to_dict(), ensure_ascii=False)+"\n")
     
 
 
 
-    def call_api(self, assistant, message, content_key, additional_system_message=None, prev_messages=[]):
+    def route_model(self, assistant, stage=None, turn_kind=None):
         """
-        call the API to translate the text
+        select the model for a call according to the routing policy
+        """
+        # before the project is staffed, e.g. when planning, the roles use the default model
+        strong_model = self.project_members[assistant]["model"] if assistant in self.project_members else self.model
+        for key in [(assistant, stage, turn_kind), (None, stage, turn_kind), (assistant, None, turn_kind), (None, None, turn_kind), (assistant, stage, None), (None, stage, None), (assistant, None, None)]:
+            if key in self.routing_policy:
+                tier = self.routing_policy[key]
+                if tier == "fast":
+                    return self.fast_model
+                elif tier == "strong":
+                    return strong_model
+                # the policy may also name a model directly
+                return tier
+        return strong_model
+
+    def escalate_model(self, assistant, model):
+        """
+        escalate a cheaper model to the strong model of the assistant
+        """
+        return self.project_members[assistant]["model"]
+
+    def compute_call_cost(self, assistant, model, usage):
+        """
+        compute the cost of one call from the usage of the response
+        """
+        if usage is None:
+            return 0
+        rates = self.model_rates.get(model, self.project_members[assistant])
+        cached_tokens = self.cached_tokens(usage)
+        input_cost = (usage["prompt_tokens"] - cached_tokens + cached_tokens * self.cached_input_discount) * rates["input_rate"]
+        return input_cost + usage["completion_tokens"] * rates["output_rate"]
+
+    def cached_tokens(self, usage):
+        """
+        the number of prompt tokens served from the provider's prompt cache
+        """
+        details = usage.get("prompt_tokens_details")
+        if details is None or details.get("cached_tokens") is None:
+            return 0
+        return details["cached_tokens"]
+
+    def record_call(self, assistant, model, stage, turn_kind, chapter_idx, latency, usage, valid, first_token_latency=None, reservation=None):
+        """
+        record the telemetry of one call
+        :param reservation: the spend reserved by the budget check of the call, released by its actual spend
+        """
+        cost = self.compute_call_cost(assistant, model, usage)
+        stat = {
+            "assistant": assistant,
+            "model": model,
+            "stage": stage,
+            "turn_kind": turn_kind,
+            "chapter_idx": chapter_idx,
+            "latency": latency,
+            "first_token_latency": first_token_latency,
+            "prompt_tokens": usage["prompt_tokens"] if usage is not None else 0,
+            "completion_tokens": usage["completion_tokens"] if usage is not None else 0,
+            "cached_tokens": self.cached_tokens(usage) if usage is not None else 0,
+            "cost": cost,
+            "valid": valid,
+        }
+        self.budget.spend(stage, chapter_idx, stat["prompt_tokens"] + stat["completion_tokens"], cost, reservation)
+        with self.stats_lock:
+            self.total_cost += cost
+            self.call_stats.append(stat)
+            with open(os.path.join(self.project_save_dir, "telemetry.jsonl"), "a") as f:
+                f.write(json.dumps(stat, ensure_ascii=False)+"\n")
+
+    def report_path(self, name):
+        """
+        the path of a report of this run, one per worker in sharded mode
+        """
+        if self.leases is None:
+            return os.path.join(self.project_save_dir, f"{name}.jsonl")
+        return os.path.join(self.project_save_dir, f"{name}_{self.leases.worker_id}.jsonl")
+
+    def write_telemetry_summary(self):
+        """
+        summarize the cost and latency of the calls per (stage, turn kind, model)
+        """
+        summary = {}
+        for stat in self.call_stats:
+            key = (stat["stage"], stat["turn_kind"], stat["model"])
+            if key not in summary:
+                summary[key] = {"stage": key[0], "turn_kind": key[1], "model": key[2], "calls": 0, "invalid": 0, "latency": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "cost": 0}
+            s = summary[key]
+            s["calls"] += 1
+            s["invalid"] += 0 if stat["valid"] else 1
+            s["latency"] += stat["latency"]
+            s["prompt_tokens"] += stat["prompt_tokens"]
+            s["completion_tokens"] += stat["completion_tokens"]
+            s["cached_tokens"] += stat["cached_tokens"]
+            s["cost"] += stat["cost"]
+        for s in summary.values():
+            s["avg_latency"] = s["latency"] / s["calls"]
+            s["cached_token_ratio"] = s["cached_tokens"] / s["prompt_tokens"] if s["prompt_tokens"] > 0 else 0
+        prompt_tokens = sum([stat["prompt_tokens"] for stat in self.call_stats])
+        cached_tokens = sum([stat["cached_tokens"] for stat in self.call_stats])
+        print(f"Total cost: {self.total_cost}")
+        print(f"Cached token ratio: {cached_tokens / prompt_tokens if prompt_tokens > 0 else 0}")
+        self.write_jsonl(self.report_path("telemetry_summary"), list(summary.values()))
+
+        decoded = self.decode_stats["clean"] + self.decode_stats["repaired"]
+        decode_stats = dict(self.decode_stats)
+        decode_stats["repair_rate"] = decode_stats["repaired"] / decoded if decoded > 0 else 0
+        decode_stats["retry_rate"] = decode_stats["retried"] / (decoded + decode_stats["retried"]) if decoded + decode_stats["retried"] > 0 else 0
+        print(f"Decoding: {decode_stats}")
+        self.write_jsonl(self.report_path("decoding"), [decode_stats])
+
+        self.write_jsonl(self.report_path("segmentation"), [self.segmentation_stats])
+        if self.pack_short_chapters:
+            if len(self.packing_fallbacks) > 0:
+                print(f"Packed prompts translated one by one: {self.packing_fallbacks}")
+            self.write_jsonl(self.report_path("packing"), self.packing_fallbacks)
+
+        # the pool may be wrapped by a local batch client
+        pool = self.client.client if isinstance(self.client, LocalBatchClient) else self.client
+        if isinstance(pool, ClientPool):
+            endpoint_stats = pool.endpoint_stats()
+            print(f"Endpoints: {endpoint_stats}")
+            self.write_jsonl(self.report_path("endpoints"), endpoint_stats)
+
+        hedge_stats = dict(self.hedge_stats)
+        hedge_stats["hedge_rate"] = hedge_stats["hedged"] / hedge_stats["calls"] if hedge_stats["calls"] > 0 else 0
+        hedge_stats["hedge_win_rate"] = hedge_stats["hedge_wins"] / hedge_stats["hedged"] if hedge_stats["hedged"] > 0 else 0
+        print(f"Hedging: {hedge_stats}")
+        self.write_jsonl(self.report_path("hedging"), [hedge_stats])
+
+        # the nodes of the preparation, started relative to the first one
+        preparation_stats = sorted(self.preparation_stats, key=lambda e: e["started"])
+        preparation_stats = [dict(e, started=e["started"] - preparation_stats[0]["started"]) for e in preparation_stats]
+        print(f"Preparation: {preparation_stats}")
+        self.write_jsonl(self.report_path("preparation"), preparation_stats)
+
+        paragraph_redo_stats = dict(self.paragraph_redo_stats)
+        paragraph_redo_stats["redone_fraction"] = paragraph_redo_stats["paragraphs_redone"] / paragraph_redo_stats["paragraphs_total"] if paragraph_redo_stats["paragraphs_total"] > 0 else 0
+        print(f"Paragraph redos: {paragraph_redo_stats}")
+        self.write_jsonl(self.report_path("paragraph_redo"), [paragraph_redo_stats])
+
+        if len(self.budget_degraded) > 0:
+            print(f"Degraded within the budget: {self.budget_degraded}")
+        self.write_jsonl(self.report_path("budget_degraded"), self.budget_degraded)
+
+        debate_stats = [dict(stage=stage, **stats) for stage, stats in self.debate_stats.items()]
+        print(f"Debates: {debate_stats}")
+        self.write_jsonl(self.report_path("debates"), debate_stats)
+
+        conversation_stats = dict(self.conversation_store.stats)
+        conversation_stats["compression_ratio"] = conversation_stats["raw_bytes"] / conversation_stats["stored_bytes"] if conversation_stats["stored_bytes"] > 0 else 0
+        print(f"Conversation store: {conversation_stats}")
+        self.write_jsonl(self.report_path("conversation_store"), [conversation_stats])
+
+        if self.speculative:
+            with self.stats_lock:
+                stats = dict(self.speculation_stats)
+            resolved = stats["hits"] + stats["misses"] + stats["cancelled"]
+            stats["hit_rate"] = stats["hits"] / resolved if resolved > 0 else 0
+            print(f"Speculation: {stats}")
+            self.write_jsonl(self.report_path("speculation"), [stats])
+
+        if self.profiler is not None:
+            # the CPU time spent locally against the time waiting for the API, the profiles of each unit are in the profile directory
+            profile_stats = self.profiler.write_reports()
+            print(f"Profile: {[(e['stage'], e['chapter_idx'], round(e['cpu_seconds'], 2), round(e['api_seconds'], 2)) for e in profile_stats[:10]]}")
+            self.write_jsonl(self.report_path("profile"), profile_stats)
+
+    def plan_unit_calls(self, stage, chapter_indices=None):
+        """
+        the calls of one unit of a stage without reruns, as (assistant, turn kind, prompt tokens, completion tokens)
+        a unit is a chapter, a group of packed chapters, a member to recruit, a role to assign or the whole book
+        """
+        o = self.plan_overhead_tokens
+        if stage in self.guideline_stages:
+            o += estimate_tokens(self.translation_guidelines) if self.translation_guidelines is not None else self.plan_guideline_tokens
+        short = self.plan_short_output_tokens
+        src = sum([estimate_tokens(self.book[i]["chapter_text"]) for i in chapter_indices or []])
+        tgt = int(src * self.plan_output_ratio)
+        if stage == "recruitment":
+            return [("ceo", "profile", o, short), ("ceo", "profile", o + short, short)]
+        if stage == "assignment":
+            return [("ceo", "select", o + 5 * short, short), ("ceo", "finalize", o + 7 * short, short)]
+        # the debates are planned at full length, an early exit only makes them shorter
+        if stage == "glossary":
+            return [("junior_editor", "draft", o + src, short), ("senior_editor", "debate", o + src + 2 * short, short), ("senior_editor", "finalize", o + src + 3 * short, short)]
+        if stage == "glossary_translation":
+            return [("junior_editor", "draft", o + short, short), ("senior_editor", "debate", o + 2 * short, short), ("junior_editor", "debate", o + 3 * short, short), ("senior_editor", "finalize", o + 4 * short, short)]
+        if stage == "summary":
+            return [("junior_editor", "draft", o + src, short), ("senior_editor", "debate", o + src + 2 * short, short), ("junior_editor", "debate", o + src + 3 * short, short), ("senior_editor", "finalize", o + src + 4 * short, short)]
+        if stage == "book_summary":
+            book_summaries = len(self.book) * short
+            return [("junior_editor", "draft", o + book_summaries, short), ("senior_editor", "debate", o + book_summaries + 2 * short, short), ("junior_editor", "debate", o + book_summaries + 3 * short, short), ("senior_editor", "finalize", o + book_summaries + 4 * short, short)]
+        if stage == "guidelines":
+            return [("senior_editor", "finalize", o + short, short)] * 3
+        if stage in ["translation", "localization", "proofreading"]:
+            drafter = {"translation": "translator", "localization": "localization_specialist", "proofreading": "proofreader"}[stage]
+            reviser = "translator" if stage != "proofreading" else "proofreader"
+            draft_input = o + src if stage == "translation" else o + src + tgt
+            return [
+                (drafter, "draft", draft_input, tgt),
+                ("junior_editor", "suggestion", draft_input + tgt, short),
+                (reviser, "revise", draft_input + tgt + short, tgt),
+                ("senior_editor", "evaluate", o + src + tgt, short),
+            ]
+        if stage == "finalization":
+            return [("senior_editor", "evaluate", o + src + 2 * tgt, short)]
+        return []
+
+    def plan_stage(self, stage, units, parallel, concurrency, requests_per_minute=None, tokens_per_minute=None, rerun_calls=None):
+        """
+        estimate the calls, tokens, cost and wall-clock of one stage
+        :param units: the calls of each unit, see plan_unit_calls
+        :param rerun_calls: the calls of each unit in the worst case, the units themselves if None
+        """
+        row = {"stage": stage, "units": len(units)}
+        for case, case_units in [("expected", units), ("worst", rerun_calls if rerun_calls is not None else units)]:
+            calls = 0
+            prompt_tokens = 0
+            completion_tokens = 0
+            cost = 0
+            chains = []
+            for unit in case_units:
+                chain = 0
+                for assistant, turn_kind, unit_prompt_tokens, unit_completion_tokens in unit:
+                    model = self.route_model(assistant, stage, turn_kind)
+                    rates = self.model_rates.get(model, {"input_rate": self.input_rate, "output_rate": self.output_rate})
+                    calls += 1
+                    prompt_tokens += unit_prompt_tokens
+                    completion_tokens += unit_completion_tokens
+                    cost += unit_prompt_tokens * rates["input_rate"] + unit_completion_tokens * rates["output_rate"]
+                    chain += self.plan_base_latency + unit_completion_tokens / self.plan_output_tokens_per_second
+                chains.append(chain)
+            # the units of a parallel stage run side by side, the calls within a unit one after another
+            workers = concurrency if parallel else 1
+            wall_clock = max(sum(chains) / workers, max(chains)) if len(chains) > 0 else 0
+            if requests_per_minute is not None:
+                wall_clock = max(wall_clock, calls / requests_per_minute * 60)
+            if tokens_per_minute is not None:
+                wall_clock = max(wall_clock, (prompt_tokens + completion_tokens) / tokens_per_minute * 60)
+            row[f"{case}_calls"] = calls
+            row[f"{case}_prompt_tokens"] = prompt_tokens
+            row[f"{case}_completion_tokens"] = completion_tokens
+            row[f"{case}_cost"] = cost
+            row[f"{case}_wall_clock"] = wall_clock
+        return row
+
+    def plan(self, concurrency=4, requests_per_minute=None, tokens_per_minute=None):
+        """
+        a dry run over the stages of the book, estimating the calls, tokens, cost and wall-clock without calling the API
+        the expected case has no reruns, the worst case reaches max_turns, max_retry of the assignment, max_rerun and max_redo
+        """
+        num_chapters = len(self.book)
+        chapters = [[i] for i in range(num_chapters)]
+        chapter_calls = {stage: [self.plan_unit_calls(stage, c) for c in chapters] for stage in ["glossary", "glossary_translation", "summary", "translation", "localization", "proofreading", "finalization"]}
+        num_members = self.num_senior_editors + self.num_junior_editors + self.num_translators + self.num_localization_specialists + self.num_proofreaders
+
+        translation_calls = chapter_calls["translation"]
+        if self.pack_short_chapters and not self.batch_mode:
+            translation_calls = [self.plan_unit_calls("translation", group) for group in self.pack_chapters(list(range(num_chapters)))]
+
+        # a rejected assignment turn selects again, a failed selection retries
+        assignment_worst = [(self.plan_unit_calls("assignment") * self.max_turns) + (self.plan_unit_calls("assignment")[:1] * (self.max_retry - 1))] * 5
+        # the reruns of a translation are not bounded in the code, the plan assumes max_rerun of them as for the localization and proofreading
+        rerun = lambda stage: [calls * self.max_rerun for calls in chapter_calls[stage]]
+        redo = [chapter_calls["finalization"][i] * (self.max_redo + 1) + (chapter_calls["translation"][i] + chapter_calls["localization"][i] + chapter_calls["proofreading"][i] + chapter_calls["finalization"][i]) * self.max_redo for i in range(num_chapters)]
+
+        kwargs = {"concurrency": concurrency, "requests_per_minute": requests_per_minute, "tokens_per_minute": tokens_per_minute}
+        rows = [
+            self.plan_stage("recruitment", [self.plan_unit_calls("recruitment")] * num_members, False, **kwargs),
+            self.plan_stage("assignment", [self.plan_unit_calls("assignment")] * 5, False, rerun_calls=assignment_worst, **kwargs),
+            self.plan_stage("glossary", [a + b for a, b in zip(chapter_calls["glossary"], chapter_calls["glossary_translation"])], False, **kwargs),
+            self.plan_stage("summary", chapter_calls["summary"], True, **kwargs),
+            self.plan_stage("book_summary", [self.plan_unit_calls("book_summary")], False, **kwargs),
+            self.plan_stage("guidelines", [self.plan_unit_calls("guidelines")], False, **kwargs),
+            self.plan_stage("translation", translation_calls, True, rerun_calls=rerun("translation"), **kwargs),
+            self.plan_stage("localization", chapter_calls["localization"], True, rerun_calls=rerun("localization"), **kwargs),
+            self.plan_stage("proofreading", chapter_calls["proofreading"], True, rerun_calls=rerun("proofreading"), **kwargs),
+            self.plan_stage("finalization", chapter_calls["finalization"], True, rerun_calls=redo, **kwargs),
+        ]
+        total = {"stage": "total", "units": num_chapters}
+        for key in rows[0].keys():
+            if key not in ["stage", "units"]:
+                total[key] = sum([row[key] for row in rows])
+        rows.append(total)
+        return rows
+
+    def write_plan(self, concurrency=4, requests_per_minute=None, tokens_per_minute=None):
+        """
+        print the dry-run plan and save it to plan.jsonl
+        """
+        rows = self.plan(concurrency, requests_per_minute, tokens_per_minute)
+        for row in rows:
+            print(f"{row['stage']}: {row['expected_calls']} calls (worst {row['worst_calls']}), {row['expected_prompt_tokens'] + row['expected_completion_tokens']} tokens, ${row['expected_cost']:.2f} (worst ${row['worst_cost']:.2f}), {row['expected_wall_clock'] / 60:.1f} minutes (worst {row['worst_wall_clock'] / 60:.1f})")
+        self.write_jsonl(self.report_path("plan"), rows)
+        return rows
+
+    def shared_prefix_messages(self, stage=None):
+        """
+        build the messages shared by all calls of a stage, kept byte-identical for prompt caching
+        """
+        messages = [{"role": "system", "content": self.company_prompt}]
+        if stage in self.guideline_stages and self.translation_guidelines is not None:
+            messages.append({"role": "system", "content": f"Translation Guidelines:\n\n{self.translation_guidelines}"})
+        return messages
+
+    def build_messages(self, assistant, message, additional_system_message=None, prev_messages=[], stage=None):
+        """
+        build the messages sent to the API, the shared prefix first and the per-call suffix after
         """
-        # print(additional_system_message)
         def update_role_prev_messages(assistant_role, prev_messages):
             new_prev_messages = []
             for m in prev_messages:
@@ -1650,17 +4155,10 @@ class TransChat:
                     )
             return new_prev_messages
 
-
-        time.sleep(1)
-        # call_api_uuid = str(uuid.uuid4())
-
-        model = self.project_members[assistant]["model"]
         role_prompt = self.project_members[assistant]["role_prompt"]
 
-        messages = [
-            {"role": "system", "content": self.company_prompt},
-            {"role": "system", "content": role_prompt},
-        ]
+        messages = self.shared_prefix_messages(stage)
+        messages.append({"role": "system", "content": role_prompt})
         if additional_system_message is not None:
             messages.append({"role": "system", "content": additional_system_message})
 
@@ -1674,46 +4172,798 @@ class TransChat:
         # for m in messages:
         #     print(m)
         # print("===================")
+        return messages
+
+    def run_batch(self, name, requests):
+        """
+        submit the independent requests of a stage as one batch and wait for the results
+        """
+        if len(requests) == 0:
+            return
+        print(f"Running the batch {name} with {len(requests)} requests...")
+        batch_dir = os.path.join(self.project_save_dir, "batch")
+        os.makedirs(batch_dir, exist_ok=True)
+        input_path = os.path.join(batch_dir, f"{name}_input.jsonl")
+        batch_path = os.path.join(batch_dir, f"{name}_batch.jsonl")
+        output_path = os.path.join(batch_dir, f"{name}_output.jsonl")
+        requests = {r["custom_id"]: r for r in requests}
+
+        if not os.path.exists(output_path):
+            if os.path.exists(batch_path):
+                print(f"Loading the batch {name} from {batch_path}...")
+                batch_id = self.read_jsonl(batch_path)[0]["batch_id"]
+            else:
+                lines = []
+                for custom_id, r in requests.items():
+                    lines.append({
+                        "custom_id": custom_id,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": self.route_model(r["assistant"], r["stage"], r["turn_kind"]),
+                            "response_format": {"type": "json_object"},
+                            "messages": self.build_messages(r["assistant"], r["message"], r["additional_system_message"], stage=r["stage"]),
+                            "temperature": 0.7,
+                        },
+                    })
+                self.write_jsonl(input_path, lines)
+                with open(input_path, "rb") as f:
+                    batch_file = self.client.files.create(file=f, purpose="batch")
+                batch = self.client.batches.create(
+                    input_file_id=batch_file.id,
+                    endpoint="/v1/chat/completions",
+                    completion_window="24h",
+                )
+                batch_id = batch.id
+                self.write_jsonl(batch_path, [{"batch_id": batch_id}])
+
+            start_time = time.time()
+            while True:
+                batch = self.client.batches.retrieve(batch_id)
+                print(f"Batch {name} is {batch.status}...")
+                if batch.status in ["completed", "failed", "expired", "cancelled"]:
+                    break
+                time.sleep(self.batch_poll_interval)
+            if batch.output_file_id is None:
+                # the requests of a failed batch are sent one by one by call_api
+                print(f"Batch {name} is {batch.status}, falling back to synchronous calls...")
+                os.remove(batch_path)
+                return
+            with open(output_path, "w") as f:
+                f.write(self.client.files.content(batch.output_file_id).text)
+            print(f"Batch {name} took {time.time() - start_time} seconds.")
+
+        for result in self.read_jsonl(output_path):
+            r = requests.get(result["custom_id"])
+            if r is None or result.get("response") is None or result["response"]["status_code"] != 200:
+                continue
+            body = result["response"]["body"]
+            try:
+                content = self.decode_response(body["choices"][0]["message"]["content"], r["content_key"], r["additional_system_message"])
+            except Exception as e:
+                print(e)
+                continue
+            self.record_call(r["assistant"], body["model"], r["stage"], r["turn_kind"], r["chapter_idx"], 0, body.get("usage"), True)
+            self.prefetched[result["custom_id"]] = (content, body)
+
+    def decode_response(self, text, content_key, additional_system_message=None):
+        """
+        parse a response, repairing it if needed, and validate it against the format in the system message
+        """
+        repaired = False
+        try:
+            content = json.loads(text, strict=False)
+        except Exception:
+            fixed = repair_json(text or "")
+            if fixed is None:
+                raise Exception("No JSON object in the response.")
+            content = json.loads(fixed, strict=False)
+            repaired = True
+        if not isinstance(content, dict):
+            raise Exception("The response is not a JSON object.")
+
+        for key, value_type in schema_from_format(additional_system_message).items():
+            value = content.get(key)
+            if value is None:
+                # only a missing free-text field or list can be filled in, e.g. the optional faulty paragraphs of an evaluation
+                if key == content_key or value_type not in ["string", "list"]:
+                    raise Exception(f"Failed to get the key {key} from the response.")
+                content[key] = "" if value_type == "string" else []
+                repaired = True
+            elif value_type == "string" and isinstance(value, (bool, int, float)):
+                content[key] = str(value)
+                repaired = True
+            elif value_type == "bool" and not isinstance(value, bool):
+                if str(value).strip().lower() not in ["true", "false"]:
+                    raise Exception(f"The key {key} is not a bool.")
+                content[key] = str(value).strip().lower() == "true"
+                repaired = True
+            elif value_type in ["int", "float"] and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                content[key] = int(value) if value_type == "int" else float(value)
+                repaired = True
+            elif value_type == "list" and not isinstance(value, list):
+                raise Exception(f"The key {key} is not a list.")
+
+        if not content_key in content.keys():
+            raise Exception(f"Failed to get the content key {content_key} from the response.")
+        with self.stats_lock:
+            self.decode_stats["repaired" if repaired else "clean"] += 1
+        return content
+
+    def call_api(self, assistant, message, content_key, additional_system_message=None, prev_messages=[], stage=None, turn_kind=None, chapter_idx=None, validator=None, prefetch_key=None):
+        """
+        call the API to translate the text
+        a response that cannot be decoded, or that fails the validator, is retried and raises once the retries run out
+        the validator is meant for structural checks, such as the chapters of a packed response, policies such as the length of a draft are left to the caller
+        """
+        if prefetch_key in self.prefetched:
+            content, response = self.prefetched.pop(prefetch_key)
+            if validator is None or validator(content):
+                self.count_speculation(prefetch_key, response, hit=True)
+                return content, response
+            self.count_speculation(prefetch_key, response, hit=False)
+
+        self.budget.check(stage, chapter_idx)
+        if turn_kind in ["suggestion", "revise"] and self.budget.nearly_spent(stage, chapter_idx):
+            # the suggestion and revision turns are optional, the draft is kept
+            print(f"Skipping the {turn_kind} turn of the {stage} near the budget...")
+            if turn_kind == "suggestion":
+                return {"suggestions": ""}, None
+            return {"adjusted": False, content_key: ""}, None
+
+        time.sleep(1)
+        # call_api_uuid = str(uuid.uuid4())
+
+        # the CPU time of this thread excludes the sleeps and the waits for the API
+        cpu_started = time.thread_time()
+        api_seconds = 0
+        model = self.route_model(assistant, stage, turn_kind)
+        messages = self.build_messages(assistant, message, additional_system_message, prev_messages, stage)
+        timeout = self.call_timeout(messages, turn_kind)
 
         retry = 0
-        flag = False
-        raw_response = None
+        response = None
+        content = None
+        expected_usage = self.expected_usage(messages, turn_kind)
         while retry < self.max_retry:
+            # the expected spend is reserved until the call is recorded
+            reservation = self.budget.check(stage, chapter_idx, expected_usage["prompt_tokens"] + expected_usage["completion_tokens"], self.compute_call_cost(assistant, model, expected_usage))
+            start_time = time.time()
+            response = None
+            self.emit("call_start", assistant=assistant, model=model, stage=stage, turn_kind=turn_kind, chapter_idx=chapter_idx)
             try:
-                raw_response = self.client.chat.completions.create(
-                    model=model,
-                    response_format={ "type": "json_object" },
-                    messages=messages,
-                    temperature=0.7,
-                )
-                content = json.loads(raw_response.choices[0].message.content)
-                output = content[content_key]
+                try:
+                    text, response = self.request_hedged(model, messages, content_key, timeout, assistant=assistant, stage=stage, turn_kind=turn_kind, chapter_idx=chapter_idx)
+                finally:
+                    api_seconds += time.time() - start_time
+                content = self.decode_response(text, content_key, additional_system_message)
                 # print("========", content)
-                # print(content_key, content.keys())
-                if not content_key in content.keys():
-                    raise Exception(f"Failed to get the content key {content_key} from the response.")
+                if validator is not None and not validator(content):
+                    raise Exception(f"The response of {model} failed the validation.")
+                self.record_call(assistant, model, stage, turn_kind, chapter_idx, time.time() - start_time, response.get("usage"), True, response.get("first_token_latency"), reservation)
+                self.emit("call_end", assistant=assistant, model=model, stage=stage, turn_kind=turn_kind, chapter_idx=chapter_idx, content=content)
                 break
 
             except Exception as e:
                 print(e)
-                print(raw_response)
+                print(response)
+                # a response that failed the validation must not be returned once the retries run out
+                content = None
+                if isinstance(e, TimeoutError) or "Timeout" in type(e).__name__:
+                    with self.stats_lock:
+                        self.hedge_stats["timeouts"] += 1
+                usage = response.get("usage") if response is not None else getattr(e, "usage", None)
+                self.record_call(assistant, model, stage, turn_kind, chapter_idx, time.time() - start_time, usage, False, reservation=reservation)
                 retry += 1
+                with self.stats_lock:
+                    self.decode_stats["retried"] += 1
+                escalated_model = self.escalate_model(assistant, model)
+                if escalated_model != model:
+                    print(f"Escalating from {model} to {escalated_model}...")
+                    model = escalated_model
                 print(f"Retry {retry} times for calling api...")
                 time.sleep(1)
 
-        return content, raw_response.model_dump()
+        if self.profiler is not None:
+            self.profiler.record_call(stage, chapter_idx, time.thread_time() - cpu_started, api_seconds)
+        if content is None:
+            with self.stats_lock:
+                self.decode_stats["failed"] += 1
+            raise InvalidResponse(f"Failed to get a valid response from {model} after {self.max_retry} retries.")
+        return content, response
+
+    def request_stream(self, model, messages, content_key, timeout=None, cancel=None, **event_payload):
+        """
+        stream one completion, emitting the partial value of content_key as it arrives
+        the stream is closed once its deadline passes or it is cancelled
+        """
+        start_time = time.time()
+        stream = self.client.chat.completions.create(
+            model=model,
+            response_format={ "type": "json_object" },
+            messages=messages,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout,
+        )
+        chunks = []
+        decoder = PartialJSONString(content_key)
+        response = {"id": None, "model": model, "usage": None, "first_token_latency": None}
+        finish_reason = None
+        emitted_length = 0
+        for chunk in stream:
+            if (cancel is not None and cancel.is_set()) or (timeout is not None and time.time() - start_time > timeout):
+                if hasattr(stream, "close"):
+                    stream.close()
+                if cancel is not None and cancel.is_set():
+                    raise Exception(f"The request to {model} was cancelled.")
+                raise TimeoutError(f"The response of {model} took longer than {timeout:.0f} seconds.")
+            response["id"] = chunk.id if getattr(chunk, "id", None) is not None else response["id"]
+            if getattr(chunk, "usage", None) is not None:
+                response["usage"] = chunk.usage.model_dump()
+            if len(chunk.choices) == 0:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content is not None:
+                if response["first_token_latency"] is None:
+                    response["first_token_latency"] = time.time() - start_time
+                    self.emit("first_token", latency=response["first_token_latency"], **event_payload)
+                chunks.append(choice.delta.content)
+                if decoder.feed(choice.delta.content) - emitted_length >= self.stream_emit_chars:
+                    emitted_length = decoder.length
+                    self.emit("partial", text=decoder.value(), **event_payload)
+            if choice.finish_reason is not None:
+                finish_reason = choice.finish_reason
+                if finish_reason == "length":
+                    # the JSON cannot be complete, only the usage chunk is still to come
+                    self.emit("truncated", **event_payload)
+
+        if finish_reason == "length":
+            # the tokens of the truncated response are still charged by call_api
+            error = Exception(f"The response of {model} was truncated.")
+            error.usage = response["usage"]
+            raise error
+        text = "".join(chunks)
+        if decoder.value() is not None and decoder.length > emitted_length:
+            self.emit("partial", text=decoder.value(), **event_payload)
+        response["choices"] = [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish_reason}]
+        return text, response
+
+    def request_once(self, model, messages, content_key, timeout=None, cancel=None, **event_payload):
+        """
+        send one request, streamed or not, with a deadline
+        """
+        if self.stream:
+            return self.request_stream(model, messages, content_key, timeout, cancel, **event_payload)
+        raw_response = self.client.chat.completions.create(
+            model=model,
+            response_format={ "type": "json_object" },
+            messages=messages,
+            temperature=0.7,
+            timeout=timeout,
+        )
+        response = raw_response.model_dump()
+        text = raw_response.choices[0].message.content
+        if raw_response.choices[0].finish_reason == "length":
+            # the tokens of the truncated response are still charged by call_api
+            error = Exception(f"The response of {model} was truncated.")
+            error.usage = response.get("usage")
+            raise error
+        return text, response
+
+    def request_hedged(self, model, messages, content_key, timeout=None, **event_payload):
+        """
+        send a request and, when it is slower than the p95 latency of its stage and turn kind, a duplicate one
+        the first successful response is returned and the other request is cancelled
+        a request that is not streamed cannot be cancelled, the loser runs to completion and its usage is counted in hedge_stats["extra_cost"] once it is done
+        """
+        with self.stats_lock:
+            self.hedge_stats["calls"] += 1
+        delay = self.hedge_delay(event_payload.get("stage"), event_payload.get("turn_kind")) if self.hedge else None
+        if delay is None:
+            return self.request_once(model, messages, content_key, timeout, **event_payload)
+
+        executor = self.hedge_executor(event_payload.get("stage"))
+        cancels = [threading.Event(), threading.Event()]
+        futures = [executor.submit(self.request_once, model, messages, content_key, timeout, cancels[0], **event_payload)]
+        done, pending = wait(futures, timeout=delay)
+        if len(done) == 0:
+            print(f"Hedging a call of the {event_payload.get('stage')} slower than {delay:.1f} seconds...")
+            with self.stats_lock:
+                self.hedge_stats["hedged"] += 1
+            futures.append(executor.submit(self.request_once, model, messages, content_key, timeout, cancels[1], **event_payload))
+
+        pending = list(futures)
+        error = None
+        while len(pending) > 0:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if future.exception() is not None:
+                    error = future.exception()
+                    if len(pending) > 0:
+                        # the other request may still win, only the last error is charged by call_api
+                        self.record_hedge_loser(event_payload.get("assistant"), model, event_payload.get("stage"), event_payload.get("chapter_idx"), future)
+                    continue
+                winner = futures.index(future)
+                for i, other in enumerate(futures):
+                    if i != winner:
+                        cancels[i].set()
+                        if not self.stream and not other.done():
+                            with self.stats_lock:
+                                self.hedge_stats["uncancelled_losers"] += 1
+                        other.add_done_callback(lambda f: self.record_hedge_loser(event_payload.get("assistant"), model, event_payload.get("stage"), event_payload.get("chapter_idx"), f))
+                if winner > 0:
+                    with self.stats_lock:
+                        self.hedge_stats["hedge_wins"] += 1
+                return future.result()
+        raise error
+
+    def hedge_executor(self, stage):
+        """
+        the pool of the hedged requests of a stage, two requests for each of its concurrent calls and as many for the losers that cannot be cancelled
+        so that a duplicate request never queues behind the calls it hedges
+        """
+        with self.stats_lock:
+            if stage not in self.hedge_executors:
+                workers = self.finalization_workers if stage == "finalization" else self.preparation_workers
+                self.hedge_executors[stage] = ThreadPoolExecutor(max_workers=4 * workers)
+            return self.hedge_executors[stage]
+
+    def record_hedge_loser(self, assistant, model, stage, chapter_idx, future):
+        """
+        count the usage of the request that lost a hedge, the usage of a cancelled stream is not known
+        """
+        if future.exception() is not None:
+            usage = getattr(future.exception(), "usage", None)
+        else:
+            usage = future.result()[1].get("usage")
+        if usage is None:
+            return
+        cost = self.compute_call_cost(assistant, model, usage)
+        tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+        self.budget.spend(stage, chapter_idx, tokens, cost)
+        with self.stats_lock:
+            self.total_cost += cost
+            self.hedge_stats["extra_tokens"] += tokens
+            self.hedge_stats["extra_cost"] += cost
+
+    def hedge_delay(self, stage, turn_kind):
+        """
+        the p95 latency of the valid calls of a stage and turn kind, None until there are enough of them
+        """
+        with self.stats_lock:
+            latencies = sorted([stat["latency"] for stat in self.call_stats if stat["stage"] == stage and stat["turn_kind"] == turn_kind and stat["valid"]])
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def call_timeout(self, messages, turn_kind):
+        """
+        the deadline of a call, scaled by its expected output length
+        the drafts and revisions are about as long as the longest message, the other turns are short
+        """
+        return self.timeout_base + self.expected_usage(messages, turn_kind)["completion_tokens"] / self.timeout_tokens_per_second
+
+    def expected_usage(self, messages, turn_kind):
+        """
+        estimate the usage of a call before it is sent
+        the drafts and revisions are about as long as the longest message, the other turns are short
+        """
+        completion_tokens = self.plan_short_output_tokens
+        if turn_kind in ["draft", "revise"]:
+            completion_tokens = max([int(estimate_tokens(m["content"]) * self.plan_output_ratio) for m in messages if m["role"] != "system"] + [completion_tokens])
+        return {"prompt_tokens": sum([estimate_tokens(m["content"]) for m in messages]), "completion_tokens": completion_tokens}
+
+    def subscribe(self, callback):
+        """
+        subscribe to the events of the API calls, callback(event, payload)
+        """
+        self.subscribers.append(callback)
+
+    def emit(self, event, **payload):
+        for callback in self.subscribers:
+            try:
+                callback(event, payload)
+            except Exception as e:
+                print(e)
+
+    def post_message(self, role, message, kind="text"):
+        """
+        buffer a message of the conversation for the front end, which renders the new messages in batches
+        :param kind: "text", or "table" for a dict of columns
+        """
+        with self.stats_lock:
+            self.conversations.append({"role": role, "content": message, "kind": kind, "time": time.time()})
+        self.emit("message", role=role, kind=kind)
+
+    def set_progress(self, stage, chapter_idx=None, status=None):
+        """
+        record the current stage and the status of one chapter in it: waiting, running or done
+        """
+        with self.stats_lock:
+            self.progress["stage"] = stage
+            if chapter_idx is not None:
+                self.progress["chapters"].setdefault(stage, {})[chapter_idx] = status
+
+    def progress_snapshot(self, num_messages=50):
+        """
+        a consistent copy of the progress with the throughput, tokens and cost so far, and the latest messages
+        """
+        with self.stats_lock:
+            chapters = {stage: dict(statuses) for stage, statuses in self.progress["chapters"].items()}
+            snapshot = {
+                "stage": self.progress["stage"],
+                "started": self.progress["started"],
+                "finished": self.progress["finished"],
+                "num_chapters": len(self.book),
+                "chapters": chapters,
+                "calls": len(self.call_stats),
+                "prompt_tokens": sum([stat["prompt_tokens"] for stat in self.call_stats]),
+                "completion_tokens": sum([stat["completion_tokens"] for stat in self.call_stats]),
+                "cost": self.total_cost,
+                "num_messages": len(self.conversations),
+                "messages": list(self.conversations)[-num_messages:],
+            }
+        end = snapshot["finished"] or time.time()
+        elapsed = end - snapshot["started"] if snapshot["started"] is not None else 0
+        done = sum([list(statuses.values()).count("done") for statuses in chapters.values()])
+        snapshot["elapsed"] = elapsed
+        snapshot["chapters_per_minute"] = done / elapsed * 60 if elapsed > 0 else 0
+        snapshot["tokens_per_second"] = (snapshot["prompt_tokens"] + snapshot["completion_tokens"]) / elapsed if elapsed > 0 else 0
+        return snapshot
+
+
+
+
+class LocalBatchObject:
+    """
+    a plain object returned by LocalBatchClient
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class LocalBatchClient:
+    """
+    LocalBatchClient is a local stand-in for the batch API of OpenAI.
+    It processes the batch files synchronously with the chat completions of the wrapped client.
+    """
+    def __init__(self, client, save_dir):
+        self.client = client
+        self.chat = client.chat
+        self.save_dir = save_dir
+        os.makedirs(self.save_dir, exist_ok=True)
+        self.batch_objects = {}
+        self.files = LocalBatchObject(create=self.create_file, content=self.file_content)
+        self.batches = LocalBatchObject(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    def create_file(self, file, purpose):
+        file_id = f"file-{uuid.uuid4()}"
+        with open(os.path.join(self.save_dir, f"{file_id}.jsonl"), "wb") as f:
+            f.write(file.read())
+        return LocalBatchObject(id=file_id, purpose=purpose)
+
+    def file_content(self, file_id):
+        with open(os.path.join(self.save_dir, f"{file_id}.jsonl"), "r") as f:
+            return LocalBatchObject(text=f.read())
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        outputs = []
+        for request in self.file_content(input_file_id).text.splitlines():
+            request = json.loads(request)
+            output = {"id": f"batch_req_{uuid.uuid4()}", "custom_id": request["custom_id"], "response": None, "error": None}
+            try:
+                response = self.client.chat.completions.create(**request["body"])
+                output["response"] = {"status_code": 200, "body": response.model_dump()}
+            except Exception as e:
+                output["error"] = {"message": str(e)}
+            outputs.append(output)
+
+        output_file_id = f"file-{uuid.uuid4()}"
+        with open(os.path.join(self.save_dir, f"{output_file_id}.jsonl"), "w") as f:
+            for output in outputs:
+                f.write(json.dumps(output, ensure_ascii=False)+"\n")
+        batch = LocalBatchObject(
+            id=f"batch_{uuid.uuid4()}",
+            endpoint=endpoint,
+            completion_window=completion_window,
+            input_file_id=input_file_id,
+            output_file_id=output_file_id,
+            status="completed",
+        )
+        self.batch_objects[batch.id] = batch
+        return batch
+
+    def retrieve_batch(self, batch_id):
+        return self.batch_objects[batch_id]
+
+
+class ClientPool:
+    """
+    ClientPool spreads the chat completions over several clients, such as several API keys or OpenAI-compatible servers.
+    Each request goes to the endpoint with the most remaining quota according to its rate limit headers.
+    Repeated errors open the circuit breaker of an endpoint for a cool-down, and the request fails over to the next endpoint.
+    """
+    def __init__(self, clients, names=None, model_maps=None, failure_threshold=3, cooldown=60):
+        self.clients = clients
+        self.names = names or [f"endpoint_{i}" for i in range(len(clients))]
+        # the model names of an endpoint, e.g. a local server serving its own models
+        self.model_maps = model_maps or [{} for _ in clients]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        # the status codes of a malformed request, which are not failed over
+        self.request_errors = [400, 413, 422]
+        self.lock = threading.Lock()
+        self.endpoints = [{
+            "name": name,
+            "remaining": 1.0,
+            "inflight": 0,
+            "last_used": 0,
+            "consecutive_failures": 0,
+            "open_until": 0,
+            "requests": 0,
+            "failures": 0,
+            "circuit_opened": 0,
+            "latency": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        } for name in self.names]
+        self.chat = LocalBatchObject(completions=LocalBatchObject(create=self.create))
+        # batches belong to the account that created them, so they stay with the first client
+        self.files = getattr(clients[0], "files", None)
+        self.batches = getattr(clients[0], "batches", None)
+
+    def pick(self, tried):
+        """
+        the endpoint with the most remaining quota among the closed circuits, or the one that reopens first
+        """
+        now = time.time()
+        with self.lock:
+            candidates = [i for i in range(len(self.clients)) if i not in tried]
+            if len(candidates) == 0:
+                return None
+            closed = [i for i in candidates if self.endpoints[i]["open_until"] <= now]
+            if len(closed) == 0:
+                i = min(candidates, key=lambda i: self.endpoints[i]["open_until"])
+            else:
+                i = max(closed, key=lambda i: (self.endpoints[i]["remaining"], -self.endpoints[i]["inflight"], -self.endpoints[i]["last_used"]))
+            self.endpoints[i]["inflight"] += 1
+            self.endpoints[i]["last_used"] = now
+            return i
+
+    def remaining_quota(self, headers):
+        """
+        the fraction of the request and token quota left, 1 when the endpoint does not report it
+        """
+        fractions = [1.0]
+        for kind in ["requests", "tokens"]:
+            try:
+                remaining = float(headers.get(f"x-ratelimit-remaining-{kind}"))
+                limit = float(headers.get(f"x-ratelimit-limit-{kind}"))
+                fractions.append(remaining / limit if limit > 0 else 0)
+            except (TypeError, ValueError):
+                continue
+        return min(fractions)
+
+    def create(self, model, **kwargs):
+        tried = []
+        error = None
+        while True:
+            i = self.pick(tried)
+            if i is None:
+                raise error
+            tried.append(i)
+            endpoint = self.endpoints[i]
+            completions = self.clients[i].chat.completions
+            start_time = time.time()
+            try:
+                endpoint_model = self.model_maps[i].get(model, model)
+                raw = getattr(completions, "with_raw_response", None)
+                if raw is not None:
+                    raw_response = raw.create(model=endpoint_model, **kwargs)
+                    headers = raw_response.headers
+                    response = raw_response.parse()
+                else:
+                    headers = {}
+                    response = completions.create(model=endpoint_model, **kwargs)
+            except Exception as e:
+                status_code = getattr(e, "status_code", None)
+                with self.lock:
+                    endpoint["inflight"] -= 1
+                    # a malformed request fails on every endpoint, it does not count against this one
+                    # an auth or not-found error is specific to the endpoint, e.g. a revoked key or a wrong url
+                    if status_code in self.request_errors:
+                        raise
+                    endpoint["requests"] += 1
+                    endpoint["failures"] += 1
+                    endpoint["consecutive_failures"] += 1
+                    if endpoint["consecutive_failures"] >= self.failure_threshold:
+                        print(f"Opening the circuit of {endpoint['name']} for {self.cooldown} seconds...")
+                        endpoint["open_until"] = time.time() + self.cooldown
+                        endpoint["circuit_opened"] += 1
+                        endpoint["consecutive_failures"] = 0
+                print(f"{endpoint['name']} failed: {e}, failing over...")
+                error = e
+                continue
+
+            with self.lock:
+                endpoint["inflight"] -= 1
+                endpoint["requests"] += 1
+                endpoint["consecutive_failures"] = 0
+                endpoint["open_until"] = 0
+                endpoint["remaining"] = self.remaining_quota(headers)
+                endpoint["latency"] += time.time() - start_time
+            if kwargs.get("stream"):
+                return self.count_stream(endpoint, response)
+            self.count_usage(endpoint, getattr(response, "usage", None))
+            return response
+
+    def count_usage(self, endpoint, usage):
+        if usage is None:
+            return
+        with self.lock:
+            endpoint["prompt_tokens"] += usage.prompt_tokens
+            endpoint["completion_tokens"] += usage.completion_tokens
 
+    def count_stream(self, endpoint, stream):
+        """
+        pass a stream through, counting its usage
+        """
+        try:
+            for chunk in stream:
+                self.count_usage(endpoint, getattr(chunk, "usage", None))
+                yield chunk
+        finally:
+            if hasattr(stream, "close"):
+                stream.close()
+
+    def endpoint_stats(self):
+        """
+        the health and throughput of each endpoint
+        """
+        now = time.time()
+        stats = []
+        with self.lock:
+            for endpoint in self.endpoints:
+                successes = endpoint["requests"] - endpoint["failures"]
+                stats.append({
+                    "name": endpoint["name"],
+                    "healthy": endpoint["open_until"] <= now,
+                    "remaining_quota": endpoint["remaining"],
+                    "requests": endpoint["requests"],
+                    "failures": endpoint["failures"],
+                    "error_rate": endpoint["failures"] / endpoint["requests"] if endpoint["requests"] > 0 else 0,
+                    "circuit_opened": endpoint["circuit_opened"],
+                    "mean_latency": endpoint["latency"] / successes if successes > 0 else 0,
+                    "prompt_tokens": endpoint["prompt_tokens"],
+                    "completion_tokens": endpoint["completion_tokens"],
+                })
+        return stats
+
+
+def build_client(api_keys, endpoints=None):
+    """
+    build one client per API key and per OpenAI-compatible endpoint, pooled when there are several
+    :param endpoints: a list of (base_url, api_key)
+    """
+    from openai import OpenAI
 
+    clients = [OpenAI(api_key=key) for key in api_keys]
+    names = [f"openai_{i}" for i in range(len(api_keys))]
+    for base_url, key in endpoints or []:
+        clients.append(OpenAI(base_url=base_url, api_key=key or "none"))
+        names.append(base_url)
+    if len(clients) == 0:
+        return OpenAI()
+    if len(clients) == 1:
+        return clients[0]
+    return ClientPool(clients, names)
 
 
+def execute_multi_target(client, src_lang, tgt_langs, text_path, save_dir, shared_dir=None, **kwargs):
+    """
+    translate a book into several target languages in parallel, preparing its source side once
+    each target language has its own project under save_dir/<tgt_lang>, the shared preparation is under shared_dir, save_dir/shared by default
+    """
+    shared_dir = shared_dir if shared_dir is not None else os.path.join(save_dir, "shared")
+    chats = [TransChat(client=client, src_lang=src_lang, tgt_lang=tgt_lang, text_path=text_path, save_dir=os.path.join(save_dir, tgt_lang), shared_dir=shared_dir, **kwargs) for tgt_lang in tgt_langs]
+    with ThreadPoolExecutor(max_workers=len(chats)) as pool:
+        list(pool.map(lambda chat: chat.execute(), chats))
+    return chats
+
+
+def job_registry():
+    """
+    the jobs of the app, kept across the reruns of the script and the browser sessions
+    """
+    import streamlit as st
+
+    @st.cache_resource
+    def registry():
+        return {}
+
+    return registry()
+
+
+def save_upload(uploaded_file):
+    """
+    save an uploaded file, return its path
+    """
+    save_path = os.path.join("uploads", uploaded_file.name)
+    with open(save_path, "wb") as f:
+        f.write(uploaded_file.getvalue())
+    return save_path
+
+
+def run_job(job):
+    """
+    run a job in a background thread, keeping its error for the dashboard
+    """
+    try:
+        job["chat"].execute()
+    except Exception as e:
+        logging.exception(e)
+        job["error"] = repr(e)
+
+
+def render_dashboard(job):
+    """
+    render the progress of a job and its latest messages in one pass
+    """
+    import streamlit as st
+    import pandas as pd
+
+    snapshot = job["chat"].progress_snapshot()
+    if job["error"] is not None:
+        st.error(f"The job failed: {job['error']}")
+    elif snapshot["finished"] is not None:
+        st.success(f"Finished in {snapshot['elapsed'] / 60:.1f} minutes.")
+    else:
+        st.info(f"Current stage: {snapshot['stage']}")
+
+    cols = st.columns(5)
+    cols[0].metric("Calls", snapshot["calls"])
+    cols[1].metric("Tokens", snapshot["prompt_tokens"] + snapshot["completion_tokens"])
+    cols[2].metric("Cost", f"${snapshot['cost']:.4f}")
+    cols[3].metric("Chapters / minute", f"{snapshot['chapters_per_minute']:.2f}")
+    cols[4].metric("Tokens / second", f"{snapshot['tokens_per_second']:.1f}")
+
+    num_chapters = snapshot["num_chapters"]
+    for stage, statuses in snapshot["chapters"].items():
+        done = list(statuses.values()).count("done")
+        st.progress(done / num_chapters if num_chapters > 0 else 0, text=f"{stage}: {done}/{num_chapters} chapters")
+    if len(snapshot["chapters"]) > 0:
+        df = pd.DataFrame().from_dict(
+            {stage: [statuses.get(i, "") for i in range(num_chapters)] for stage, statuses in snapshot["chapters"].items()}
+        )
+        st.dataframe(df)
+
+    if job["partial"] != "" and snapshot["finished"] is None:
+        with st.expander("Current response", expanded=True):
+            st.write(job["partial"])
+    with st.expander(f"Latest messages ({snapshot['num_messages']} in total)"):
+        for m in snapshot["messages"]:
+            role = m["role"] if isinstance(m["role"], str) else ",".join(m["role"])
+            with st.chat_message(role):
+                if m["kind"] == "table":
+                    st.table(pd.DataFrame().from_dict(m["content"]))
+                else:
+                    st.write(m["content"])
+
 
 def main():
+    import streamlit as st
+    import pandas as pd
+
     # parser = argparse.ArgumentParser()
 
     langs = ("Chinese", "English")
     st.title("TransChat")
     with st.sidebar:
-        api_key = st.text_input("Your api key")
+        api_key = st.text_input("Your api key, several keys separated by commas")
+        extra_endpoints = st.text_area("OpenAI-compatible endpoints, one \"base_url,api_key\" per line")
         src_lang = st.selectbox("source language", langs)
         tgt_lang = st.selectbox("target language", langs)
         uploaded_file = st.file_uploader("Your file")
@@ -1728,44 +4978,154 @@ def main():
         max_turns= st.slider("Number of Max Converstaion Turns", 1, 10, 3) 
         max_retry=st.slider("Number of Maximum Retry", 1, 10, 3)
         max_rerun=st.slider("Number of Maximum Return", 1, 10, 5) 
+        batch_mode = st.checkbox("Batch mode (offline, lower cost)")
+        speculative = st.checkbox("Localize while translations are being evaluated (chapters translated one by one)")
+        stream = st.checkbox("Stream the responses", value=True)
+        hedge = st.checkbox("Duplicate the calls slower than the p95 latency of their stage")
+        pack_short_chapters = st.checkbox("Translate short chapters together", value=True)
+        profile = st.checkbox("Profile CPU and memory per stage")
+        budget = st.number_input("Budget in USD (0 for no limit)", 0.0, 100000.0, 0.0)
+        concurrency = st.slider("Parallel workers for the estimate", 1, 16, 1)
+        requests_per_minute = st.number_input("Requests per minute for the estimate", 1, 100000, 500)
 
     if not os.path.exists("output"):
         os.makedirs("output")
 
+    jobs = job_registry()
+    poll_interval = 2
+
+    settings = dict(
+        src_lang=src_lang,
+        tgt_lang=tgt_lang,
+        save_dir="output",
+        num_senior_editors=num_senior_editors, 
+        num_junior_editors=num_junior_editors,
+        num_translators=num_translators, 
+        num_localization_specialists=num_localization_specialists, 
+        num_proofreaders=num_proofreaders,
+        num_beta_readers=num_beta_readers,
+        max_turns=max_turns,
+        max_retry=max_retry,
+        max_rerun=max_rerun,
+        batch_mode=batch_mode,
+        speculative=speculative,
+        stream=stream,
+        hedge=hedge,
+        pack_short_chapters=pack_short_chapters,
+        budget={"project": {"cost": budget}} if budget > 0 else None,
+        profile=profile,
+    )
+
+    if st.button("Estimate Cost and Time") and uploaded_file is not None:
+        # a dry run, no API calls are made
+        chat = TransChat(client=None, text_path=save_upload(uploaded_file), **dict(settings, profile=False))
+        rows = chat.write_plan(concurrency=concurrency, requests_per_minute=requests_per_minute)
+        st.dataframe(pd.DataFrame(rows))
+
     # st.columns(1)
     if st.button('Start Processing') and api_key is not None and uploaded_file is not None:
+        if uploaded_file.name in jobs and jobs[uploaded_file.name]["thread"].is_alive():
+            st.warning(f"{uploaded_file.name} is already being processed.")
+            return
 
-        file_details = {
-            "filename": uploaded_file.name,
-            "content": uploaded_file.getvalue()
-        }
-        save_path = os.path.join("uploads", file_details["filename"])
-        with open(save_path, "wb") as f:
-            f.write(file_details["content"])
-
-
-        client = OpenAI(api_key=api_key)
-
-        chat = TransChat(
-            client=client,
-            src_lang=src_lang,
-            tgt_lang=tgt_lang,
-            text_path=save_path,
-            save_dir="output",
-            num_senior_editors=num_senior_editors, 
-            num_junior_editors=num_junior_editors,
-            num_translators=num_translators, 
-            num_localization_specialists=num_localization_specialists, 
-            num_proofreaders=num_proofreaders,
-            num_beta_readers=num_beta_readers,
-            max_turns=max_turns,
-            max_retry=max_retry,
-            max_rerun=max_rerun,
-        )
-
-        chat.execute()
+        save_path = save_upload(uploaded_file)
+        api_keys = [k.strip() for k in api_key.split(",") if k.strip() != ""]
+        endpoints = [(line.split(",") + [""])[:2] for line in extra_endpoints.splitlines() if line.strip() != ""]
+        client = build_client(api_keys, [(url.strip(), key.strip()) for url, key in endpoints])
+        chat = TransChat(client=client, text_path=save_path, **settings)
+
+        # the job runs in a background thread, the page only polls its progress
+        job = {"chat": chat, "partial": "", "error": None}
+        def keep_partial(event, payload):
+            if event == "partial":
+                job["partial"] = payload["text"]
+        chat.subscribe(keep_partial)
+        job["thread"] = threading.Thread(target=run_job, args=(job,), daemon=True)
+        jobs[uploaded_file.name] = job
+        job["thread"].start()
+        st.session_state["job_name"] = uploaded_file.name
+
+    if len(jobs) == 0:
+        return
+    job_names = list(jobs.keys())
+    job_name = st.session_state.get("job_name")
+    job_name = st.selectbox("Job", job_names, index=job_names.index(job_name) if job_name in job_names else len(job_names)-1)
+    # the rendering of the page is profiled with the job
+    with jobs[job_name]["chat"].profile_unit("render"):
+        render_dashboard(jobs[job_name])
+    if jobs[job_name]["thread"].is_alive():
+        time.sleep(poll_interval)
+        st.rerun()
+
+
+def run_worker():
+    """
+    run a headless worker, several workers on hosts sharing the save directory can process one book together
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--text_path", required=True)
+    parser.add_argument("--save_dir", default="output")
+    parser.add_argument("--src_lang", default="Chinese")
+    parser.add_argument("--tgt_lang", default="English", help="the target language, or several separated by commas to translate into them in parallel")
+    parser.add_argument("--shared_dir", default=None, help="share the source-side preparation with the workers of other target languages")
+    parser.add_argument("--worker_id", default=None, help="the id of this worker among those sharing the save directory, the host and process by default")
+    parser.add_argument("--lease_ttl", type=int, default=300)
+    parser.add_argument("--endpoint", action="append", default=[], help="an OpenAI-compatible endpoint as base_url,api_key, may be repeated")
+    parser.add_argument("--budget", type=float, default=None, help="the ceiling on the cost of the project in USD")
+    parser.add_argument("--dry_run", action="store_true", help="estimate the calls, tokens, cost and wall-clock without calling the API")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--requests_per_minute", type=int, default=None)
+    parser.add_argument("--tokens_per_minute", type=int, default=None)
+    parser.add_argument("--profile", action="store_true", help="profile the CPU time and memory of each stage and chapter, apart from the waits for the API")
+    parser.add_argument("--batch_mode", action="store_true", help="send the translation and summary drafts through the batch API, for offline runs at a lower cost")
+    parser.add_argument("--batch_poll_interval", type=int, default=60)
+    parser.add_argument("--local_batch", action="store_true", help="process the batches locally with the chat completions, for endpoints without the batch API")
+    parser.add_argument("--hedge", action="store_true", help="send a duplicate request for the calls slower than the p95 latency of their stage, the first response wins")
+    args = parser.parse_args()
+
+    # a batch covers the whole book, so a batch worker does not share the project through leases unless given a worker id
+    worker_id = args.worker_id
+    if worker_id is None and not args.batch_mode:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    if args.batch_mode and worker_id is not None:
+        print(f"Batch mode is disabled for the worker {worker_id} sharing the project, the drafts are requested one by one...")
+
+    tgt_langs = args.tgt_lang.split(",")
+    if args.dry_run:
+        for tgt_lang in tgt_langs:
+            chat = TransChat(client=None, src_lang=args.src_lang, tgt_lang=tgt_lang, text_path=args.text_path, save_dir=args.save_dir if len(tgt_langs) == 1 else os.path.join(args.save_dir, tgt_lang), batch_mode=args.batch_mode)
+            chat.write_plan(args.concurrency, args.requests_per_minute, args.tokens_per_minute)
+        return
+
+    client = build_client([k for k in os.environ.get("OPENAI_API_KEY", "").split(",") if k != ""], [endpoint.split(",", 1) if "," in endpoint else (endpoint, "") for endpoint in args.endpoint])
+    if args.local_batch:
+        client = LocalBatchClient(client, os.path.join(args.save_dir, "local_batches"))
+    budget = {"project": {"cost": args.budget}} if args.budget is not None else None
+    if len(tgt_langs) > 1:
+        execute_multi_target(client, args.src_lang, tgt_langs, args.text_path, args.save_dir, shared_dir=args.shared_dir, worker_id=worker_id, lease_ttl=args.lease_ttl, budget=budget, profile=args.profile, batch_mode=args.batch_mode, batch_poll_interval=args.batch_poll_interval, hedge=args.hedge)
+        return
+    chat = TransChat(
+        client=client,
+        src_lang=args.src_lang,
+        tgt_lang=args.tgt_lang,
+        text_path=args.text_path,
+        save_dir=args.save_dir,
+        worker_id=worker_id,
+        lease_ttl=args.lease_ttl,
+        budget=budget,
+        shared_dir=args.shared_dir,
+        profile=args.profile,
+        batch_mode=args.batch_mode,
+        batch_poll_interval=args.batch_poll_interval,
+        hedge=args.hedge,
+    )
+    chat.execute()
 
 
 if __name__=="__main__":
-    main()
+    # streamlit runs the script without arguments
+    if len(sys.argv) > 1:
+        run_worker()
+    else:
+        main()
 
@@ -0,0 +1,228 @@
+import json
+import os
+import time
+
+import pytest
+
+from demo import Book, Budget, BudgetExceeded, LeaseManager, TransChat, TranslationMemory, align_paragraphs, repair_json
+
+
+@pytest.fixture
+def chat(tmp_path):
+    text_path = tmp_path / "book.txt"
+    text_path.write_text("".join([f"第{i}章 标题{i}\n张三第{i}次走进了房间。\n他看见了李四。\n" for i in range(1, 4)]))
+    return TransChat(client=None, src_lang="Chinese", tgt_lang="English", text_path=str(text_path), save_dir=str(tmp_path / "output"))
+
+
+def test_repair_json_code_fence():
+    assert json.loads(repair_json('```json\n{"a": 1}\n```')) == {"a": 1}
+
+
+def test_repair_json_text_around_the_object():
+    assert json.loads(repair_json('Sure! {"a": "x"} Hope it helps. {"b": 2}')) == {"a": "x"}
+
+
+def test_repair_json_unescaped_quotes_and_newlines():
+    assert json.loads(repair_json('{"a": "he said "hi" to me", "b": "line 1\nline 2"}')) == {"a": 'he said "hi" to me', "b": "line 1\nline 2"}
+
+
+def test_repair_json_truncated():
+    assert json.loads(repair_json('{"a": [1, 2, {"b": "trunc')) == {"a": [1, 2, {"b": "trunc"}]}
+    # a key without a value is dropped
+    assert json.loads(repair_json('{"a": 1, "b":')) == {"a": 1}
+
+
+def test_repair_json_without_object():
+    assert repair_json("no JSON here") is None
+
+
+def test_decode_response_coerces_types(chat):
+    format = 'Your response should always be in JSON format as follows: {"justification": string, "finalize": bool, "score": int}.'
+    content = chat.decode_response('{"justification": 3, "finalize": "True", "score": "7"}', "finalize", format)
+    assert content == {"justification": "3", "finalize": True, "score": 7}
+    assert chat.decode_stats["repaired"] == 1
+
+
+def test_decode_response_repairs_text(chat):
+    format = 'Your response should always be in JSON format as follows: {"translation": string}.'
+    assert chat.decode_response('```json\n{"translation": "a "quoted" word"}\n```', "translation", format) == {"translation": 'a "quoted" word'}
+
+
+def test_decode_response_rejects_invalid_types(chat):
+    format = 'Your response should always be in JSON format as follows: {"finalize": bool, "glossary": [string]}.'
+    with pytest.raises(Exception):
+        chat.decode_response('{"finalize": "maybe", "glossary": []}', "finalize", format)
+    with pytest.raises(Exception):
+        chat.decode_response('{"finalize": true, "glossary": "a term"}', "finalize", format)
+    with pytest.raises(Exception):
+        chat.decode_response("not JSON", "finalize", format)
+
+
+def test_decode_response_fills_missing_lists(chat):
+    format = 'Your response should always be in JSON format as follows: {"justification": string, "finalize": bool, "faulty_paragraphs": [int]}.'
+    for text in ['{"justification": "ok", "finalize": false}', '{"justification": "ok", "finalize": false, "faulty_paragraphs": null}']:
+        assert chat.decode_response(text, "finalize", format)["faulty_paragraphs"] == []
+
+
+def test_decode_response_requires_content_key(chat):
+    format = 'Your response should always be in JSON format as follows: {"justification": string, "paragraphs": [int]}.'
+    with pytest.raises(Exception):
+        chat.decode_response('{"justification": "ok"}', "paragraphs", format)
+    format = 'Your response should always be in JSON format as follows: {"justification": string, "finalize": bool}.'
+    with pytest.raises(Exception):
+        chat.decode_response('{"justification": "ok"}', "justification", format)
+
+
+def test_align_paragraphs_one_to_one():
+    source = ["a" * 40, "b" * 8, "c" * 80]
+    target = ["A" * 44, "B" * 8, "C" * 84]
+    assert align_paragraphs(source, target) == [([0], [0]), ([1], [1]), ([2], [2])]
+
+
+def test_align_paragraphs_split_paragraph():
+    source = ["a" * 40, "b" * 80, "c" * 40]
+    target = ["A" * 40, "B" * 40, "B" * 40, "C" * 40]
+    assert align_paragraphs(source, target) == [([0], [0]), ([1], [1, 2]), ([2], [3])]
+
+
+def test_align_paragraphs_empty():
+    assert align_paragraphs([], ["A"]) is None
+    assert align_paragraphs(["a"], []) is None
+
+
+def test_redo_paragraphs_splices_the_faulty_paragraphs(chat, monkeypatch):
+    chat.book[0]["chapter_text"] = "张三第一次走进了房间，他四处看了看。\n他看见了李四。"
+    translation = "Zhang San entered the room for the first time and looked around.\nHe saw Li Si."
+    calls = []
+
+    def call_api(**kwargs):
+        calls.append(kwargs)
+        return {"paragraphs": [{"paragraph": 1, "translation": "There he saw Li Si."}, {"paragraph": 0, "translation": "ignored"}]}, None
+
+    monkeypatch.setattr(chat, "call_api", call_api)
+    monkeypatch.setattr(chat, "post_message", lambda *args: None)
+    chat.project_roles = {"senior_editor": None, "translator": None}
+    spliced = chat.redo_paragraphs(0, "translation", translation, {"finalize": False, "justification": "", "faulty_paragraphs": [1, 7, True]}, [])
+    assert spliced == "Zhang San entered the room for the first time and looked around.\nThere he saw Li Si."
+    assert "paragraphs 1 of the chapter text" in calls[0]["message"]
+    assert chat.paragraph_redo_stats["spliced"] == 1
+
+
+def test_redo_paragraphs_without_faulty_paragraphs(chat):
+    translation = "Zhang San entered the room.\nHe saw Li Si."
+    assert chat.redo_paragraphs(0, "translation", translation, {"finalize": False, "faulty_paragraphs": []}, []) is None
+
+
+def test_lease_acquire_and_release(tmp_path):
+    a = LeaseManager(str(tmp_path), "a")
+    b = LeaseManager(str(tmp_path), "b")
+    assert a.acquire("translation_chapter_0")
+    assert a.acquire("translation_chapter_0")
+    assert not b.acquire("translation_chapter_0")
+    # only the holder removes the lease
+    b.release("translation_chapter_0")
+    assert not b.acquire("translation_chapter_0")
+    a.release("translation_chapter_0")
+    assert b.acquire("translation_chapter_0")
+    assert json.loads((tmp_path / "translation_chapter_0.lease").read_text())["worker_id"] == "b"
+
+
+def test_lease_reclaims_expired(tmp_path):
+    (tmp_path / "summary.lease").write_text(json.dumps({"worker_id": "dead", "expires": time.time() - 1}))
+    b = LeaseManager(str(tmp_path), "b")
+    assert b.acquire("summary")
+    assert json.loads((tmp_path / "summary.lease").read_text())["worker_id"] == "b"
+    assert [p.name for p in tmp_path.iterdir()] == ["summary.lease"]
+
+
+def test_lease_reclaims_empty_file_after_ttl(tmp_path):
+    path = tmp_path / "summary.lease"
+    path.write_text("")
+    b = LeaseManager(str(tmp_path), "b", ttl=60)
+    # a worker may still be writing it
+    assert not b.acquire("summary")
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    assert b.acquire("summary")
+
+
+def test_budget_scopes(tmp_path):
+    budget = Budget(str(tmp_path / "budget.json"), {"stage": {"tokens": 100}, "stage:translation": {"tokens": 10}})
+    assert budget.scopes("translation", 2) == [("project", "project"), ("stage:translation", "stage:translation"), ("chapter:2", "chapter")]
+    assert budget.scopes("summary", None) == [("project", "project"), ("stage:summary", "stage")]
+
+
+def test_budget_limits(tmp_path):
+    budget = Budget(str(tmp_path / "budget.json"), {"stage": {"tokens": 100}, "stage:translation": {"tokens": 10}, "chapter": {"cost": 0.1}})
+    budget.spend("translation", 0, 10, 0)
+    with pytest.raises(BudgetExceeded):
+        budget.check("translation", 1)
+    budget.check("summary", 1)
+    budget.spend("summary", 1, 0, 0.1)
+    with pytest.raises(BudgetExceeded):
+        budget.check("summary", 1)
+    budget.check("summary", 2)
+    assert budget.usage("summary", 1) == 1
+    assert budget.nearly_spent("translation", None)
+
+
+def test_budget_reservations(tmp_path):
+    budget = Budget(str(tmp_path / "budget.json"), {"project": {"cost": 1}})
+    reservation = budget.check("translation", 0, 100, 0.6)
+    assert budget.usage(None, None) == 0.6
+    # a concurrent call cannot overshoot the ceiling with the first one
+    budget.check("translation", 1, 100, 0.6)
+    with pytest.raises(BudgetExceeded):
+        budget.check("translation", 2, 100, 0.1)
+    budget.spend("translation", 0, 80, 0.2, reservation)
+    assert budget.usage(None, None) == pytest.approx(0.8)
+
+
+def test_budget_persists_across_restarts(tmp_path):
+    limits = {"project": {"tokens": 100}}
+    Budget(str(tmp_path / "budget.json"), limits).spend("translation", 0, 60, 0)
+    assert Budget(str(tmp_path / "budget.json"), limits).usage(None, None) == 0.6
+    # the spend of the other workers of a sharded project counts as well
+    Budget(str(tmp_path / "budget_b.json"), limits).spend("translation", 1, 40, 0)
+    with pytest.raises(BudgetExceeded):
+        Budget(str(tmp_path / "budget.json"), limits).check("translation", 2)
+
+
+def test_book_round_trip(tmp_path):
+    book = Book(str(tmp_path), [{"chapter_title": f"Chapter {i}", "chapter_text": f"text {i}"} for i in range(3)], cache_size=2)
+    book[0]["chapter_translation_init"] = "translation 0"
+    assert len(book) == 3
+    assert len(book.cache) == 2
+    assert [chapter["chapter_text"] for chapter in book] == ["text 0", "text 1", "text 2"]
+    assert book[0].to_dict() == {"chapter_title": "Chapter 0", "chapter_text": "text 0", "chapter_translation_init": "translation 0"}
+    assert book[1].get("chapter_summary") is None
+    # only the text fields are spilled to disk
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["chapter_0_chapter_text.txt", "chapter_0_chapter_translation_init.txt", "chapter_1_chapter_text.txt", "chapter_2_chapter_text.txt"]
+
+
+def test_book_to_dict_does_not_fill_cache(tmp_path):
+    book = Book(str(tmp_path), [{"chapter_text": "text 0"}, {"chapter_text": "text 1"}], cache_size=1)
+    assert list(book.cache) == [(1, "chapter_text")]
+    assert book[0].to_dict() == {"chapter_text": "text 0"}
+    assert list(book.cache) == [(1, "chapter_text")]
+
+
+def test_translation_memory_round_trip(tmp_path):
+    memory = TranslationMemory(str(tmp_path), "Chinese", "English")
+    assert memory.add("张三走进了房间。\n他看见了李四。", "Zhang San entered the room.\nHe saw Li Si.") == 2
+    # an existing segment is not stored again
+    assert memory.add("张三走进了房间。", "Zhang San walked into the room.") == 0
+    # the paragraphs of a translation that merges them cannot be aligned
+    assert memory.add("第一段。\n第二段。", "Both paragraphs.") == 0
+
+    memory = TranslationMemory(str(tmp_path), "Chinese", "English")
+    assert memory.lookup(" 张三走进了房间。 ") == ("exact", {"source": "张三走进了房间。", "target": "Zhang San entered the room."}, 1.0)
+    assert memory.lookup("完全不同的句子") is None
+
+
+def test_translation_memory_fuzzy_lookup(tmp_path):
+    memory = TranslationMemory(str(tmp_path), "English", "French")
+    memory.add("The quick brown fox jumps over the lazy dog.", "Le rapide renard brun saute par-dessus le chien paresseux.")
+    kind, segment, score = memory.lookup("The quick brown fox jumps over the lazy cat.")
+    assert kind == "fuzzy"
+    assert segment["target"] == "Le rapide renard brun saute par-dessus le chien paresseux."
+    assert 0.5 <= score < 1